@@ -1,6 +1,7 @@
 from datetime import datetime
 from json import loads
 
+from django.core.cache import cache
 from django.test import TestCase, RequestFactory
 
 from hashtagsv2.hashtags.factories import HashtagFactory
@@ -11,6 +12,7 @@ from . import views
 # Create your tests here.
 class StatisticsTest(TestCase):
     def setUp(self):
+        cache.clear()
         # 5 edits for project: 'en.wikipedia.org' and username: 'a'
         for i in range(1, 6):
             HashtagFactory(
@@ -82,6 +84,40 @@ class StatisticsTest(TestCase):
         )
         self.assertEqual(dict["edits_array"], [5, 3, 0, 2])
 
+    def test_edits_over_days_from_edits(self):
+        # The same series, counted from the edits rather than daily totals
+        HashtagFactory(
+            hashtag="test_hashtag1",
+            rc_id=11,
+            has_image=True,
+            timestamp=datetime(2016, 2, 3),
+        )
+        factory = RequestFactory()
+
+        for data, edits_array, queries in [
+            ({"query": "test_hashtag1"}, [5, 3, 1, 2], 3),
+            ({"query": "test_hashtag1", "image": "on"}, [1], 3),
+            ({"query": "test_hashtag1, test_hashtag2"}, [5, 3, 1, 2], 4),
+        ]:
+            request = factory.get("/api/time_stats", data)
+            # One query for the hashtags' watermarks and ids, one for the date
+            # range, and one for the edits per day. There's no test_hashtag2,
+            # so its id is looked up again.
+            with self.assertNumQueries(queries):
+                response = views.time_statistics_data(request)
+            dict = loads(response.content.decode("utf-8"))
+            self.assertEqual(dict["edits_array"], edits_array)
+
+    def test_edits_over_time_without_edits(self):
+        factory = RequestFactory()
+
+        data = {"query": "test_hashtag1", "image": "on"}
+        request = factory.get("/api/time_stats", data)
+        response = views.time_statistics_data(request)
+        dict = loads(response.content.decode("utf-8"))
+        self.assertEqual(dict["time_array"], [])
+        self.assertEqual(dict["edits_array"], [])
+
     def test_edits_over_months(self):
         # Test edits over month
         for i in range(1, 5):
@@ -146,7 +182,7 @@ class StatisticsTest(TestCase):
         data = {"query": "test_hashtag1"}
         request = factory.get("/users_csv", data)
         response = views.users_csv(request)
-        page_content = response.content
+        page_content = b"".join(response.streaming_content)
 
         # CSV should contain 4 lines - header plus 3 entries
         self.assertEqual(len(page_content.splitlines()), 4)
@@ -157,7 +193,7 @@ class StatisticsTest(TestCase):
         data = {"query": "test_hashtag1"}
         request = factory.get("/projects_csv", data)
         response = views.projects_csv(request)
-        page_content = response.content
+        page_content = b"".join(response.streaming_content)
 
         # CSV should contain 4 lines - header plus 3 entries
         self.assertEqual(len(page_content.splitlines()), 4)
@@ -221,6 +257,14 @@ class StatisticsTest(TestCase):
         ]
         self.assertEqual(user_list, test_users_list)
 
+    def test_all_users_without_results(self):
+        factory = RequestFactory()
+
+        data = {"query": "nonexistenttag"}
+        request = factory.get("/all_users", data)
+        response = views.All_users_view.as_view()(request)
+        self.assertEqual(list(response.context_data["users_list"]), [])
+
     def test_all_projects(self):
         # Test if All_projects_view is giving correct results
         factory = RequestFactory()
@@ -2,24 +2,28 @@ import csv
 import math
 import json
 import itertools
-from datetime import datetime, timedelta, timezone
-from dateutil.relativedelta import relativedelta
+from datetime import date, datetime
 from django.utils.translation import gettext as _
 
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
-from django.db.models import Count
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.db.models import Count, Max, Min, Sum
 from django.db.models.functions import TruncMonth, TruncDay, TruncYear
+from django.views.decorators.gzip import gzip_page
 from django.views.generic import FormView, ListView, View
 from django.shortcuts import render
 
+from hashtagsv2.hashtags.exports import csv_chunks
 from hashtagsv2.hashtags.forms import SearchForm
+from hashtagsv2.hashtags.pagination import CachedCountPaginator
 from hashtagsv2.hashtags.helpers import (
+    cached_search,
+    daily_rollup,
+    edits_per,
     hashtag_queryset,
     get_hashtags_context,
-    results_count,
+    search_statistics,
 )
-from hashtagsv2.hashtags.models import Hashtag
 
 
 def top_project_statistics_data(request):
@@ -27,134 +31,148 @@ def top_project_statistics_data(request):
     # We will need this info as x-axis and y-axis when rendering chart.
     request_dict = request.GET.dict()
 
-    projects = []
-    edits_per_project = []
+    def top_projects():
+        projects = []
+        edits_per_project = []
 
-    hashtags = hashtag_queryset(request_dict)
-    qs = results_count(hashtags, "domain", "-edits")[:10]
-    for item in qs:
-        projects.append(item["domain"])
-        edits_per_project.append(item["edits"])
+        qs = edits_per(request_dict, "domain", "-edits")[:10]
+        for item in qs:
+            projects.append(item["domain"])
+            edits_per_project.append(item["edits"])
 
-    data = {"projects": projects, "edits_per_project": edits_per_project}
-    return JsonResponse(data)
+        return {"projects": projects, "edits_per_project": edits_per_project}
+
+    return JsonResponse(cached_search("top_projects", request_dict, top_projects))
 
 
 def top_user_statistics_data(request):
     # Returns top 10 projects in decreasing order of number of edits.
     request_dict = request.GET.dict()
 
-    usernames = []
-    edits_per_user = []
+    def top_users():
+        usernames = []
+        edits_per_user = []
+
+        qs = edits_per(request_dict, "username", "-edits")[:10]
+        for item in qs:
+            usernames.append(item["username"])
+            edits_per_user.append(item["edits"])
 
-    hashtags = hashtag_queryset(request_dict)
-    qs = results_count(hashtags, "username", "-edits")[:10]
-    for item in qs:
-        usernames.append(item["username"])
-        edits_per_user.append(item["edits"])
+        return {"usernames": usernames, "edits_per_user": edits_per_user}
 
-    data = {"usernames": usernames, "edits_per_user": edits_per_user}
-    return JsonResponse(data)
+    return JsonResponse(cached_search("top_users", request_dict, top_users))
+
+
+# The periods the time series can be split into: how to truncate dates to
+# them, and how to label them.
+TIME_CHARTS = {
+    "dailyTimeChart": (TruncDay, "%Y-%m-%d"),
+    "monthlyTimeChart": (TruncMonth, "%b-%Y"),
+    "yearlyTimeChart": (TruncYear, "%Y"),
+}
+
+
+def period_number(day, view_type):
+    """
+    Number the period a date falls in, counting from the first period of
+    year 1, so that consecutive periods have consecutive numbers.
+    """
+    if view_type == "dailyTimeChart":
+        return day.toordinal()
+    elif view_type == "monthlyTimeChart":
+        return day.year * 12 + day.month - 1
+    return day.year
+
+
+def period_start(number, view_type):
+    """
+    The first day of a period numbered by period_number().
+    """
+    if view_type == "dailyTimeChart":
+        return date.fromordinal(number)
+    elif view_type == "monthlyTimeChart":
+        return date(number // 12, number % 12 + 1, 1)
+    return date(number, 1, 1)
 
 
 def time_statistics_data(request):
     request_dict = request.GET.dict()
+    data = cached_search(
+        "time_stats:" + request_dict.get("view_type", ""),
+        request_dict,
+        lambda: time_statistics(request_dict),
+    )
+    return JsonResponse(data)
 
-    edits_array = []
-    time_array = []
-
-    hashtags = hashtag_queryset(request_dict)
-    earliest_date = hashtags[len(hashtags) - 1].timestamp.date()
-    latest_date = hashtags.first().timestamp.date()
 
-    date_range = latest_date - earliest_date
-    # key value pairs of date unit and number of edits
-    time_dic = {}
+def time_statistics(request_dict):
+    """
+    The number of edits a search found in each day, month or year between
+    its first and last edit.
+    """
+    # Count from the daily totals if they can answer the search, and from
+    # the edits themselves if not. Either way we only read the number of
+    # edits in each period, never the edits.
+    rollup = daily_rollup(request_dict)
+    if rollup is not None:
+        dates = rollup.aggregate(earliest=Min("day"), latest=Max("day"))
+    else:
+        hashtags = hashtag_queryset(request_dict).order_by()
+        dates = hashtags.aggregate(earliest=Min("timestamp"), latest=Max("timestamp"))
+        if dates["earliest"] is not None:
+            dates = {key: value.date() for key, value in dates.items()}
+    earliest_date, latest_date = dates["earliest"], dates["latest"]
 
-    number_of_days = date_range.days
     # if the request is to change the view_type
     if "view_type" in request_dict:
         view_type = request_dict["view_type"]
-        number_of_days = 9999
+        if view_type not in TIME_CHARTS:
+            view_type = "yearlyTimeChart"
+    elif earliest_date is None or (latest_date - earliest_date).days < 90:
+        view_type = "dailyTimeChart"
+    elif (latest_date - earliest_date).days < 1095:
+        view_type = "monthlyTimeChart"
     else:
-        view_type = "NOTA"
+        view_type = "yearlyTimeChart"
 
-    # Split by days
-    if number_of_days < 90 or view_type == "dailyTimeChart":
-        view_type = "dailyTimeChart"
-        qs = (
-            hashtags.annotate(day=TruncDay("timestamp"))
-            .values("day")
-            .annotate(edits=Count("rc_id"))
-            .order_by()
-        )
+    if earliest_date is None:
+        return {"edits_array": [], "time_array": [], "view_type": view_type}
 
-        for item in qs:
-            time_dic[item["day"].date()] = item["edits"]
-        while earliest_date <= latest_date:
-            time_array.append(earliest_date.strftime("%Y-%m-%d"))
-            # If there are edits on a day, append number of edits else append 0
-            if earliest_date in time_dic:
-                temp = time_dic.pop(earliest_date)
-                edits_array.append(temp)
-            else:
-                edits_array.append(0)
-            earliest_date = earliest_date + timedelta(days=1)
-    # Split by months
-    elif (
-        number_of_days >= 90
-        and number_of_days < 1095
-        or view_type == "monthlyTimeChart"
-    ):
-        view_type = "monthlyTimeChart"
+    trunc, label_format = TIME_CHARTS[view_type]
+    if rollup is not None:
         qs = (
-            hashtags.annotate(month=TruncMonth("timestamp"))
-            .values("month")
-            .annotate(edits=Count("rc_id"))
+            rollup.annotate(period=trunc("day"))
+            .values_list("period")
+            .annotate(edits=Sum("edits"))
             .order_by()
         )
-        for item in qs:
-            time_dic[item["month"].date()] = item["edits"]
-
-        earliest_date = earliest_date.replace(day=1)
-        latest_date = latest_date.replace(day=1)
-        while earliest_date <= latest_date:
-            time_array.append(earliest_date.strftime("%b-%Y"))
-            if earliest_date in time_dic:
-                temp = time_dic.pop(earliest_date)
-                edits_array.append(temp)
-            else:
-                edits_array.append(0)
-            earliest_date = earliest_date + relativedelta(months=+1)
-    # Split by years
     else:
-        view_type = "yearlyTimeChart"
         qs = (
-            hashtags.annotate(year=TruncYear("timestamp"))
-            .values("year")
+            hashtags.annotate(period=trunc("timestamp"))
+            .values_list("period")
             .annotate(edits=Count("rc_id"))
             .order_by()
         )
-        for item in qs:
-            time_dic[item["year"].date()] = item["edits"]
-
-        earliest_date = earliest_date.replace(day=1, month=1)
-        latest_date = latest_date.replace(day=1, month=1)
-        while earliest_date <= latest_date:
-            time_array.append(earliest_date.strftime("%Y"))
-            if earliest_date in time_dic:
-                temp = time_dic.pop(earliest_date)
-                edits_array.append(temp)
-            else:
-                edits_array.append(0)
-            earliest_date = earliest_date + relativedelta(years=+1)
-
-    data = {
+
+    # One entry for every period from the earliest edit to the latest,
+    # including those without any edits.
+    first = period_number(earliest_date, view_type)
+    last = period_number(latest_date, view_type)
+    edits_array = [0] * (last - first + 1)
+    for period, edits in qs:
+        if isinstance(period, datetime):
+            period = period.date()
+        edits_array[period_number(period, view_type) - first] += edits
+    time_array = [
+        period_start(number, view_type).strftime(label_format)
+        for number in range(first, last + 1)
+    ]
+
+    return {
         "edits_array": edits_array,
         "time_array": time_array,
         "view_type": view_type,
     }
-    return JsonResponse(data)
 
 
 class StatisticsView(View):
@@ -186,14 +204,21 @@ class All_users_view(ListView):
 
     def get_queryset(self):
         request_dict = self.request.GET.dict()
-        hashtags = hashtag_queryset(request_dict)
-        users_qs = results_count(hashtags, "username", "username")
+        users_qs = edits_per(request_dict, "username", "username")
         return users_qs
 
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return CachedCountPaginator(
+            queryset, per_page, self.request.GET.dict(), cache_prefix="users", **kwargs
+        )
+
     def get_paginate_by(self, queryset):
         request_dict = self.request.GET.dict()
-        hashtags = hashtag_queryset(request_dict)
-        users_count = hashtags.values("username").distinct().count()
+        # The statistics box has the number of users, which only needs to be
+        # roughly right here.
+        users_count = search_statistics(request_dict, hashtag_queryset(request_dict))[
+            "users"
+        ]
         # Paginate such that there are atmost 10 pages
         if users_count > 300:
             return math.ceil(users_count / 10)
@@ -215,50 +240,43 @@ class All_projects_view(ListView):
 
     def get_queryset(self):
         request_dict = self.request.GET.dict()
-        hashtags = hashtag_queryset(request_dict)
-        projects_qs = results_count(hashtags, "domain", "-edits")
+        projects_qs = edits_per(request_dict, "domain", "-edits")
         return projects_qs
 
 
+@gzip_page
 def users_csv(request):
     request_dict = request.GET.dict()
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = 'attachment; filename="hashtags_users.csv"'
 
-    hashtags = hashtag_queryset(request_dict)
-    users_qs = results_count(hashtags, "username", "username")
-    writer = csv.writer(response)
-    writer.writerow(
-        [
-            # Translators: User of the hashtag
-            _("User"),
-            # Translators: Edits done on wikimedia projects.
-            _("Edits"),
-        ]
-    )
-    for user in users_qs:
-        writer.writerow([user["username"], user["edits"]])
+    users_qs = edits_per(request_dict, "username", "username")
+    header = [
+        # Translators: User of the hashtag
+        _("User"),
+        # Translators: Edits done on wikimedia projects.
+        _("Edits"),
+    ]
+    rows = ([user["username"], user["edits"]] for user in users_qs.iterator())
+
+    response = StreamingHttpResponse(csv_chunks(header, rows), content_type="text/csv")
+    response["Content-Disposition"] = 'attachment; filename="hashtags_users.csv"'
     return response
 
 
+@gzip_page
 def projects_csv(request):
     request_dict = request.GET.dict()
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = 'attachment; filename="hashtags_projects.csv"'
 
-    hashtags = hashtag_queryset(request_dict)
-    projects_qs = results_count(hashtags, "domain", "-edits")
-    writer = csv.writer(response)
-    writer.writerow(
-        [
-            # Translators: Wikimedia projects
-            _("Project"),
-            # Translators: Edits done on wikimedia projects.
-            _("Edits"),
-        ]
-    )
-    for project in projects_qs:
-        writer.writerow([project["domain"], project["edits"]])
+    projects_qs = edits_per(request_dict, "domain", "-edits")
+    header = [
+        # Translators: Wikimedia projects
+        _("Project"),
+        # Translators: Edits done on wikimedia projects.
+        _("Edits"),
+    ]
+    rows = ([project["domain"], project["edits"]] for project in projects_qs.iterator())
+
+    response = StreamingHttpResponse(csv_chunks(header, rows), content_type="text/csv")
+    response["Content-Disposition"] = 'attachment; filename="hashtags_projects.csv"'
     return response
 
 
@@ -1,5 +1,8 @@
 from django.contrib import admin
 
-from .models import Hashtag
+from .models import Edit, EditTag, Hashtag, Tag
 
 admin.site.register(Hashtag)
+admin.site.register(Tag)
+admin.site.register(Edit)
+admin.site.register(EditTag)
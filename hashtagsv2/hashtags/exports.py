@@ -0,0 +1,219 @@
+"""
+Streams search results to the downloads a batch at a time, so that exporting
+a hashtag with millions of edits needs no more memory than one batch of them.
+"""
+
+import csv
+from collections import defaultdict
+from io import StringIO
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .helpers import tag_ids
+from .models import EditTag
+from .pagination import rows_after
+
+# How many rows we read from the database per query, and write to the
+# response per chunk.
+EXPORT_BATCH_SIZE = 2000
+
+# The columnar formats we export to, with their content type and file
+# extension: Parquet files, and Arrow IPC streams.
+COLUMNAR_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+# The columns of the columnar exports, besides the hashtags.
+COLUMNAR_FIELDS = (
+    "domain",
+    "timestamp",
+    "username",
+    "page_title",
+    "edit_summary",
+    "rc_id",
+    "rev_id",
+    "has_image",
+    "has_video",
+    "has_audio",
+)
+
+
+def iterate_batches(queryset, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the rows of a search, ordered by -timestamp, -id, a batch at a time.
+    Each batch starts straight after the last row of the one before, rather
+    than at an OFFSET, and the database client never holds more than one
+    batch (unlike iterator(), which mysqlclient reads in full).
+    """
+    batch = list(queryset[:batch_size])
+    while batch:
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+        batch = list(rows_after(queryset, last.timestamp, last.id)[:batch_size])
+
+
+def iterate_rows(queryset, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the rows of a search one at a time, reading them in batches.
+    """
+    for batch in iterate_batches(queryset, batch_size):
+        yield from batch
+
+
+def csv_chunks(header, rows, chunk_size=EXPORT_BATCH_SIZE):
+    """
+    Yield a CSV file with the given header and rows, chunk_size rows at a
+    time, for a StreamingHttpResponse.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for number, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if number % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def json_row(hashtag):
+    """
+    A row of the JSON downloads, with the field names they've always had.
+    """
+    return {
+        "Domain": hashtag.domain,
+        "Timestamp": hashtag.timestamp,
+        "Username": hashtag.username,
+        "Page_title": hashtag.page_title,
+        "Edit_summary": hashtag.edit_summary,
+        "Revision_ID": hashtag.rev_id,
+    }
+
+
+def json_chunks(rows, chunk_size=EXPORT_BATCH_SIZE):
+    """
+    Yield {"Rows": [...]} for the given dicts, chunk_size rows at a time, as
+    JsonResponse would have written it all at once.
+    """
+    encoder = DjangoJSONEncoder()
+    chunk = ['{"Rows": [']
+    for number, row in enumerate(rows):
+        chunk.append((", " if number else "") + encoder.encode(row))
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]}")
+    yield "".join(chunk)
+
+
+def ndjson_chunks(rows, chunk_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the given dicts as newline-delimited JSON, one object per line,
+    chunk_size rows at a time.
+    """
+    encoder = DjangoJSONEncoder()
+    chunk = []
+    for row in rows:
+        chunk.append(encoder.encode(row) + "\n")
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk)
+
+
+class ChunkSink:
+    """
+    A write-only file that hands over what's been written to it whenever we
+    drain() it, so that a file can be streamed while it's written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        # Parquet records where each part of the file starts.
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def columnar_schema():
+    import pyarrow as pa
+
+    # Dictionary encoded, as there are few distinct projects, users and
+    # hashtags compared to edits.
+    names = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("domain", names),
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("username", names),
+            ("page_title", pa.string()),
+            ("edit_summary", pa.string()),
+            ("rc_id", pa.int64()),
+            ("rev_id", pa.int64()),
+            ("has_image", pa.bool_()),
+            ("has_video", pa.bool_()),
+            ("has_audio", pa.bool_()),
+            ("hashtags", pa.list_(names)),
+        ]
+    )
+
+
+def columnar_chunks(queryset, hashtag_list, file_format, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the rows of a search as a compressed Parquet file or Arrow stream,
+    a record batch at a time. The hashtags column lists which of the searched
+    hashtags each edit has.
+    """
+    # Only the exports need pyarrow, so don't load it into every worker.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = columnar_schema()
+    sink = ChunkSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(
+            sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+        )
+
+    # Prefixes match any number of hashtags, so we look for links by id.
+    searched = tag_ids(hashtag_list)
+    for rows in iterate_batches(queryset, batch_size):
+        hashtags = defaultdict(list)
+        for edit_id, name in EditTag.objects.filter(
+            edit_id__in=[row.id for row in rows], tag_id__in=searched
+        ).values_list("edit_id", "tag__name"):
+            hashtags[edit_id].append(name)
+
+        columns = {
+            field: [getattr(row, field) for row in rows] for field in COLUMNAR_FIELDS
+        }
+        columns["hashtags"] = [hashtags[row.id] for row in rows]
+        writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
@@ -1,23 +1,136 @@
+from django.db.models import F
 from django.utils import timezone
 import factory
-import random
+from scripts.hll import HyperLogLog, add_edit
 
-from .models import Hashtag
+from .models import (
+    DailyDomainEdits,
+    DailySketch,
+    DailyUserEdits,
+    Edit,
+    EditTag,
+    Tag,
+)
 
 
-class HashtagFactory(factory.django.DjangoModelFactory):
+class TagFactory(factory.django.DjangoModelFactory):
+
+    class Meta:
+        model = Tag
+        django_get_or_create = ("name",)
+        strategy = factory.CREATE_STRATEGY
+
+    name = factory.Faker("word")
+
+
+class EditFactory(factory.django.DjangoModelFactory):
 
     class Meta:
-        model = Hashtag
+        model = Edit
+        django_get_or_create = ("domain", "rc_id")
         strategy = factory.CREATE_STRATEGY
 
-    hashtag = factory.Faker("word")
     domain = "en.wikipedia.org"
     timestamp = timezone.now()
     username = factory.Faker("word")
     page_title = factory.Faker("word")
     edit_summary = factory.Faker("sentence")
-    rc_id = random.randint(1, 100000)
+    # Edits are unique per (domain, rc_id), so each one needs its own.
+    rc_id = factory.Sequence(lambda n: 100000 + n)
     has_image = False
     has_video = False
     has_audio = False
+
+
+class HashtagFactory(factory.django.DjangoModelFactory):
+    """
+    An edit logged with a hashtag. Hashtags for the same rc_id share an edit.
+    The edit is added to the hashtag's daily totals, and the hashtag's
+    watermark advanced, as the collector would.
+    """
+
+    class Meta:
+        model = EditTag
+        strategy = factory.CREATE_STRATEGY
+
+    class Params:
+        hashtag = factory.Faker("word")
+        domain = "en.wikipedia.org"
+        username = factory.Faker("word")
+        page_title = factory.Faker("word")
+        edit_summary = factory.Faker("sentence")
+        rc_id = factory.Sequence(lambda n: 100000 + n)
+        rev_id = None
+        has_image = False
+        has_video = False
+        has_audio = False
+
+    timestamp = timezone.now()
+    tag = factory.SubFactory(TagFactory, name=factory.SelfAttribute("..hashtag"))
+    edit = factory.SubFactory(
+        EditFactory,
+        domain=factory.SelfAttribute("..domain"),
+        timestamp=factory.SelfAttribute("..timestamp"),
+        username=factory.SelfAttribute("..username"),
+        page_title=factory.SelfAttribute("..page_title"),
+        edit_summary=factory.SelfAttribute("..edit_summary"),
+        rc_id=factory.SelfAttribute("..rc_id"),
+        rev_id=factory.SelfAttribute("..rev_id"),
+        has_image=factory.SelfAttribute("..has_image"),
+        has_video=factory.SelfAttribute("..has_video"),
+        has_audio=factory.SelfAttribute("..has_audio"),
+    )
+
+    @factory.post_generation
+    def daily_totals(obj, create, extracted, **kwargs):
+        if not create:
+            return
+        timestamp = obj.edit.timestamp
+        if timezone.is_aware(timestamp):
+            timestamp = timestamp.astimezone(timezone.utc)
+        for model, field in (
+            (DailyDomainEdits, "domain"),
+            (DailyUserEdits, "username"),
+        ):
+            total, _ = model.objects.get_or_create(
+                tag=obj.tag,
+                day=timestamp.date(),
+                defaults={"edits": 0},
+                **{field: getattr(obj.edit, field)}
+            )
+            model.objects.filter(pk=total.pk).update(edits=F("edits") + 1)
+
+    @factory.post_generation
+    def daily_sketches(obj, create, extracted, **kwargs):
+        if not create:
+            return
+        timestamp = obj.edit.timestamp
+        if timezone.is_aware(timestamp):
+            timestamp = timestamp.astimezone(timezone.utc)
+        empty = HyperLogLog().to_bytes()
+        stored, _ = DailySketch.objects.get_or_create(
+            tag=obj.tag,
+            day=timestamp.date(),
+            defaults={"users": empty, "pages": empty, "revisions": empty},
+        )
+        sketches = [
+            HyperLogLog.from_bytes(stored.users),
+            HyperLogLog.from_bytes(stored.pages),
+            HyperLogLog.from_bytes(stored.revisions),
+        ]
+        add_edit(
+            sketches,
+            obj.edit.username,
+            obj.edit.domain,
+            obj.edit.page_title,
+            obj.edit.rev_id,
+        )
+        stored.users, stored.pages, stored.revisions = (
+            sketch.to_bytes() for sketch in sketches
+        )
+        stored.save()
+
+    @factory.post_generation
+    def watermark(obj, create, extracted, **kwargs):
+        if create:
+            Tag.objects.filter(pk=obj.tag_id).update(watermark=F("watermark") + 1)
@@ -14,8 +14,14 @@ class SearchForm(forms.Form):
     query = forms.CharField(
         label=_("Hashtag"),
         # Translators: Placeholder for the section of form where we ask user to specify a hashtag.
+        # Suggestions for the hashtag being typed are filled in by suggest.js.
         widget=forms.TextInput(
-            attrs={"placeholder": _("Enter a hashtag"), "style": "width:100%"}
+            attrs={
+                "placeholder": _("Enter a hashtag"),
+                "style": "width:100%",
+                "list": "hashtag-suggestions",
+                "autocomplete": "off",
+            }
         ),
     )
 
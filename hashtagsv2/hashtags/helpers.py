@@ -1,11 +1,50 @@
 from datetime import datetime
-from datetime import timedelta
+from datetime import timedelta, timezone
 
-from .models import Hashtag
+from .models import (
+    DailyDomainEdits,
+    DailySketch,
+    DailyUserEdits,
+    Edit,
+    EditTag,
+    Leaderboard,
+    Tag,
+)
 
-from django.db.models import Count
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Min, Sum, Value
+from django.db.models.functions import Concat
+from hashlib import sha1
+from scripts.hll import HyperLogLog
 from urllib.parse import urlencode
 
+# How long we remember what we've worked out for a search, such as its number
+# of results, its statistics box and its charts. Cached results are also
+# dropped as soon as edits are logged with any of its hashtags.
+SEARCH_CACHE_S = 60 * 60
+
+# The home page lists this many of the hashtags used most over this many days.
+TOP_TAGS_COUNT = 10
+TOP_TAGS_DAYS = 30
+
+# A search term ending in a * matches the hashtags starting with the rest of
+# it, which must be at least PREFIX_MIN_LENGTH characters long. Only the first
+# PREFIX_MAX_TAGS of them alphabetically are searched.
+PREFIX_MIN_LENGTH = 3
+PREFIX_MAX_TAGS = 1000
+
+# Parameters that change which page of results we show, but not the results.
+PAGE_PARAMETERS = ("page", "cursor")
+
+# The daily totals of edits per hashtag kept for each field, and the search
+# parameter that filters on the field. A search filtering on the other field
+# can't be answered from them.
+ROLLUPS = {
+    "domain": (DailyDomainEdits, "project"),
+    "username": (DailyUserEdits, "user"),
+}
+
 
 def split_hashtags(hashtag_list):
     split_hashtags_list = hashtag_list.split(",")
@@ -17,6 +56,135 @@ def split_hashtags(hashtag_list):
     return final_hashtags
 
 
+def hashtag_prefix(term):
+    """
+    The prefix a search term matches hashtags by, or None if it's a hashtag
+    name.
+    """
+    if len(term) > PREFIX_MIN_LENGTH and term.endswith("*"):
+        return term[:-1]
+    return None
+
+
+def prefix_tags(prefix):
+    """
+    The hashtags searched for a prefix: those starting with it, whatever
+    their case, up to PREFIX_MAX_TAGS of them.
+    """
+    return Tag.objects.filter(name__istartswith=prefix).order_by("name")[
+        :PREFIX_MAX_TAGS
+    ]
+
+
+def truncated_prefixes(hashtag_list):
+    """
+    The prefixes among the given search terms that match more hashtags than
+    we search.
+    """
+    return [
+        hashtag_prefix(term)
+        for term in hashtag_list
+        if hashtag_prefix(term)
+        and Tag.objects.filter(name__istartswith=hashtag_prefix(term))
+        .order_by("name")[PREFIX_MAX_TAGS:]
+        .exists()
+    ]
+
+
+def matching_tags(hashtag_list):
+    """
+    The name, id and watermark of each hashtag searched for by the given
+    terms. Names match without regard to case, as the database compares them,
+    and prefixes do too.
+    """
+    names = [term for term in hashtag_list if not hashtag_prefix(term)]
+    tags = list(
+        Tag.objects.filter(name__in=names).values_list("name", "id", "watermark")
+    )
+    for term in hashtag_list:
+        if hashtag_prefix(term):
+            tags += prefix_tags(hashtag_prefix(term)).values_list(
+                "name", "id", "watermark"
+            )
+    return tags
+
+
+def tag_id_key(name):
+    return "tag_id:{}".format(sha1(name.lower().encode()).hexdigest())
+
+
+def tag_ids(hashtag_list):
+    """
+    The ids of the hashtags with the given names, so that searches can find
+    their links by integer rather than joining on the name. Hashtags keep
+    their ids for good, so each is only looked up once and then cached.
+    Names we have no hashtag for are left out. Prefixes are looked up every
+    time, since new hashtags may start with them.
+    """
+    prefixes = [hashtag_prefix(term) for term in hashtag_list if hashtag_prefix(term)]
+    keys = {name: tag_id_key(name) for name in hashtag_list if not hashtag_prefix(name)}
+    cached = cache.get_many(keys.values())
+    missing = [name for name, key in keys.items() if key not in cached]
+    if missing:
+        found = dict(Tag.objects.filter(name__in=missing).values_list("name", "id"))
+        lowercased = {name.lower(): tag_id for name, tag_id in found.items()}
+        new = {
+            keys[name]: lowercased[name.lower()]
+            for name in missing
+            if name.lower() in lowercased
+        }
+        # The database compares names without regard to accents too, so a
+        # tag we found that no name matches in Python is one of the others'.
+        # Only the database can tell which, so ask it name by name.
+        unclaimed = set(found.values()) - set(new.values())
+        for name in missing:
+            if unclaimed and keys[name] not in new:
+                tag_id = (
+                    Tag.objects.filter(name=name, id__in=unclaimed)
+                    .values_list("id", flat=True)
+                    .first()
+                )
+                if tag_id is not None:
+                    new[keys[name]] = tag_id
+        cache.set_many(new, timeout=None)
+        cached.update(new)
+    ids = {cached[key] for key in keys.values() if key in cached}
+    for prefix in prefixes:
+        ids.update(prefix_tags(prefix).values_list("id", flat=True))
+    return sorted(ids)
+
+
+def edits_with_any_hashtag(hashtag_list, **link_filters):
+    """
+    The edits with any of the given hashtags. link_filters further filter
+    the EditTags linking them, e.g. by timestamp.
+    """
+    # A subquery rather than a join, so that an edit with several of the
+    # hashtags is only returned once.
+    return Edit.objects.filter(
+        id__in=EditTag.objects.filter(
+            tag_id__in=tag_ids(hashtag_list), **link_filters
+        ).values("edit_id")
+    )
+
+
+def edits_with_all_hashtags(hashtag_list, **link_filters):
+    """
+    The edits with every one of the given hashtags, filtered in the same way
+    as edits_with_any_hashtag().
+    """
+    # One subquery per hashtag, so that the database finds the edits they
+    # have in common and we never load the edits for each hashtag here.
+    queryset = Edit.objects.all()
+    for hashtag in hashtag_list:
+        queryset = queryset.filter(
+            id__in=EditTag.objects.filter(
+                tag_id__in=tag_ids([hashtag]), **link_filters
+            ).values("edit_id")
+        )
+    return queryset
+
+
 def hashtag_queryset(request_dict):
     """
     This function parses a request dictionary and filters a hashtag
@@ -25,27 +193,36 @@ def hashtag_queryset(request_dict):
 
     hashtag_list = split_hashtags(request_dict["query"])
 
+    # Links have the same timestamp as their edit. Filtering them by it too
+    # means the database only reads the links (and, if the table is
+    # partitioned, the partitions) for the dates searched.
+    date_filters = {}
+
+    if "startdate" in request_dict:
+        if request_dict["startdate"]:
+            date_filters["timestamp__gt"] = request_dict["startdate"]
+
+    if "enddate" in request_dict:
+        if request_dict["enddate"]:
+            # Convert enddate to a datetime directly to ensure timedelta
+            # works if the date comes in as a string.
+            if type(request_dict["enddate"]) == str:
+                end_date = datetime.strptime(request_dict["enddate"], "%Y-%m-%d")
+            else:
+                end_date = request_dict["enddate"]
+            enddate_plus_one = end_date + timedelta(days=1)
+            date_filters["timestamp__lt"] = enddate_plus_one
+
     # If search_type is provided by the user
     if "search_type" in request_dict:
         if request_dict["search_type"] == "and":
-            rcids_for_hashtag = []
-            # Collect rc_ids for each individual tag
-            for hashtag in hashtag_list:
-                qs = (
-                    Hashtag.objects.filter(hashtag=hashtag)
-                    .values_list("rc_id", flat=True)
-                    .distinct()
-                )
-                rcids_for_hashtag.append(set(qs))
-            # Find common rc_ids by taking intersection of above
-            # obtained rc_ids
-            final_rcids = rcids_for_hashtag[0].intersection(*rcids_for_hashtag)
-            queryset = Hashtag.objects.filter(rc_id__in=list(final_rcids))
+            queryset = edits_with_all_hashtags(hashtag_list, **date_filters)
         else:
-            queryset = Hashtag.objects.filter(hashtag__in=hashtag_list)
+            queryset = edits_with_any_hashtag(hashtag_list, **date_filters)
     # If user didn't provide search_type
     else:
-        queryset = Hashtag.objects.filter(hashtag__in=hashtag_list)
+        queryset = edits_with_any_hashtag(hashtag_list, **date_filters)
+    queryset = queryset.filter(**date_filters)
 
     if "project" in request_dict:
         if request_dict["project"]:
@@ -55,21 +232,6 @@ def hashtag_queryset(request_dict):
         if request_dict["user"]:
             queryset = queryset.filter(username=request_dict["user"])
 
-    if "startdate" in request_dict:
-        if request_dict["startdate"]:
-            queryset = queryset.filter(timestamp__gt=request_dict["startdate"])
-
-    if "enddate" in request_dict:
-        if request_dict["enddate"]:
-            # Convert enddate to a datetime directly to ensure timedelta
-            # works if the date comes in as a string.
-            if type(request_dict["enddate"]) == str:
-                end_date = datetime.strptime(request_dict["enddate"], "%Y-%m-%d")
-            else:
-                end_date = request_dict["enddate"]
-            enddate_plus_one = end_date + timedelta(days=1)
-            queryset = queryset.filter(timestamp__lt=enddate_plus_one)
-
     if request_dict.get("image", False):
         queryset = queryset.filter(has_image=True)
 
@@ -79,68 +241,315 @@ def hashtag_queryset(request_dict):
     if request_dict.get("audio", False):
         queryset = queryset.filter(has_audio=True)
 
-    # We're using MySQL, which doesn't support DISTINCT ON, but we
-    # want to allow multiple hashtags to be queried simultaneously while
-    # not displaying the same edit more than once. We can achieve this
-    # by using values_list() for every field except hashtag - each
-    # other field is identical for the same edit, so we can use
-    # distinct() successfully.
+    # Each edit is only stored once, however many of the hashtags it has, so
+    # we don't need DISTINCT to avoid listing the same edit more than once.
     # Note that this returns a Queryset of Rows, not Objects.
-    ordered_queryset = (
-        queryset.order_by("-timestamp")
-        .values_list(
-            "domain",
-            "timestamp",
-            "username",
-            "page_title",
-            "edit_summary",
-            "rc_id",
-            "rev_id",
-            "has_image",
-            "has_video",
-            "has_audio",
-            named=True,
-        )
-        .distinct()
+    # Ordering by id as well gives each edit a fixed place in the results,
+    # which keyset pagination relies on.
+    ordered_queryset = queryset.order_by("-timestamp", "-id").values_list(
+        "id",
+        "domain",
+        "timestamp",
+        "username",
+        "page_title",
+        "edit_summary",
+        "rc_id",
+        "rev_id",
+        "has_image",
+        "has_video",
+        "has_audio",
+        named=True,
     )
 
     return ordered_queryset
 
 
+def canonical_search(request_dict):
+    """
+    The parameters that decide the results of a search, written the same way
+    for every search with the same results: hashtags deduplicated, sorted and
+    lowercased (the database compares them without regard to case), the
+    project lowercased, and media flags as booleans.
+    """
+    hashtags = sorted(
+        {hashtag.lower() for hashtag in split_hashtags(request_dict.get("query", ""))}
+    )
+    search = {"query": ",".join(hashtags)}
+    if len(hashtags) > 1:
+        search["search_type"] = (
+            "and" if request_dict.get("search_type") == "and" else "or"
+        )
+    if request_dict.get("project"):
+        search["project"] = request_dict["project"].strip().lower()
+    for parameter in ("user", "startdate", "enddate"):
+        if request_dict.get(parameter):
+            search[parameter] = str(request_dict[parameter]).strip()
+    for flag in ("image", "video", "audio"):
+        if request_dict.get(flag):
+            search[flag] = True
+    return search
+
+
+def query_cache_key(prefix, request_dict):
+    """
+    A cache key for the results of a search, the same whichever page of them
+    we're looking at and however the search is written. It includes the
+    watermarks of the search's hashtags, which the collector advances as it
+    logs edits with them, so the key changes whenever the results might. New
+    hashtags starting with a searched prefix change it too.
+    """
+    hashtags = split_hashtags(request_dict.get("query", ""))
+    tags = matching_tags(hashtags)
+    watermarks = sorted((name.lower(), watermark) for name, _, watermark in tags)
+    # We have the ids anyway, so the search itself needn't look them up.
+    names = {hashtag.lower() for hashtag in hashtags}
+    cache.set_many(
+        {tag_id_key(name): tag_id for name, tag_id, _ in tags if name.lower() in names},
+        timeout=None,
+    )
+    parameters = sorted(canonical_search(request_dict).items()) + [
+        ("#" + name, watermark) for name, watermark in watermarks
+    ]
+    return "{prefix}:{digest}".format(
+        prefix=prefix, digest=sha1(urlencode(parameters).encode()).hexdigest()
+    )
+
+
+def cached_search(prefix, request_dict, compute):
+    """
+    Something we work out for a search with compute(), which we only do once
+    until the search's hashtags are used again (or an hour has passed).
+    """
+    return cache.get_or_set(
+        query_cache_key(prefix, request_dict), compute, SEARCH_CACHE_S
+    )
+
+
+def cached_results_count(request_dict, hashtags):
+    """
+    The number of results for a search, which we only count once rather than
+    for every page of results.
+    """
+    return cached_search(
+        "results_count", request_dict, lambda: hashtags.order_by().count()
+    )
+
+
+def hashtag_statistics(hashtags):
+    """
+    The figures for the statistics box, computed in a single query.
+    """
+    # We use a query derived from the main queryset, so we keep most
+    # parameters (e.g. start and end date), but remove the ordering.
+    statistics = hashtags.order_by().aggregate(
+        oldest=Min("timestamp"),
+        newest=Max("timestamp"),
+        revisions=Count("rev_id", distinct=True),
+        projects=Count("domain", distinct=True),
+        # Domains can't contain a colon, so this is unique to each page.
+        pages=Count(Concat("domain", Value(":"), "page_title"), distinct=True),
+        users=Count("username", distinct=True),
+    )
+    # A search with no results has no dates.
+    for field in ("oldest", "newest"):
+        if statistics[field] is not None:
+            statistics[field] = statistics[field].date()
+    return statistics
+
+
+def approximate_statistics(request_dict):
+    """
+    The figures for the statistics box, with the numbers of users, pages and
+    revisions estimated from the daily sketches. None if the sketches can't
+    answer the search, or if it's small enough to count exactly.
+    """
+    sketches = sketch_queryset(request_dict)
+    if sketches is None:
+        return None
+    totals = for_days(
+        DailyDomainEdits.objects.filter(
+            tag_id__in=tag_ids(split_hashtags(request_dict["query"]))
+        ),
+        request_dict,
+    ).aggregate(
+        edits=Sum("edits"),
+        oldest=Min("day"),
+        newest=Max("day"),
+        projects=Count("domain", distinct=True),
+    )
+    # Without daily totals for the search we can't tell how big it is.
+    if not totals["edits"]:
+        return None
+    if (
+        not settings.APPROXIMATE_STATISTICS
+        and totals["edits"] <= settings.APPROXIMATE_STATISTICS_EDITS
+    ):
+        return None
+
+    users, pages, revisions = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for stored in sketches.values_list("users", "pages", "revisions"):
+        for sketch, data in zip((users, pages, revisions), stored):
+            sketch.update(HyperLogLog.from_bytes(data))
+    return {
+        "oldest": totals["oldest"],
+        "newest": totals["newest"],
+        "revisions": revisions.count(),
+        "projects": totals["projects"],
+        "pages": pages.count(),
+        "users": users.count(),
+        "approximate": True,
+    }
+
+
+def search_statistics(request_dict, hashtags):
+    """
+    The figures for the statistics box for a search, which are the same for
+    every page of results, so we only work them out once. They're estimated
+    for big searches unless the search asks for exact ones.
+    """
+    if request_dict.get("exact"):
+        return cached_search(
+            "exact_statistics", request_dict, lambda: hashtag_statistics(hashtags)
+        )
+    return cached_search(
+        "statistics",
+        request_dict,
+        lambda: approximate_statistics(request_dict) or hashtag_statistics(hashtags),
+    )
+
+
 def get_hashtags_context(request, hashtags, context):
     # Context data for StatisticsView and Index view
-    # TODO: We should be able to cache this across pages.
 
     hashtag_query = request.GET.get("query")
     context["hashtag_query_list"] = split_hashtags(hashtag_query)
 
-    # We use queries derived from the main queryset, so we keep most parameters
-    # (e.g. start and end date), but remove the ordering and select only the
-    # fields we need.
-    context["oldest"] = (hashtags.order_by().values("timestamp").earliest("timestamp"))[
-        "timestamp"
-    ].date()
-    context["newest"] = (hashtags.order_by().values("timestamp").latest("timestamp"))[
-        "timestamp"
-    ].date()
-    context["revisions"] = hashtags.order_by().values("rev_id").distinct().count()
-    context["projects"] = hashtags.order_by().values("domain").distinct().count()
-    context["pages"] = (
-        hashtags.order_by().values("domain", "page_title").distinct().count()
-    )
-    context["users"] = hashtags.order_by().values("username").distinct().count()
+    context.update(search_statistics(request.GET.dict(), hashtags))
 
     request_dict = request.GET.dict()
 
     # The GET parameters from the URL, for formatting links
-    # We don't require page parameter so removing it from request_dict
-    if "page" in request_dict:
-        request_dict.pop("page")
+    # We don't require page parameters so removing them from request_dict
+    for parameter in PAGE_PARAMETERS:
+        request_dict.pop(parameter, None)
     context["query_string"] = urlencode(request_dict)
     return context
 
 
+def rollup_queryset(request_dict, field):
+    """
+    The daily totals of edits for a search, kept by hashtag and field (domain
+    or username), or None if the search needs the edits themselves.
+    """
+    # Edits with several of the hashtags would be counted once for each.
+    hashtags = split_hashtags(request_dict["query"])
+    if len({hashtag.lower() for hashtag in hashtags}) != 1:
+        return None
+    # Nor can edits with several hashtags starting with the same prefix.
+    if hashtag_prefix(hashtags[0]):
+        return None
+    # Media flags aren't kept in the totals.
+    if any(request_dict.get(flag) for flag in ("image", "video", "audio")):
+        return None
+    model, parameter = ROLLUPS[field]
+    for other_field, (_, other_parameter) in ROLLUPS.items():
+        if other_field != field and request_dict.get(other_parameter):
+            return None
+
+    queryset = model.objects.filter(tag_id__in=tag_ids(hashtags[:1]))
+    if request_dict.get(parameter):
+        queryset = queryset.filter(**{field: request_dict[parameter]})
+    return for_days(queryset, request_dict)
+
+
+def sketch_queryset(request_dict):
+    """
+    The daily sketches for a search, or None if the search needs the edits
+    themselves.
+    """
+    # Sketches of several hashtags merge into a sketch of the edits with any
+    # of them, but not of the edits they have in common.
+    hashtags = split_hashtags(request_dict["query"])
+    if len(hashtags) > 1 and request_dict.get("search_type") == "and":
+        return None
+    # Sketches are only kept per hashtag.
+    for parameter in ("project", "user", "image", "video", "audio"):
+        if request_dict.get(parameter):
+            return None
+    return for_days(
+        DailySketch.objects.filter(tag_id__in=tag_ids(hashtags)), request_dict
+    )
+
+
+def for_days(queryset, request_dict):
+    """
+    Filter a queryset of daily totals or sketches to a search's dates. They're
+    kept by day, so a search from or to a date covers the whole of that day.
+    """
+    if request_dict.get("startdate"):
+        queryset = queryset.filter(day__gte=request_dict["startdate"])
+    if request_dict.get("enddate"):
+        queryset = queryset.filter(day__lte=request_dict["enddate"])
+    return queryset
+
+
+def daily_rollup(request_dict):
+    """
+    The daily totals of edits for a search from whichever table can answer
+    it, or None if neither can.
+    """
+    for field in ROLLUPS:
+        queryset = rollup_queryset(request_dict, field)
+        if queryset is not None:
+            return queryset
+    return None
+
+
+def edits_per(request_dict, field, sort_param):
+    """
+    The number of edits a search found for each value of field (domain or
+    username), sorted by sort_param, from the daily totals if they can
+    answer the search.
+    """
+    queryset = rollup_queryset(request_dict, field)
+    if queryset is None:
+        return results_count(hashtag_queryset(request_dict), field, sort_param)
+    return queryset.values(field).annotate(edits=Sum("edits")).order_by(sort_param)
+
+
 def results_count(qs, field, sort_param):
     # Return edits count for a particular field (for eg. users)
     # sorted by sort_param (for eg. edits)
     return qs.values(field).annotate(edits=Count("rc_id")).order_by(sort_param)
+
+
+def refresh_leaderboard():
+    """
+    Count the hashtags used most recently, and find the latest edit we've
+    logged, for the home page.
+    """
+    since = datetime.now(timezone.utc).date() - timedelta(days=TOP_TAGS_DAYS)
+    # The daily totals have far fewer rows to add up than the edits.
+    top_tags = (
+        DailyDomainEdits.objects.filter(day__gt=since)
+        .values_list("tag__name")
+        .annotate(edits=Sum("edits"))
+        .order_by("-edits")[:TOP_TAGS_COUNT]
+    )
+    leaderboard, _ = Leaderboard.objects.update_or_create(
+        id=1,
+        defaults={
+            "top_tags": [name for name, _ in top_tags],
+            "latest_edit": Edit.objects.aggregate(latest=Max("timestamp"))["latest"],
+            "refreshed": datetime.now(timezone.utc),
+        },
+    )
+    return leaderboard
+
+
+def get_leaderboard():
+    """
+    The home page's leaderboard, as last refreshed. We only count it here if
+    it's never been refreshed, e.g. on a new install.
+    """
+    return Leaderboard.objects.filter(id=1).first() or refresh_leaderboard()
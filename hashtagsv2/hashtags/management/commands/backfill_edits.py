@@ -0,0 +1,120 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from hashtagsv2.hashtags.models import Edit, EditTag, Hashtag, Tag
+
+# How many legacy rows we copy per transaction. Small batches keep the locks
+# short, so the collector and the website carry on as normal meanwhile.
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy hashtags logged in the old hashtags_hashtag table to the Tag, "
+        "Edit and EditTag tables. Safe to run while the collector is running, "
+        "and to run again if interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start-id",
+            type=int,
+            default=0,
+            help="Resume from this hashtags_hashtag id.",
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        start_id = options["start_id"]
+        batch_size = options["batch_size"]
+        copied = 0
+        while True:
+            rows = list(
+                Hashtag.objects.filter(id__gte=start_id)
+                .order_by("id")
+                .values(
+                    "id",
+                    "hashtag",
+                    "domain",
+                    "timestamp",
+                    "username",
+                    "page_title",
+                    "edit_summary",
+                    "rc_id",
+                    "rev_id",
+                    "has_image",
+                    "has_video",
+                    "has_audio",
+                )[:batch_size]
+            )
+            if not rows:
+                break
+            with transaction.atomic():
+                copied += copy_rows(rows)
+            start_id = rows[-1]["id"] + 1
+            self.stdout.write(
+                "Copied {copied} hashtags, up to id {id}".format(
+                    copied=copied, id=rows[-1]["id"]
+                )
+            )
+        self.stdout.write(self.style.SUCCESS("Done"))
+
+
+def copy_rows(rows):
+    """
+    Copy legacy Hashtag rows to the new tables, skipping any that are already
+    there. Returns the number of hashtags copied.
+    """
+    Tag.objects.bulk_create(
+        [Tag(name=name) for name in {row["hashtag"] for row in rows}],
+        ignore_conflicts=True,
+    )
+    tag_ids = tag_ids_for({row["hashtag"] for row in rows})
+
+    edits = {}
+    for row in rows:
+        edit = {k: v for k, v in row.items() if k not in ("id", "hashtag")}
+        edits.setdefault((row["domain"], row["rc_id"]), edit)
+    Edit.objects.bulk_create(
+        [Edit(**edit) for edit in edits.values()], ignore_conflicts=True
+    )
+    edit_ids = {
+        (domain, rc_id): edit_id
+        for edit_id, domain, rc_id in Edit.objects.filter(
+            domain__in={domain for domain, _ in edits},
+            rc_id__in={rc_id for _, rc_id in edits},
+        ).values_list("id", "domain", "rc_id")
+    }
+
+    links = {
+        (tag_ids[row["hashtag"]], edit_ids[(row["domain"], row["rc_id"])]): row
+        for row in rows
+    }
+    existing = set(
+        EditTag.objects.filter(edit_id__in=edit_ids.values()).values_list(
+            "tag_id", "edit_id"
+        )
+    )
+    new_links = [
+        EditTag(tag_id=tag_id, edit_id=edit_id, timestamp=row["timestamp"])
+        for (tag_id, edit_id), row in links.items()
+        if (tag_id, edit_id) not in existing
+    ]
+    EditTag.objects.bulk_create(new_links, ignore_conflicts=True)
+    # Cached searches for these hashtags are now out of date.
+    Tag.objects.filter(id__in={link.tag_id for link in new_links}).update(
+        watermark=F("watermark") + 1
+    )
+    return len(new_links)
+
+
+def tag_ids_for(names):
+    """
+    Map hashtag names to Tag ids. The database compares names without regard
+    to case, so a name may belong to a Tag stored with different case.
+    """
+    tag_ids = dict(Tag.objects.filter(name__in=names).values_list("name", "id"))
+    for name in names - tag_ids.keys():
+        tag_ids[name] = Tag.objects.filter(name=name).values_list("id", flat=True)[0]
+    return tag_ids
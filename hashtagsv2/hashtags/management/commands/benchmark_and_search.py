@@ -0,0 +1,107 @@
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from hashtagsv2.hashtags.helpers import hashtag_queryset
+from hashtagsv2.hashtags.models import Edit, EditTag, Tag
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare AND searches done in the database with the old approach of "
+        "intersecting each hashtag's edits in Python, on synthetic data. The "
+        "data is created in a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--edits", type=int, default=200000, help="Edits per hashtag."
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            query = self.create_edits(options["edits"])
+            for name, search in (
+                ("python sets", python_sets_search),
+                ("database", database_search),
+            ):
+                tracemalloc.start()
+                start = time.perf_counter()
+                count, page = search(query)
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.stdout.write(
+                    "{name:12} {count} edits, {elapsed:.2f} s, "
+                    "peak memory {peak:.1f} MiB".format(
+                        name=name,
+                        count=count,
+                        elapsed=elapsed,
+                        peak=peak / 2**20,
+                    )
+                )
+            transaction.set_rollback(True)
+
+    def create_edits(self, edits_per_tag):
+        """
+        Create two hashtags with edits_per_tag edits each, half of which
+        have both hashtags. Returns the search query for them.
+        """
+        tags = [Tag.objects.create(name="benchmark_and_" + x) for x in "ab"]
+        timestamp = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        total = edits_per_tag * 3 // 2
+        for start in range(0, total, BATCH_SIZE):
+            edits = Edit.objects.bulk_create(
+                Edit(
+                    domain="benchmark.wikipedia.org",
+                    timestamp=timestamp + timedelta(seconds=n),
+                    username="Benchmark",
+                    page_title="Benchmark",
+                    edit_summary="#benchmark_and_a #benchmark_and_b",
+                    rc_id=n,
+                )
+                for n in range(start, min(start + BATCH_SIZE, total))
+            )
+            # bulk_create only sets ids on some databases, so look them up.
+            edits = (
+                Edit.objects.filter(domain="benchmark.wikipedia.org", rc_id__gte=start)
+                .order_by("rc_id")
+                .values_list("id", "rc_id", "timestamp")[: len(edits)]
+            )
+            links = []
+            for edit_id, rc_id, edit_timestamp in edits:
+                # The first third of the edits have the first hashtag, the
+                # last third the second, and the middle third both.
+                for tag, has_tag in (
+                    (tags[0], rc_id < edits_per_tag),
+                    (tags[1], rc_id >= total - edits_per_tag),
+                ):
+                    if has_tag:
+                        links.append(
+                            EditTag(tag=tag, edit_id=edit_id, timestamp=edit_timestamp)
+                        )
+            EditTag.objects.bulk_create(links)
+            self.stdout.write("Created {} edits".format(min(start + BATCH_SIZE, total)))
+        return ", ".join(tag.name for tag in tags)
+
+
+def python_sets_search(query):
+    # How AND searches used to work: load each hashtag's edits and intersect
+    # them here, then search for the result.
+    edits_for_hashtag = [
+        set(EditTag.objects.filter(tag__name=name).values_list("edit_id", flat=True))
+        for name in query.split(", ")
+    ]
+    final_edits = edits_for_hashtag[0].intersection(*edits_for_hashtag)
+    queryset = Edit.objects.filter(id__in=list(final_edits)).order_by("-timestamp")
+    return queryset.count(), list(queryset[:20])
+
+
+def database_search(query):
+    queryset = hashtag_queryset({"query": query, "search_type": "and"})
+    return queryset.count(), list(queryset[:20])
@@ -0,0 +1,139 @@
+from datetime import datetime, time, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+
+from hashtagsv2.hashtags.models import (
+    DailyDomainEdits,
+    DailySketch,
+    DailyUserEdits,
+    EditTag,
+    Tag,
+)
+from hashtagsv2.hashtags.pagination import rows_after
+from scripts.hll import HyperLogLog, add_edit
+
+# How often, in hashtags, we report progress.
+REPORT_EVERY = 500
+
+# How many of a hashtag's edits we read at a time to build its sketches.
+SKETCH_BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the daily totals of edits per hashtag and project, and per "
+        "hashtag and user, and the daily sketches of each hashtag's users, "
+        "pages and revisions, from the logged edits. Those for days before "
+        "--until are replaced; the collector keeps later ones up to date."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--until",
+            type=lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+            default=datetime.now(timezone.utc).date(),
+            help="Rebuild the totals for days before this one (YYYY-MM-DD, UTC). "
+            "Defaults to today.",
+        )
+
+    def handle(self, *args, **options):
+        # Compare the indexed timestamps with the start of the day, rather
+        # than the dates of each timestamp, which can't use the index.
+        until = datetime.combine(options["until"], time(), tzinfo=timezone.utc)
+        tag_ids = list(Tag.objects.order_by("id").values_list("id", flat=True))
+        built = 0
+        for count, tag_id in enumerate(tag_ids, 1):
+            # Each hashtag gets its own transaction, so the collector, which
+            # adds to the same totals, is only held up for one at a time.
+            with transaction.atomic():
+                built += build_totals(DailyDomainEdits, "domain", tag_id, until)
+                built += build_totals(DailyUserEdits, "username", tag_id, until)
+                built += build_sketches(tag_id, until)
+                # Cached charts for this hashtag are now out of date.
+                Tag.objects.filter(id=tag_id).update(watermark=F("watermark") + 1)
+            if count % REPORT_EVERY == 0 or count == len(tag_ids):
+                self.stdout.write(
+                    "Built {built} daily totals, up to tag id {id}".format(
+                        built=built, id=tag_id
+                    )
+                )
+        self.stdout.write(self.style.SUCCESS("Done"))
+
+
+def build_totals(model, field, tag_id, until):
+    """
+    Replace the daily totals in model for a tag before until, a UTC datetime
+    at the start of a day, with ones counted from its EditTags. Returns the
+    number of totals built.
+    """
+    model.objects.filter(tag_id=tag_id, day__lt=until.date()).delete()
+    totals = (
+        EditTag.objects.filter(tag_id=tag_id, timestamp__lt=until)
+        .annotate(day=TruncDate("timestamp", tzinfo=timezone.utc))
+        .values_list("day", "edit__" + field)
+        .annotate(edits=Count("id"))
+        .order_by()
+    )
+    rows = [
+        model(tag_id=tag_id, day=day, edits=edits, **{field: value})
+        for day, value, edits in totals
+    ]
+    model.objects.bulk_create(rows)
+    return len(rows)
+
+
+def build_sketches(tag_id, until):
+    """
+    Replace the daily sketches for a tag before until, a UTC datetime at the
+    start of a day, with ones built from its EditTags. Returns the number of
+    sketches built.
+    """
+    DailySketch.objects.filter(tag_id=tag_id, day__lt=until.date()).delete()
+    # Read the tag's edits a batch at a time, newest first, to use its
+    # (tag, timestamp) index.
+    links = (
+        EditTag.objects.filter(tag_id=tag_id, timestamp__lt=until)
+        .order_by("-timestamp", "-id")
+        .values_list(
+            "id",
+            "timestamp",
+            "edit__username",
+            "edit__domain",
+            "edit__page_title",
+            "edit__rev_id",
+            named=True,
+        )
+    )
+    sketches = {}
+    batch = list(links[:SKETCH_BATCH_SIZE])
+    while batch:
+        for link in batch:
+            day = link.timestamp.astimezone(timezone.utc).date()
+            if day not in sketches:
+                sketches[day] = [HyperLogLog(), HyperLogLog(), HyperLogLog()]
+            add_edit(
+                sketches[day],
+                link.edit__username,
+                link.edit__domain,
+                link.edit__page_title,
+                link.edit__rev_id,
+            )
+        if len(batch) < SKETCH_BATCH_SIZE:
+            break
+        last = batch[-1]
+        batch = list(rows_after(links, last.timestamp, last.id)[:SKETCH_BATCH_SIZE])
+
+    DailySketch.objects.bulk_create(
+        DailySketch(
+            tag_id=tag_id,
+            day=day,
+            users=users.to_bytes(),
+            pages=pages.to_bytes(),
+            revisions=revisions.to_bytes(),
+        )
+        for day, (users, pages, revisions) in sketches.items()
+    )
+    return len(sketches)
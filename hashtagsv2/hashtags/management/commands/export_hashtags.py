@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from hashtagsv2.hashtags.exports import (
+    COLUMNAR_FORMATS,
+    EXPORT_BATCH_SIZE,
+    columnar_chunks,
+)
+from hashtagsv2.hashtags.helpers import hashtag_queryset, split_hashtags
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the edits found by a search to a compressed Parquet file or "
+        "Arrow stream, a batch of edits at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("query", help="Hashtags to search for, comma separated.")
+        parser.add_argument("output", help="File to write.")
+        parser.add_argument(
+            "--format", choices=sorted(COLUMNAR_FORMATS), default="parquet"
+        )
+        parser.add_argument(
+            "--search-type",
+            choices=["or", "and"],
+            default="or",
+            help="Find edits with any of the hashtags, or with all of them.",
+        )
+        parser.add_argument("--project", help="Only edits to this project.")
+        parser.add_argument("--user", help="Only edits by this user.")
+        parser.add_argument("--startdate", help="Only edits after this date.")
+        parser.add_argument("--enddate", help="Only edits up to this date.")
+        parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        request_dict = {
+            "query": options["query"],
+            "search_type": options["search_type"],
+        }
+        for parameter in ("project", "user", "startdate", "enddate"):
+            if options[parameter]:
+                request_dict[parameter] = options[parameter]
+
+        hashtags = hashtag_queryset(request_dict)
+        with open(options["output"], "wb") as output:
+            for chunk in columnar_chunks(
+                hashtags,
+                split_hashtags(options["query"]),
+                options["format"],
+                options["batch_size"],
+            ):
+                output.write(chunk)
+        self.stdout.write(
+            self.style.SUCCESS("Wrote {output}".format(output=options["output"]))
+        )
@@ -0,0 +1,291 @@
+from datetime import date, datetime, timezone
+import gzip
+import os
+import shutil
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
+
+from hashtagsv2.hashtags.models import (
+    DailyDomainEdits,
+    DailySketch,
+    DailyUserEdits,
+    EditTag,
+    Tag,
+)
+
+# The links and the edits they link to, which are partitioned alike, so that
+# a month of both can be archived together.
+LINKS_TABLE = "hashtags_edittag"
+TABLES = (LINKS_TABLE, "hashtags_edit")
+
+# The daily totals and sketches, which are archived along with the edits they
+# count, so that statistics and charts agree with the search results.
+DAILY_MODELS = (DailyDomainEdits, DailyUserEdits, DailySketch)
+
+# The partition after the last month, which should always be empty.
+FUTURE_PARTITION = "pfuture"
+
+# How many months we keep partitions ready for.
+MONTHS_AHEAD = 3
+
+# Where archived months are written. Not in /app/backup, where recovery.py
+# deletes the daily backups after 14 days: an archive is the only copy of its
+# month, so it's kept until someone removes it.
+ARCHIVE_DIR = "/app/archive"
+
+PARTITIONS_QUERY = """
+    SELECT PARTITION_NAME
+    FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION
+    """
+
+
+class Command(BaseCommand):
+    help = (
+        "Partition hashtags_edittag and hashtags_edit by month of timestamp "
+        "(MySQL only), so that inserts and date-bounded searches only touch "
+        "the months they need. Run regularly to add partitions for the coming "
+        "months, and with --archive-after to move old months to compressed "
+        "dumps."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--create",
+            action="store_true",
+            help="Partition the tables if they aren't already. This rebuilds "
+            "them, which blocks the collector until it's done.",
+        )
+        parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+        parser.add_argument(
+            "--archive-after",
+            type=int,
+            metavar="MONTHS",
+            help="Dump the edits, links and daily totals from months before "
+            "this many full months ago to gzipped SQL files, and remove them.",
+        )
+        parser.add_argument(
+            "--archive-dir",
+            default=ARCHIVE_DIR,
+            help="Where to write the archived months. They're the only copy "
+            "of those months and are never deleted automatically, so keep "
+            "them out of the backup directory, whose files are deleted after "
+            "14 days.",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "mysql":
+            raise CommandError("Partitioning needs MySQL or MariaDB.")
+
+        this_month = datetime.now(timezone.utc).date().replace(day=1)
+        last_month = add_months(this_month, options["months_ahead"])
+
+        for table in TABLES:
+            partitions = existing_partitions(table)
+            if not partitions:
+                if not options["create"]:
+                    self.stdout.write(
+                        "{table} isn't partitioned. Run with --create to "
+                        "partition it.".format(table=table)
+                    )
+                    continue
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT MIN(timestamp) FROM {}".format(table))
+                    oldest = cursor.fetchone()[0]
+                first_month = oldest.date().replace(day=1) if oldest else this_month
+                months = month_range(first_month, last_month)
+                self.stdout.write(
+                    "Partitioning {table} into {count} months".format(
+                        table=table, count=len(months)
+                    )
+                )
+                with connection.cursor() as cursor:
+                    cursor.execute(create_partitions_sql(table, months))
+            else:
+                # The last partition is the future one.
+                newest = partition_month(partitions[-2])
+                months = month_range(add_months(newest, 1), last_month)
+                if months:
+                    self.stdout.write(
+                        "Adding partitions to {table} up to {month}".format(
+                            table=table, month=partition_name(months[-1])
+                        )
+                    )
+                    with connection.cursor() as cursor:
+                        cursor.execute(add_partitions_sql(table, months))
+
+        if options["archive_after"] is not None:
+            partitions = {table: existing_partitions(table) for table in TABLES}
+            if not all(partitions.values()):
+                raise CommandError(
+                    "Both {} must be partitioned to archive them.".format(
+                        " and ".join(TABLES)
+                    )
+                )
+            cutoff = add_months(this_month, -options["archive_after"])
+            # The oldest partition also has any rows from before its month,
+            # so we archive them in order, everything before each one's end.
+            for name in partitions[LINKS_TABLE][:-1]:
+                month = partition_month(name)
+                if month >= cutoff:
+                    break
+                path = archive_month(name, month, options["archive_dir"])
+                self.stdout.write(
+                    "Archived {name} to {path}".format(name=name, path=path)
+                )
+
+        self.stdout.write(self.style.SUCCESS("Done"))
+
+
+def add_months(month, months):
+    """
+    The first day of the month the given number of months after the month of
+    the given date.
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_range(first, last):
+    """
+    The first days of the months from first to last, inclusive.
+    """
+    months = []
+    while first <= last:
+        months.append(first)
+        first = add_months(first, 1)
+    return months
+
+
+def partition_name(month):
+    return month.strftime("p%Y%m")
+
+
+def partition_month(name):
+    return datetime.strptime(name, "p%Y%m").date()
+
+
+def partition_definitions(months):
+    """
+    A partition for the rows from each month, and an empty one for any later
+    ones.
+    """
+    definitions = [
+        "PARTITION {name} VALUES LESS THAN ('{end}')".format(
+            name=partition_name(month), end=add_months(month, 1)
+        )
+        for month in months
+    ]
+    definitions.append(
+        "PARTITION {name} VALUES LESS THAN (MAXVALUE)".format(name=FUTURE_PARTITION)
+    )
+    return ",\n".join(definitions)
+
+
+def create_partitions_sql(table, months):
+    # The primary key has to include the timestamp too.
+    return """
+        ALTER TABLE {table}
+        DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)
+        PARTITION BY RANGE COLUMNS (timestamp) (
+        {definitions}
+        )
+        """.format(table=table, definitions=partition_definitions(months))
+
+
+def add_partitions_sql(table, months):
+    # Splitting the empty future partition doesn't need to move any rows.
+    return """
+        ALTER TABLE {table} REORGANIZE PARTITION {future} INTO (
+        {definitions}
+        )
+        """.format(
+        table=table,
+        future=FUTURE_PARTITION,
+        definitions=partition_definitions(months),
+    )
+
+
+def existing_partitions(table):
+    """
+    The names of a table's partitions, oldest first, or an empty list if it
+    isn't partitioned.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(PARTITIONS_QUERY, [table])
+        return [name for (name,) in cursor.fetchall()]
+
+
+def dump(archive, tables, where):
+    """
+    Append the rows of the given tables matching a WHERE clause to an open
+    archive, as SQL.
+    """
+    database = settings.DATABASES["default"]
+    # The password goes in the environment rather than the arguments, which
+    # anyone on the machine can see.
+    env = dict(os.environ, MYSQL_PWD=database["PASSWORD"])
+    process = subprocess.Popen(
+        [
+            "mysqldump",
+            "--no-create-info",
+            "--skip-comments",
+            "--single-transaction",
+            "--where=" + where,
+            "-h",
+            database["HOST"],
+            "-u",
+            database["USER"],
+            database["NAME"],
+        ]
+        + list(tables),
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+    shutil.copyfileobj(process.stdout, archive)
+    return process.wait() == 0
+
+
+def archive_month(name, month, archive_dir):
+    """
+    Dump a month's edits, their links and the daily totals and sketches
+    counting them to a read-only gzipped SQL file, which recovery.py
+    --restore can load back in, then remove them. Returns the file's path.
+    """
+    end = add_months(month, 1)
+    path = os.path.join(archive_dir, "hashtags.{name}.sql.gz".format(name=name))
+    with gzip.open(path, "wb") as archive:
+        dumped = dump(archive, TABLES, "timestamp < '{end}'".format(end=end)) and dump(
+            archive,
+            [model._meta.db_table for model in DAILY_MODELS],
+            "day < '{end}'".format(end=end),
+        )
+    if not dumped:
+        os.remove(path)
+        raise CommandError("Couldn't dump {name}".format(name=name))
+    os.chmod(path, 0o440)
+
+    tag_ids = list(
+        EditTag.objects.filter(timestamp__lt=end)
+        .values_list("tag_id", flat=True)
+        .distinct()
+    )
+    with transaction.atomic():
+        for model in DAILY_MODELS:
+            model.objects.filter(day__lt=end).delete()
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(
+                "ALTER TABLE {table} DROP PARTITION {name}".format(
+                    table=table, name=name
+                )
+            )
+    # Cached searches for these hashtags may include the archived edits.
+    Tag.objects.filter(id__in=tag_ids).update(watermark=F("watermark") + 1)
+    return path
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from hashtagsv2.hashtags.helpers import refresh_leaderboard
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the hashtags used most in the last 30 days, and find the latest "
+        "logged edit, for the home page. Run by cron every few minutes."
+    )
+
+    def handle(self, *args, **options):
+        leaderboard = refresh_leaderboard()
+        self.stdout.write(
+            "Top hashtags: {tags}. Latest edit: {latest}.".format(
+                tags=", ".join(leaderboard.top_tags) or "none",
+                latest=leaderboard.latest_edit,
+            )
+        )
@@ -0,0 +1,49 @@
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_hashtags(apps, schema_editor):
+    # The collector used to check for an existing (hashtag, rc_id) row before
+    # inserting, but two collectors replaying the same part of the stream
+    # could both log it. Keep the first copy of each. Each wiki has its own
+    # rc_ids, so rows from different wikis are never duplicates.
+    Hashtag = apps.get_model("hashtags", "Hashtag")
+    duplicates = (
+        Hashtag.objects.values("hashtag", "domain", "rc_id")
+        .annotate(first_id=Min("id"), copies=Count("id"))
+        .filter(copies__gt=1)
+        .order_by()
+    )
+    for duplicate in list(duplicates):
+        Hashtag.objects.filter(
+            hashtag=duplicate["hashtag"],
+            domain=duplicate["domain"],
+            rc_id=duplicate["rc_id"],
+        ).exclude(id=duplicate["first_id"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0011_auto_20240404_1641"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_hashtags, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="hashtag",
+            constraint=models.UniqueConstraint(
+                fields=("hashtag", "domain", "rc_id"),
+                name="unique_hashtag_domain_rc_id",
+            ),
+        ),
+        migrations.AlterIndexTogether(
+            name="hashtag",
+            index_together={
+                ("hashtag", "domain", "page_title"),
+                ("hashtag", "username"),
+                ("hashtag", "timestamp"),
+                ("hashtag", "rev_id"),
+            },
+        ),
+    ]
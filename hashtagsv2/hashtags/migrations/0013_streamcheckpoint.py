@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0012_hashtag_unique_hashtag_rc_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StreamCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("stream", models.CharField(max_length=64, unique=True)),
+                ("last_event_id", models.TextField()),
+                ("updated", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0013_streamcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Edit",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("domain", models.CharField(max_length=32)),
+                ("timestamp", models.DateTimeField(db_index=True)),
+                ("username", models.CharField(db_index=True, max_length=255)),
+                ("page_title", models.CharField(max_length=500)),
+                ("edit_summary", models.CharField(max_length=800)),
+                ("rc_id", models.PositiveIntegerField()),
+                ("rev_id", models.PositiveIntegerField(null=True)),
+                ("has_image", models.BooleanField(default=False)),
+                ("has_video", models.BooleanField(default=False)),
+                ("has_audio", models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Tag",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=128, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="EditTag",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("timestamp", models.DateTimeField()),
+                (
+                    "edit",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="hashtags.edit"
+                    ),
+                ),
+                (
+                    "tag",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="hashtags.tag"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="edit",
+            constraint=models.UniqueConstraint(
+                fields=("domain", "rc_id"), name="unique_edit_domain_rc_id"
+            ),
+        ),
+        migrations.AlterIndexTogether(
+            name="edit",
+            index_together={("domain", "page_title")},
+        ),
+        migrations.AddConstraint(
+            model_name="edittag",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "edit"), name="unique_tag_edit"
+            ),
+        ),
+        migrations.AlterIndexTogether(
+            name="edittag",
+            index_together={("tag", "timestamp"), ("timestamp", "tag")},
+        ),
+    ]
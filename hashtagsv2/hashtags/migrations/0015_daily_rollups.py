@@ -0,0 +1,72 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0014_edit_tag_edittag"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyUserEdits",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("username", models.CharField(max_length=255)),
+                ("edits", models.PositiveIntegerField()),
+                (
+                    "tag",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="hashtags.tag"
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="DailyDomainEdits",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("domain", models.CharField(max_length=32)),
+                ("edits", models.PositiveIntegerField()),
+                (
+                    "tag",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="hashtags.tag"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="dailyuseredits",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "day", "username"), name="unique_tag_day_username"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="dailydomainedits",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "day", "domain"), name="unique_tag_day_domain"
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0015_daily_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tag",
+            name="watermark",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0016_tag_watermark"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Leaderboard",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("top_tags", models.JSONField(default=list)),
+                ("latest_edit", models.DateTimeField(null=True)),
+                ("refreshed", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0017_leaderboard"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailySketch",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("users", models.BinaryField()),
+                ("pages", models.BinaryField()),
+                ("revisions", models.BinaryField()),
+                (
+                    "tag",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="hashtags.tag"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="dailysketch",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "day"), name="unique_tag_day"
+            ),
+        ),
+    ]
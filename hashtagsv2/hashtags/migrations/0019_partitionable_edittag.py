@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0018_daily_sketches"),
+    ]
+
+    # Foreign keys go first, as MySQL won't drop the index they use, and the
+    # new unique key is added before the old one is dropped so that links are
+    # never duplicated in between.
+    operations = [
+        migrations.AlterField(
+            model_name="edittag",
+            name="edit",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="hashtags.edit",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="edittag",
+            name="tag",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="hashtags.tag",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="edittag",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "edit", "timestamp"), name="unique_tag_edit_timestamp"
+            ),
+        ),
+        migrations.RemoveConstraint(
+            model_name="edittag",
+            name="unique_tag_edit",
+        ),
+    ]
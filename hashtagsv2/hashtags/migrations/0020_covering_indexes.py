@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0019_partitionable_edittag"),
+    ]
+
+    # The index on username alone is only dropped once (username, timestamp)
+    # is there to replace it.
+    operations = [
+        migrations.AlterIndexTogether(
+            name="edit",
+            index_together={
+                ("username", "timestamp"),
+                ("domain", "page_title"),
+                ("domain", "timestamp"),
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name="edittag",
+            index_together={("tag", "timestamp", "edit"), ("timestamp", "tag")},
+        ),
+        migrations.AlterField(
+            model_name="edit",
+            name="username",
+            field=models.CharField(max_length=255),
+        ),
+    ]
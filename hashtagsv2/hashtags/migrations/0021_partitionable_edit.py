@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hashtags", "0020_covering_indexes"),
+    ]
+
+    # The new unique key is added before the old one is dropped, so that
+    # edits are never duplicated in between.
+    operations = [
+        migrations.AddConstraint(
+            model_name="edit",
+            constraint=models.UniqueConstraint(
+                fields=("domain", "rc_id", "timestamp"),
+                name="unique_edit_domain_rc_id_timestamp",
+            ),
+        ),
+        migrations.RemoveConstraint(
+            model_name="edit",
+            name="unique_edit_domain_rc_id",
+        ),
+    ]
@@ -6,6 +6,10 @@ class Hashtag(models.Model):
     Hashtags model, based on the db schema for the original hashtags tool.
     We should always be gathering every piece of the model - edit summary
     is optional, but we shouldn't be logging anything with no summary.
+
+    This stored a copy of the edit for every hashtag it logged. The collector
+    now writes to Tag, Edit and EditTag instead, and the backfill_edits
+    command copies the rows logged here over to them.
     """
 
     hashtag = models.CharField(max_length=128, db_index=True)
@@ -57,11 +61,228 @@ class Hashtag(models.Model):
         )[0]
 
     class Meta:
+        # A hashtag is only logged once per change. Each wiki has its own
+        # recentchanges table, so a change is identified by its domain and
+        # rc_id together.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["hashtag", "domain", "rc_id"],
+                name="unique_hashtag_domain_rc_id",
+            ),
+        ]
         # Indexes we need for computing statistics.
         index_together = [
             ("hashtag", "timestamp"),
-            ("hashtag", "rc_id"),
             ("hashtag", "rev_id"),
             ("hashtag", "domain", "page_title"),
             ("hashtag", "username"),
         ]
+
+
+class Tag(models.Model):
+    """
+    A hashtag we've logged at least one edit for.
+    """
+
+    name = models.CharField(max_length=128, unique=True)
+    # Advanced whenever edits are logged with the hashtag, so that cached
+    # search results for it are no longer used.
+    watermark = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+
+class Edit(models.Model):
+    """
+    A change logged with one or more hashtags. Edits are stored once, however
+    many hashtags they have, and linked to their hashtags by EditTag.
+
+    Like EditTag, this table can be partitioned by month of timestamp with the
+    partition_edittags command.
+    """
+
+    # Hashtags v1 only recorded language Wikipedia project. Recording
+    # the entire domain allows us to track edits to other projects too.
+    domain = models.CharField(max_length=32)
+
+    timestamp = models.DateTimeField(db_index=True)
+    username = models.CharField(max_length=255)
+    page_title = models.CharField(max_length=500)
+
+    # Per https://meta.wikimedia.org/wiki/Help:Edit_summary, summaries
+    # have a maximum possible length of 800 characters.
+    edit_summary = models.CharField(max_length=800)
+
+    # Recentchanges ID
+    # (https://www.mediawiki.org/wiki/Manual:Recentchanges_table)
+    rc_id = models.PositiveIntegerField()
+
+    # Revision ID (https://www.mediawiki.org/wiki/Manual:Revision_table)
+    rev_id = models.PositiveIntegerField(null=True)
+
+    # Whether this change introduces different media in the page.
+    has_image = models.BooleanField(default=False)
+    has_video = models.BooleanField(default=False)
+    has_audio = models.BooleanField(default=False)
+
+    class Meta:
+        # Each wiki has its own recentchanges table, so an rc_id only
+        # identifies a change together with its domain. A change always has
+        # the same timestamp, so including it, as a partitioned table's unique
+        # keys must, doesn't change which edits are unique.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["domain", "rc_id", "timestamp"],
+                name="unique_edit_domain_rc_id_timestamp",
+            ),
+        ]
+        # Indexes we need for computing statistics, and for searches by
+        # project or user, which are often for a range of dates too.
+        index_together = [
+            ("domain", "page_title"),
+            ("domain", "timestamp"),
+            ("username", "timestamp"),
+        ]
+
+
+class EditTag(models.Model):
+    """
+    Links an edit to one of its hashtags. The edit's timestamp is copied here
+    so that a hashtag's edits can be found in time order from this table's
+    index alone.
+
+    On MySQL the partition_edittags command can split this table into a
+    partition per month of timestamp. Partitioned tables can't have foreign
+    keys, and their unique keys must include the timestamp.
+    """
+
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, db_constraint=False)
+    edit = models.ForeignKey(Edit, on_delete=models.CASCADE, db_constraint=False)
+    timestamp = models.DateTimeField()
+
+    def get_values_list(self):
+        # Searches return a values_list of edits, so it can be useful to get
+        # the same for an individual object, such as when testing.
+        return Edit.objects.filter(pk=self.edit_id).values_list(
+            "id",
+            "domain",
+            "timestamp",
+            "username",
+            "page_title",
+            "edit_summary",
+            "rc_id",
+            "rev_id",
+            "has_image",
+            "has_video",
+            "has_audio",
+            named=True,
+        )[0]
+
+    class Meta:
+        # A hashtag is only logged once per change. The timestamp is always
+        # the edit's, so it doesn't change which links are unique.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["tag", "edit", "timestamp"], name="unique_tag_edit_timestamp"
+            ),
+        ]
+        # Searches find a hashtag's edits for a range of dates from the first
+        # index alone, without reading the links themselves.
+        index_together = [
+            ("tag", "timestamp", "edit"),
+            ("timestamp", "tag"),
+        ]
+
+
+class DailyDomainEdits(models.Model):
+    """
+    The number of edits made with a hashtag on each project each day (UTC).
+    The collector keeps this up to date as it logs edits, and the
+    build_rollups command builds it from EditTag for earlier days, so that
+    statistics don't have to count the edits every time.
+    """
+
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    day = models.DateField()
+    domain = models.CharField(max_length=32)
+    edits = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["tag", "day", "domain"], name="unique_tag_day_domain"
+            ),
+        ]
+
+
+class DailyUserEdits(models.Model):
+    """
+    The number of edits made with a hashtag by each user each day (UTC),
+    maintained in the same way as DailyDomainEdits.
+    """
+
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    day = models.DateField()
+    username = models.CharField(max_length=255)
+    edits = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["tag", "day", "username"], name="unique_tag_day_username"
+            ),
+        ]
+
+
+class DailySketch(models.Model):
+    """
+    HyperLogLog sketches (see scripts/hll.py) of the users, pages and
+    revisions with a hashtag each day (UTC). Merging a search's days
+    estimates how many distinct ones it has without counting its edits,
+    which is much quicker for the biggest hashtags. Maintained in the same way
+    as DailyDomainEdits.
+    """
+
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    day = models.DateField()
+    users = models.BinaryField()
+    pages = models.BinaryField()
+    revisions = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["tag", "day"], name="unique_tag_day"),
+        ]
+
+
+class Leaderboard(models.Model):
+    """
+    What the home page shows for every visitor: the hashtags used most over
+    the last 30 days, and when the latest edit we've logged was made. There's
+    a single row, which cron rewrites every few minutes with the
+    refresh_leaderboard command.
+    """
+
+    # Hashtag names, most used first.
+    top_tags = models.JSONField(default=list)
+    latest_edit = models.DateTimeField(null=True)
+    refreshed = models.DateTimeField()
+
+
+class StreamCheckpoint(models.Model):
+    """
+    The ID of the last EventStream event the hashtag collector has processed,
+    written along with the hashtags it logged. When the collector restarts
+    it resumes the stream from this event rather than replaying everything
+    since the latest hashtag.
+    """
+
+    # The EventStreams stream name, e.g. "recentchange".
+    stream = models.CharField(max_length=64, unique=True)
+
+    # EventStreams event IDs are JSON lists of Kafka topic offsets, which we
+    # send back as-is in the Last-Event-ID header.
+    last_event_id = models.TextField()
+
+    updated = models.DateTimeField()
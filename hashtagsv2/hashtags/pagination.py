@@ -0,0 +1,158 @@
+from datetime import datetime, timezone
+
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .helpers import cached_search
+
+# Cursors point at the first or last row of a page by its timestamp and id,
+# e.g. "next_20240404164100000000_1234" for the page after that row.
+CURSOR_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+class CachedCountPaginator(Paginator):
+    """
+    A Paginator that gets its count, and its first page, from the cache,
+    shared by every page of the same search, instead of running COUNT(*) for
+    each page. cache_prefix tells apart the lists we paginate for a search.
+    """
+
+    def __init__(
+        self, object_list, per_page, request_dict, cache_prefix="results", **kwargs
+    ):
+        super().__init__(object_list, per_page, **kwargs)
+        self.request_dict = request_dict
+        self.cache_prefix = cache_prefix
+
+    @cached_property
+    def count(self):
+        return cached_search(
+            self.cache_prefix + "_count",
+            self.request_dict,
+            lambda: self.object_list.order_by().count(),
+        )
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if number != 1:
+            return super().page(number)
+        # Most people only look at the first page of a search.
+        object_list = cached_search(
+            "{prefix}_first_page:{per_page}".format(
+                prefix=self.cache_prefix, per_page=self.per_page
+            ),
+            self.request_dict,
+            lambda: list(self.object_list[: self.per_page]),
+        )
+        return self._get_page(object_list, number, self)
+
+
+def rows_after(queryset, timestamp, id_):
+    """
+    The rows of a queryset ordered by -timestamp, -id that come after the row
+    with the given timestamp and id.
+    """
+    return queryset.filter(
+        Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id_)
+    )
+
+
+def rows_before(queryset, timestamp, id_):
+    """
+    The rows of a queryset ordered by -timestamp, -id that come before the row
+    with the given timestamp and id.
+    """
+    return queryset.filter(
+        Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id_)
+    )
+
+
+def make_cursor(direction, row):
+    return "{direction}_{timestamp}_{id}".format(
+        direction=direction,
+        timestamp=row.timestamp.astimezone(timezone.utc).strftime(
+            CURSOR_TIMESTAMP_FORMAT
+        ),
+        id=row.id,
+    )
+
+
+def parse_cursor(cursor):
+    """
+    Return the direction, timestamp and id of a cursor, or None for the first
+    page (or a cursor we don't understand).
+    """
+    try:
+        direction, timestamp, id_ = cursor.split("_")
+        if direction not in ("next", "prev"):
+            return None
+        timestamp = datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT)
+        return direction, timestamp.replace(tzinfo=timezone.utc), int(id_)
+    except ValueError:
+        return None
+
+
+class CursorPage:
+    """
+    A page of search results found by keyset pagination: rather than counting
+    its way past the rows on earlier pages with OFFSET, the query starts
+    straight after the (timestamp, id) of the row the cursor points at. Deep
+    pages are then as quick as the first one.
+
+    Rows must be ordered by -timestamp, -id and have both fields. Given the
+    search's request_dict, the first page is cached.
+    """
+
+    def __init__(self, queryset, per_page, cursor, count, request_dict=None):
+        self.paginator = CursorPaginator(count)
+        position = parse_cursor(cursor)
+
+        if position is None:
+            if request_dict is None:
+                rows = list(queryset[: per_page + 1])
+            else:
+                rows = cached_search(
+                    "results_first_page:cursor:{}".format(per_page),
+                    request_dict,
+                    lambda: list(queryset[: per_page + 1]),
+                )
+            self.has_previous = False
+            self.has_next = len(rows) > per_page
+            rows = rows[:per_page]
+        else:
+            direction, timestamp, id_ = position
+            if direction == "next":
+                rows = list(rows_after(queryset, timestamp, id_)[: per_page + 1])
+                self.has_previous = True
+                self.has_next = len(rows) > per_page
+                rows = rows[:per_page]
+            else:
+                # Read backwards from the cursor, then put the rows back in
+                # order.
+                rows = list(
+                    rows_before(queryset, timestamp, id_).reverse()[: per_page + 1]
+                )
+                self.has_previous = len(rows) > per_page
+                self.has_next = True
+                rows = rows[:per_page][::-1]
+
+        self.object_list = rows
+        self.next_cursor = make_cursor("next", rows[-1]) if rows else None
+        self.previous_cursor = make_cursor("prev", rows[0]) if rows else None
+
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class CursorPaginator:
+    """
+    Stands in for the Paginator of a CursorPage, which only knows how many
+    results there are.
+    """
+
+    def __init__(self, count):
+        self.count = count
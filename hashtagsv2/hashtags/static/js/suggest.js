@@ -0,0 +1,35 @@
+// Suggest hashtags for the last one typed into the search box. Each
+// suggestion is the whole query with that hashtag completed, since picking
+// one from the list replaces everything in the box.
+(function(){
+    var url = document.currentScript.getAttribute("data-url");
+    var list = document.getElementById("hashtag-suggestions");
+    var input = document.getElementById("id_query");
+    if(!input){
+        return;
+    }
+    var request = null;
+    input.addEventListener("input", function(){
+        var terms = input.value.split(",");
+        var prefix = terms.pop().trim().replace(/^#/, "");
+        if(request){
+            request.abort();
+        }
+        if(!prefix){
+            list.innerHTML = "";
+            return;
+        }
+        request = new XMLHttpRequest();
+        request.open("GET", url + "?query=" + encodeURIComponent(prefix));
+        request.onload = function(){
+            var start = terms.length ? terms.join(",") + ", " : "";
+            list.innerHTML = "";
+            JSON.parse(this.responseText).hashtags.forEach(function(suggestion){
+                var option = document.createElement("option");
+                option.value = start + suggestion.hashtag;
+                list.appendChild(option);
+            });
+        };
+        request.send();
+    });
+})();
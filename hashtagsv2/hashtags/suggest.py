@@ -0,0 +1,87 @@
+"""
+Suggests hashtags for the search box as it's typed into. Each worker keeps
+the hashtags used recently, and how much, in memory, sorted by name, so a
+suggestion is a binary search away and never queries the database.
+"""
+
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+import heapq
+import threading
+import time
+
+from django.db.models import Sum
+
+from .models import DailyDomainEdits
+
+# Hashtags used within this many days are suggested, most used first.
+SUGGEST_DAYS = 90
+
+# How often each worker reloads the hashtags it suggests.
+SUGGEST_REFRESH_S = 5 * 60
+
+# The most hashtags we suggest at once.
+SUGGESTIONS = 10
+
+# Sorts after any character a hashtag can contain.
+LAST_CHARACTER = chr(0x10FFFF)
+
+
+class Suggestions:
+    """
+    Hashtags and their numbers of edits, in arrays sorted by lowercased name,
+    so the hashtags starting with a prefix are all next to each other.
+    """
+
+    def __init__(self, counts):
+        rows = sorted((name.lower(), name, edits) for name, edits in counts)
+        self.keys = [key for key, _, _ in rows]
+        self.names = [name for _, name, _ in rows]
+        self.edits = [edits for _, _, edits in rows]
+        self.loaded = time.monotonic()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def suggest(self, prefix, limit=SUGGESTIONS):
+        """
+        The most used hashtags starting with a prefix, whatever its case, as
+        (name, edits) pairs. Equally used hashtags are in alphabetical order.
+        """
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + LAST_CHARACTER, start)
+        best = heapq.nlargest(limit, range(start, end), key=self.edits.__getitem__)
+        return [(self.names[index], self.edits[index]) for index in best]
+
+
+def load_suggestions():
+    """
+    Count the edits with each hashtag used recently from the daily totals,
+    rather than from the edits themselves.
+    """
+    since = datetime.now(timezone.utc).date() - timedelta(days=SUGGEST_DAYS)
+    return Suggestions(
+        DailyDomainEdits.objects.filter(day__gt=since)
+        .values("tag__name")
+        .annotate(edits=Sum("edits"))
+        .values_list("tag__name", "edits")
+    )
+
+
+_suggestions = None
+_lock = threading.Lock()
+
+
+def get_suggestions():
+    """
+    This worker's suggestions, reloaded once they're SUGGEST_REFRESH_S old.
+    """
+    global _suggestions
+    with _lock:
+        if (
+            _suggestions is None
+            or time.monotonic() - _suggestions.loaded > SUGGEST_REFRESH_S
+        ):
+            _suggestions = load_suggestions()
+        return _suggestions
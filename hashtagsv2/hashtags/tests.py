@@ -1,14 +1,54 @@
-from datetime import datetime
-from mock import patch
+from collections import namedtuple
+from datetime import date, datetime, timedelta, timezone
+from importlib import import_module
+from io import BytesIO, StringIO
+import gzip
+import itertools
+import os
+import re
+import tempfile
+import tracemalloc
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from mock import MagicMock, Mock, patch
 from json import loads
 
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count
+from django.http import JsonResponse
 from django.urls import reverse
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
 
+from .exports import csv_chunks, iterate_rows, json_chunks, json_row
 from .factories import HashtagFactory
-from .models import Hashtag
-from .helpers import split_hashtags
-from . import views
+from .models import (
+    DailyDomainEdits,
+    DailySketch,
+    DailyUserEdits,
+    Edit,
+    EditTag,
+    Hashtag,
+    Leaderboard,
+    Tag,
+)
+from .helpers import (
+    cached_search,
+    edits_per,
+    get_hashtags_context,
+    hashtag_queryset,
+    query_cache_key,
+    rollup_queryset,
+    split_hashtags,
+    tag_ids,
+    truncated_prefixes,
+)
+from .management.commands import partition_edittags
+from .pagination import CachedCountPaginator
+from . import suggest, views
 
 
 class HomepageTest(TestCase):
@@ -33,6 +73,511 @@ class HomepageTest(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        self.recently = datetime.now(timezone.utc) - timedelta(minutes=10)
+        for rc_id, hashtag in enumerate(["popular", "popular", "quiet"]):
+            HashtagFactory(hashtag=hashtag, rc_id=rc_id, timestamp=self.recently)
+        HashtagFactory(
+            hashtag="forgotten",
+            rc_id=10,
+            timestamp=datetime.now(timezone.utc) - timedelta(days=60),
+        )
+
+    def test_refresh_leaderboard(self):
+        """
+        The leaderboard has the hashtags used most in the last 30 days, and
+        the time of the latest edit.
+        """
+        call_command("refresh_leaderboard", stdout=StringIO())
+
+        leaderboard = Leaderboard.objects.get()
+        self.assertEqual(leaderboard.top_tags, ["popular", "quiet"])
+        self.assertEqual(leaderboard.latest_edit, self.recently)
+
+    def test_homepage_uses_leaderboard(self):
+        """
+        The home page shows the leaderboard as last refreshed, without
+        counting hashtags itself.
+        """
+        call_command("refresh_leaderboard", stdout=StringIO())
+        HashtagFactory(hashtag="newcomer", rc_id=20, timestamp=self.recently)
+        request = RequestFactory().get(reverse("index"))
+
+        with self.assertNumQueries(1):
+            response = views.Index.as_view()(request)
+
+        self.assertEqual(response.context_data["top_tags"], ["popular", "quiet"])
+
+    def test_homepage_without_leaderboard(self):
+        """
+        If the leaderboard has never been refreshed, the home page does it.
+        """
+        request = RequestFactory().get(reverse("index"))
+        response = views.Index.as_view()(request)
+
+        self.assertEqual(response.context_data["top_tags"], ["popular", "quiet"])
+        self.assertEqual(Leaderboard.objects.count(), 1)
+
+
+class EditTagModelTest(TestCase):
+    def test_hashtag_unique_per_change(self):
+        """
+        A hashtag can only be logged once for each change, but the same
+        change can log several different hashtags.
+        """
+        HashtagFactory(hashtag="hashtag1", rc_id=1234)
+        HashtagFactory(hashtag="hashtag2", rc_id=1234)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            HashtagFactory(hashtag="hashtag1", rc_id=1234)
+
+        self.assertEqual(EditTag.objects.filter(edit__rc_id=1234).count(), 2)
+        self.assertEqual(Edit.objects.filter(rc_id=1234).count(), 1)
+
+
+class HashtagModelTest(TestCase):
+    def create(self, domain):
+        return Hashtag.objects.create(
+            hashtag="hashtag1",
+            domain=domain,
+            timestamp=datetime(2020, 1, 1, tzinfo=timezone.utc),
+            username="xyz",
+            page_title="test",
+            edit_summary="#hashtag1",
+            rc_id=1234,
+        )
+
+    def test_hashtag_unique_per_wiki_change(self):
+        """
+        Each wiki has its own rc_ids, so the same hashtag and rc_id can be
+        logged once on each of them, and the migration that removed
+        duplicates keeps both.
+        """
+        self.create("en.wikipedia.org")
+        self.create("fr.wikipedia.org")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.create("en.wikipedia.org")
+
+        migration = import_module(
+            "hashtagsv2.hashtags.migrations.0012_hashtag_unique_hashtag_rc_id"
+        )
+        migration.remove_duplicate_hashtags(apps, None)
+        self.assertEqual(Hashtag.objects.count(), 2)
+
+
+class BackfillEditsTest(TestCase):
+    def test_backfill_edits(self):
+        """
+        Hashtags logged in the old table are copied to the new ones, with one
+        edit per change, and copying them again changes nothing.
+        """
+        timestamp = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        for hashtag, domain, rc_id in [
+            ("hashtag1", "en.wikipedia.org", 1),
+            ("hashtag2", "en.wikipedia.org", 1),
+            ("hashtag3", "fr.wikipedia.org", 1),
+            ("hashtag1", "en.wikipedia.org", 2),
+        ]:
+            Hashtag.objects.create(
+                hashtag=hashtag,
+                domain=domain,
+                timestamp=timestamp,
+                username="xyz",
+                page_title="test",
+                edit_summary="#" + hashtag,
+                rc_id=rc_id,
+            )
+        # Already copied by an earlier run.
+        HashtagFactory(hashtag="hashtag1", rc_id=2, timestamp=timestamp)
+
+        for _ in range(2):
+            call_command("backfill_edits", batch_size=2, stdout=StringIO())
+
+        self.assertEqual(Edit.objects.count(), 3)
+        self.assertEqual(EditTag.objects.count(), 4)
+        self.assertEqual(
+            EditTag.objects.filter(
+                edit__domain="en.wikipedia.org", edit__rc_id=1
+            ).count(),
+            2,
+        )
+
+
+class DailyRollupTest(TestCase):
+    def setUp(self):
+        for rc_id, domain, username, day, has_image in [
+            (1, "en.wikipedia.org", "a", 1, True),
+            (2, "en.wikipedia.org", "b", 1, False),
+            (3, "fr.wikipedia.org", "a", 2, False),
+            (4, "en.wikipedia.org", "a", 3, False),
+        ]:
+            HashtagFactory(
+                hashtag="rollup",
+                rc_id=rc_id,
+                domain=domain,
+                username=username,
+                has_image=has_image,
+                timestamp=datetime(2020, 1, day, 12, tzinfo=timezone.utc),
+            )
+        HashtagFactory(
+            hashtag="other",
+            rc_id=1,
+            timestamp=datetime(2020, 1, 1, 12, tzinfo=timezone.utc),
+        )
+
+    def test_rollups_match_raw_counts(self):
+        """
+        Searches the daily totals can answer get the same counts from them as
+        from the edits themselves.
+        """
+        for request_dict in [
+            {"query": "rollup"},
+            {"query": "rollup", "project": "en.wikipedia.org"},
+            {"query": "rollup", "user": "a", "startdate": "2020-01-02"},
+            {"query": "rollup", "enddate": "2020-01-02"},
+        ]:
+            for field in ("domain", "username"):
+                with self.subTest(request_dict=request_dict, field=field):
+                    raw = hashtag_queryset(request_dict)
+                    expected = list(
+                        raw.values(field).annotate(edits=Count("id")).order_by(field)
+                    )
+                    self.assertEqual(
+                        list(edits_per(request_dict, field, field)), expected
+                    )
+
+    def test_falls_back_to_edits(self):
+        """
+        Searches the daily totals can't answer are counted from the edits.
+        """
+        self.assertIsNotNone(rollup_queryset({"query": "rollup"}, "domain"))
+        for request_dict, field in [
+            ({"query": "rollup", "image": "on"}, "domain"),
+            ({"query": "rollup, other"}, "domain"),
+            ({"query": "rollup", "user": "a"}, "domain"),
+            ({"query": "rollup", "project": "en.wikipedia.org"}, "username"),
+        ]:
+            with self.subTest(request_dict=request_dict):
+                self.assertIsNone(rollup_queryset(request_dict, field))
+
+        self.assertEqual(
+            list(edits_per({"query": "rollup", "image": "on"}, "domain", "-edits")),
+            [{"domain": "en.wikipedia.org", "edits": 1}],
+        )
+        self.assertEqual(
+            list(edits_per({"query": "rollup, other"}, "domain", "-edits")),
+            [
+                {"domain": "en.wikipedia.org", "edits": 3},
+                {"domain": "fr.wikipedia.org", "edits": 1},
+            ],
+        )
+
+    def test_build_rollups(self):
+        """
+        The daily totals can be rebuilt from the edits, leaving the days from
+        --until onwards to the collector.
+        """
+        expected = sorted(
+            DailyDomainEdits.objects.values_list("tag__name", "day", "domain", "edits")
+        )
+        DailyDomainEdits.objects.update(edits=100)
+        DailyUserEdits.objects.all().delete()
+
+        call_command("build_rollups", "--until", "2020-01-03", stdout=StringIO())
+
+        self.assertEqual(
+            sorted(
+                DailyDomainEdits.objects.values_list(
+                    "tag__name", "day", "domain", "edits"
+                )
+            ),
+            [total[:3] + (100,) if total[1].day == 3 else total for total in expected],
+        )
+        self.assertEqual(
+            sorted(
+                DailyUserEdits.objects.filter(tag__name="rollup").values_list(
+                    "day", "username", "edits"
+                )
+            ),
+            [
+                (datetime(2020, 1, 1).date(), "a", 1),
+                (datetime(2020, 1, 1).date(), "b", 1),
+                (datetime(2020, 1, 2).date(), "a", 1),
+            ],
+        )
+
+    def test_build_sketches(self):
+        """
+        The daily sketches rebuilt from the edits are the same as the ones
+        built as the edits were logged.
+        """
+        sketches = DailySketch.objects.order_by("tag__name", "day").values_list(
+            "tag__name", "day", "users", "pages", "revisions"
+        )
+        expected = [
+            sketch[:2] + tuple(bytes(data) for data in sketch[2:])
+            for sketch in sketches
+            if sketch[1].day < 3
+        ]
+        DailySketch.objects.all().delete()
+
+        call_command("build_rollups", "--until", "2020-01-03", stdout=StringIO())
+
+        self.assertEqual(
+            [
+                sketch[:2] + tuple(bytes(data) for data in sketch[2:])
+                for sketch in sketches.all()
+            ],
+            expected,
+        )
+
+
+class PartitionEditTagsTest(TestCase):
+    def test_needs_mysql(self):
+        with self.assertRaises(CommandError):
+            call_command("partition_edittags", stdout=StringIO())
+
+    def test_partition_sql(self):
+        """
+        Each month gets a partition, and later links go in an empty one that
+        new months are split off from.
+        """
+        months = partition_edittags.month_range(date(2020, 11, 1), date(2021, 1, 1))
+        self.assertEqual(
+            months, [date(2020, 11, 1), date(2020, 12, 1), date(2021, 1, 1)]
+        )
+
+        sql = partition_edittags.create_partitions_sql("hashtags_edit", months)
+        self.assertIn("ALTER TABLE hashtags_edit", sql)
+        self.assertIn("PARTITION BY RANGE COLUMNS (timestamp)", sql)
+        self.assertIn("PARTITION p202012 VALUES LESS THAN ('2021-01-01')", sql)
+        self.assertIn("PARTITION pfuture VALUES LESS THAN (MAXVALUE)", sql)
+
+        sql = partition_edittags.add_partitions_sql("hashtags_edittag", months[2:])
+        self.assertIn("REORGANIZE PARTITION pfuture INTO", sql)
+        self.assertIn("PARTITION p202101 VALUES LESS THAN ('2021-02-01')", sql)
+
+    def test_archive(self):
+        """
+        Archiving a month dumps its edits, their links and its daily totals
+        without putting the password on the command line, then removes them
+        and invalidates cached searches for its hashtags.
+        """
+        HashtagFactory(
+            hashtag="archived",
+            rc_id=1,
+            timestamp=datetime(2020, 1, 15, tzinfo=timezone.utc),
+        )
+        HashtagFactory(
+            hashtag="kept",
+            rc_id=2,
+            timestamp=datetime(2020, 3, 15, tzinfo=timezone.utc),
+        )
+        watermarks = dict(Tag.objects.values_list("name", "watermark"))
+
+        dumps = []
+
+        def mysqldump(args, stdout, env):
+            dumps.append((args, env))
+            process = Mock()
+            process.stdout = BytesIO(" ".join(args).encode() + b"\n")
+            process.wait.return_value = 0
+            return process
+
+        # Keep everything from February 2020 on.
+        now = datetime.now(timezone.utc)
+        months = now.year * 12 + now.month - (2020 * 12 + 2)
+        fake_connection = MagicMock(vendor="mysql")
+        cursor = fake_connection.cursor.return_value.__enter__.return_value
+        command = "hashtagsv2.hashtags.management.commands.partition_edittags"
+        with tempfile.TemporaryDirectory() as archive_dir, patch(
+            command + ".connection", fake_connection
+        ), patch(
+            command + ".existing_partitions",
+            return_value=["p202001", "p202002", "p202003", "pfuture"],
+        ), patch(
+            command + ".subprocess.Popen", side_effect=mysqldump
+        ):
+            call_command(
+                "partition_edittags",
+                archive_after=months,
+                archive_dir=archive_dir,
+                stdout=StringIO(),
+            )
+            path = os.path.join(archive_dir, "hashtags.p202001.sql.gz")
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o440)
+            with gzip.open(path) as archive:
+                contents = archive.read().decode()
+
+        self.assertIn("hashtags_edittag hashtags_edit", contents)
+        self.assertIn("--where=timestamp < '2020-02-01'", contents)
+        self.assertIn("hashtags_dailydomainedits", contents)
+        self.assertIn("--where=day < '2020-02-01'", contents)
+        for args, env in dumps:
+            self.assertFalse(any(arg.startswith("-p") for arg in args))
+            self.assertIn("MYSQL_PWD", env)
+
+        statements = [args[0] for args, _ in cursor.execute.call_args_list]
+        for table in ("hashtags_edittag", "hashtags_edit"):
+            self.assertIn(
+                "ALTER TABLE {} DROP PARTITION p202001".format(table), statements
+            )
+        self.assertNotIn("ALTER TABLE hashtags_edit DROP PARTITION p202002", statements)
+
+        for model in (DailyDomainEdits, DailyUserEdits, DailySketch):
+            self.assertEqual(
+                list(model.objects.values_list("tag__name", flat=True)), ["kept"]
+            )
+        self.assertEqual(
+            Tag.objects.get(name="archived").watermark, watermarks["archived"] + 1
+        )
+        self.assertEqual(Tag.objects.get(name="kept").watermark, watermarks["kept"])
+
+    def test_search_dates_filter_links(self):
+        """
+        Searches by date filter the links by timestamp as well as the edits,
+        so only the partitions for those dates are read.
+        """
+        Tag.objects.create(name="dated")
+        hashtags = hashtag_queryset(
+            {"query": "dated", "startdate": "2020-01-01", "enddate": "2020-01-31"}
+        )
+        subquery = str(hashtags.query).split("SELECT U0")[1]
+        self.assertIn('U0."timestamp" >', subquery)
+        self.assertIn('U0."timestamp" <', subquery)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        # Some edits at the same time, so batches have to be split by id.
+        for rc_id in range(1, 6):
+            HashtagFactory(
+                hashtag="export",
+                rc_id=rc_id,
+                timestamp=datetime(2020, 1, 1 + rc_id // 2, tzinfo=timezone.utc),
+            )
+
+    def test_iterate_rows_in_batches(self):
+        """
+        Rows are read a batch at a time, each batch starting after the last.
+        """
+        hashtags = hashtag_queryset({"query": "export"})
+        with self.assertNumQueries(3):
+            rows = list(iterate_rows(hashtags, batch_size=2))
+        self.assertEqual(rows, list(hashtags))
+
+    def test_csv_download_gzip(self):
+        """
+        The CSV download is streamed, and compressed for clients that accept
+        gzip.
+        """
+        request = RequestFactory().get(
+            reverse("csv_download"), {"query": "export"}, HTTP_ACCEPT_ENCODING="gzip"
+        )
+        response = views.csv_download(request)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        content = gzip.decompress(b"".join(response.streaming_content))
+        self.assertEqual(len(content.splitlines()), 6)
+
+    def test_json_download(self):
+        """
+        The streamed JSON download is the same as a JsonResponse of all the
+        rows, and the NDJSON one has the same rows one per line.
+        """
+        hashtags = hashtag_queryset({"query": "export"})
+        expected = JsonResponse(
+            {"Rows": [json_row(hashtag) for hashtag in hashtags]}
+        ).content
+
+        request = RequestFactory().get(reverse("json_download"), {"query": "export"})
+        response = views.json_download(request)
+        self.assertEqual(b"".join(response.streaming_content), expected)
+        self.assertEqual(
+            "".join(json_chunks((json_row(h) for h in hashtags), chunk_size=2)),
+            expected.decode(),
+        )
+
+        request = RequestFactory().get(
+            reverse("json_download"), {"query": "export", "format": "ndjson"}
+        )
+        response = views.json_download(request)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual([loads(line) for line in lines], loads(expected)["Rows"])
+
+    def test_parquet_download(self):
+        """
+        The downloads can be Parquet files, with typed timestamps and
+        dictionary encoded names.
+        """
+        HashtagFactory(
+            hashtag="other",
+            rc_id=5,
+            timestamp=datetime(2020, 1, 3, tzinfo=timezone.utc),
+        )
+        request = RequestFactory().get(
+            reverse("csv_download"), {"query": "export", "format": "parquet"}
+        )
+        response = views.csv_download(request)
+        self.assertEqual(response["Content-Type"], "application/vnd.apache.parquet")
+        table = pq.read_table(pa.BufferReader(b"".join(response.streaming_content)))
+
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(table.schema.field("timestamp").type.tz, "UTC")
+        self.assertTrue(pa.types.is_dictionary(table.schema.field("domain").type))
+        rows = table.to_pylist()
+        self.assertEqual(rows[0]["rc_id"], 5)
+        self.assertEqual(rows[0]["hashtags"], ["export"])
+        self.assertEqual(
+            rows[0]["timestamp"], datetime(2020, 1, 3, tzinfo=timezone.utc)
+        )
+
+    def test_export_hashtags_command(self):
+        """
+        The export command writes the same rows as an Arrow stream, a batch
+        at a time.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "export.arrows")
+            call_command(
+                "export_hashtags",
+                "export",
+                output,
+                format="arrow",
+                batch_size=2,
+                stdout=StringIO(),
+            )
+            with pa.OSFile(output) as source:
+                batches = list(pa.ipc.open_stream(source))
+
+        self.assertEqual([batch.num_rows for batch in batches], [2, 2, 1])
+        self.assertEqual(
+            [rc_id for batch in batches for rc_id in batch.column("rc_id").to_pylist()],
+            [5, 4, 3, 2, 1],
+        )
+
+    def test_csv_memory_ceiling(self):
+        """
+        Writing a CSV file needs no more memory than one chunk of it, however
+        many rows it has.
+        """
+        row = ["en.wikipedia.org", "2020-01-01 00:00:00", "a", "Page", "#x", 1]
+        rows = itertools.repeat(row, 1000000)
+        size = 0
+        tracemalloc.start()
+        try:
+            for chunk in csv_chunks(["Domain"], rows):
+                size += len(chunk)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # The whole file would be around 50 MB.
+        self.assertGreater(size, 50 * 1000 * 1000)
+        self.assertLess(peak, 4 * 1000 * 1000)
+
+
 class HashtagSearchTest(TestCase):
     @classmethod
     def setUp(cls):
@@ -229,7 +774,7 @@ class HashtagSearchTest(TestCase):
         request = factory.get(self.download_url, data)
         response = views.csv_download(request)
 
-        page_content = response.content
+        page_content = b"".join(response.streaming_content)
 
         # CSV should be presented successfully, and should contain
         # 6 lines - header plus 5 entries
@@ -251,7 +796,7 @@ class HashtagSearchTest(TestCase):
         request = factory.get(self.download_url, data)
         response = views.csv_download(request)
 
-        page_content = response.content
+        page_content = b"".join(response.streaming_content)
 
         # CSV should be presented successfully, and should contain
         # 2 lines - header plus 1 entry
@@ -269,7 +814,7 @@ class HashtagSearchTest(TestCase):
         response = views.json_download(request)
 
         # decode and transform response back to JSON
-        page_content = response.content.decode("utf-8")
+        page_content = b"".join(response.streaming_content).decode("utf-8")
         json_content = loads(page_content)
 
         # JSON should contain 5 rows. Not sure though if this test
@@ -293,7 +838,7 @@ class HashtagSearchTest(TestCase):
         response = views.json_download(request)
 
         # decode and transform response back to JSON
-        page_content = response.content.decode("utf-8")
+        page_content = b"".join(response.streaming_content).decode("utf-8")
         json_content = loads(page_content)
 
         # JSON should contain 1 row. Not sure though if this test
@@ -306,8 +851,8 @@ class HashtagSearchTest(TestCase):
         This shouldn't result in a homepage server error.
         """
 
-        # Clear the database of hashtag objects
-        Hashtag.objects.all().delete()
+        # Clear the database of edits and their hashtags
+        Edit.objects.all().delete()
 
         factory = RequestFactory()
 
@@ -373,6 +918,30 @@ class HashtagSearchTest(TestCase):
         # And it is the correct edit
         self.assertEqual(object_list[0].rc_id, 1234)
 
+    def test_and_search_needs_every_hashtag(self):
+        """
+        Test that 'and' searches only return edits with every one of the
+        hashtags.
+        """
+        HashtagFactory(hashtag="hashtag_and_1", rc_id=1234)
+        HashtagFactory(hashtag="hashtag_and_2", rc_id=1234)
+        HashtagFactory(hashtag="hashtag_and_3", rc_id=1234)
+        HashtagFactory(hashtag="hashtag_and_1", rc_id=1235)
+        HashtagFactory(hashtag="hashtag_and_2", rc_id=1235)
+        HashtagFactory(hashtag="hashtag_and_1", rc_id=1236)
+
+        factory = RequestFactory()
+
+        data = {
+            "query": "hashtag_and_1, hashtag_and_2, hashtag_and_1",
+            "search_type": "and",
+        }
+        request = factory.get(self.url, data)
+        response = views.Index.as_view()(request)
+        object_list = response.context_data["object_list"]
+
+        self.assertEqual(sorted(edit.rc_id for edit in object_list), [1234, 1235])
+
     def test_image_filter(self):
         """
         Test that we can filter by edits that introduce images.
@@ -432,3 +1001,550 @@ class HashtagSearchTest(TestCase):
         self.assertEqual(len(object_list), 1)
         # And it is the correct edit
         self.assertEqual(object_list[0].rc_id, 1234)
+
+
+class StatisticsBoxTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        for rc_id, domain, page_title, username, rev_id, day in [
+            (1, "en.wikipedia.org", "Page", "a", 10, 1),
+            (2, "en.wikipedia.org", "Page", "b", 11, 2),
+            (3, "fr.wikipedia.org", "Page", "a", 12, 3),
+            (4, "fr.wikipedia.org", "Other", "a", None, 5),
+        ]:
+            HashtagFactory(
+                hashtag="stats",
+                rc_id=rc_id,
+                domain=domain,
+                page_title=page_title,
+                username=username,
+                rev_id=rev_id,
+                timestamp=datetime(2020, 1, day, tzinfo=timezone.utc),
+            )
+
+    def test_statistics(self):
+        """
+        The statistics box is counted in one query, once the daily totals show
+        the search is small enough, and then cached for the same search,
+        whichever page of it we're on. Finding it in the cache only needs the
+        hashtag's watermark.
+        """
+        request = RequestFactory().get("/", {"query": "stats"})
+        hashtags = hashtag_queryset(request.GET.dict())
+        with self.assertNumQueries(3):
+            context = get_hashtags_context(request, hashtags, {})
+
+        self.assertEqual(context["oldest"], datetime(2020, 1, 1).date())
+        self.assertEqual(context["newest"], datetime(2020, 1, 5).date())
+        self.assertEqual(context["revisions"], 3)
+        self.assertEqual(context["projects"], 2)
+        self.assertEqual(context["pages"], 3)
+        self.assertEqual(context["users"], 2)
+
+        request = RequestFactory().get("/", {"page": "2", "query": "stats"})
+        with self.assertNumQueries(1):
+            self.assertEqual(get_hashtags_context(request, hashtags, {})["pages"], 3)
+
+    @override_settings(APPROXIMATE_STATISTICS_EDITS=3)
+    def test_approximate_statistics(self):
+        """
+        Searches with more edits than APPROXIMATE_STATISTICS_EDITS estimate
+        the statistics from the daily totals and sketches, unless they ask
+        for exact ones.
+        """
+        request = RequestFactory().get("/", {"query": "stats"})
+        hashtags = hashtag_queryset(request.GET.dict())
+        with self.assertNumQueries(3):
+            context = get_hashtags_context(request, hashtags, {})
+
+        self.assertTrue(context["approximate"])
+        self.assertEqual(context["oldest"], datetime(2020, 1, 1).date())
+        self.assertEqual(context["newest"], datetime(2020, 1, 5).date())
+        # Small sets are estimated exactly.
+        self.assertEqual(context["revisions"], 3)
+        self.assertEqual(context["projects"], 2)
+        self.assertEqual(context["pages"], 3)
+        self.assertEqual(context["users"], 2)
+
+        request = RequestFactory().get("/", {"query": "stats", "exact": "1"})
+        context = get_hashtags_context(request, hashtags, {})
+        self.assertNotIn("approximate", context)
+        self.assertEqual(context["pages"], 3)
+
+    @override_settings(APPROXIMATE_STATISTICS=True)
+    def test_sketches_need_whole_hashtags(self):
+        """
+        Searches filtering by project, user or media are always counted.
+        """
+        request = RequestFactory().get("/", {"query": "stats", "user": "a"})
+        hashtags = hashtag_queryset(request.GET.dict())
+        context = get_hashtags_context(request, hashtags, {})
+
+        self.assertNotIn("approximate", context)
+        self.assertEqual(context["users"], 1)
+
+
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        for rc_id in range(1, 4):
+            HashtagFactory(hashtag="cached", rc_id=rc_id)
+
+    def test_same_search_same_key(self):
+        """
+        Searches written differently share cached results if they'd find the
+        same edits.
+        """
+        key = query_cache_key(
+            "results",
+            {"query": "cached, other", "project": "en.wikipedia.org", "image": "on"},
+        )
+        for request_dict in [
+            {
+                "query": "#OTHER,cached",
+                "project": "EN.wikipedia.org",
+                "image": "true",
+                "search_type": "or",
+                "page": "2",
+                "startdate": "",
+            },
+            {
+                "query": "other, cached, Other",
+                "project": "en.wikipedia.org ",
+                "image": "1",
+            },
+        ]:
+            with self.subTest(request_dict=request_dict):
+                self.assertEqual(query_cache_key("results", request_dict), key)
+
+        for request_dict in [
+            {"query": "cached, other", "project": "en.wikipedia.org"},
+            {"query": "cached", "project": "en.wikipedia.org", "image": "on"},
+            {
+                "query": "cached, other",
+                "project": "en.wikipedia.org",
+                "image": "on",
+                "search_type": "and",
+            },
+        ]:
+            with self.subTest(request_dict=request_dict):
+                self.assertNotEqual(query_cache_key("results", request_dict), key)
+
+    def test_tag_ids_cached(self):
+        """
+        A hashtag's id is only looked up once, whatever case it's written in,
+        and hashtags we don't have are left out.
+        """
+        tag_id = Tag.objects.get(name="cached").id
+        with self.assertNumQueries(1):
+            self.assertEqual(tag_ids(["cached", "missing"]), [tag_id])
+        with self.assertNumQueries(0):
+            self.assertEqual(tag_ids(["CACHED"]), [tag_id])
+
+        # Building a search's cache key looks the ids up along the way.
+        cache.clear()
+        query_cache_key("results", {"query": "cached"})
+        with self.assertNumQueries(0):
+            hashtag_queryset({"query": "cached"})
+
+    def test_tag_ids_accent_variants(self):
+        """
+        A name the database matches to a hashtag stored with different
+        accents gets that hashtag's id.
+        """
+        tag_id = Tag.objects.create(name="café").id
+        filter = Tag.objects.filter
+
+        def filter_without_accents(**filters):
+            # Compare names as MariaDB's utf8mb4_unicode_ci does, which
+            # SQLite can't.
+            stored = {
+                name.replace("é", "e").lower(): name
+                for name in Tag.objects.values_list("name", flat=True)
+            }
+            if "name__in" in filters:
+                filters["name__in"] = [
+                    stored.get(name.lower(), name) for name in filters["name__in"]
+                ]
+            if "name" in filters:
+                filters["name"] = stored.get(filters["name"].lower(), filters["name"])
+            return filter(**filters)
+
+        with patch.object(Tag.objects, "filter", side_effect=filter_without_accents):
+            self.assertEqual(tag_ids(["cafe", "missing"]), [tag_id])
+        with self.assertNumQueries(0):
+            self.assertEqual(tag_ids(["CAFE"]), [tag_id])
+
+    def test_new_edits_invalidate(self):
+        """
+        Cached results for a search are dropped once its hashtags are used
+        again, and only then.
+        """
+        request_dict = {"query": "cached"}
+
+        def count():
+            return cached_search(
+                "results_count",
+                request_dict,
+                lambda: hashtag_queryset(request_dict).count(),
+            )
+
+        self.assertEqual(count(), 3)
+        HashtagFactory(hashtag="unrelated", rc_id=4)
+        # Sneak an edit past the cache, without advancing the watermark.
+        EditTag.objects.create(
+            tag=Tag.objects.get(name="cached"),
+            edit=Edit.objects.get(rc_id=4),
+            timestamp=datetime.now(timezone.utc),
+        )
+        self.assertEqual(count(), 3)
+
+        HashtagFactory(hashtag="cached", rc_id=5)
+        self.assertEqual(count(), 5)
+
+    def test_first_page_cached(self):
+        """
+        The first page of results is only read from the database once.
+        """
+        request_dict = {"query": "cached"}
+        hashtags = hashtag_queryset(request_dict)
+        rows = list(CachedCountPaginator(hashtags, 2, request_dict).page(1))
+        # Just the watermarks for the count and the page.
+        with self.assertNumQueries(2):
+            page = CachedCountPaginator(hashtags, 2, request_dict).page(1)
+        self.assertEqual(list(page), rows)
+        self.assertEqual(page.paginator.num_pages, 2)
+
+
+class CursorPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Several edits share each timestamp, so pages have to be split
+        # between them.
+        for i in range(45):
+            HashtagFactory(
+                hashtag="paged",
+                timestamp=datetime(2020, 1, 1 + i // 4, tzinfo=timezone.utc),
+            )
+        self.url = reverse("index")
+        self.message_patcher = patch("hashtagsv2.hashtags.views.messages.add_message")
+        self.message_patcher.start()
+
+    def tearDown(self):
+        self.message_patcher.stop()
+
+    def get_page(self, cursor):
+        request = RequestFactory().get(self.url, {"query": "paged", "cursor": cursor})
+        return views.Index.as_view()(request).context_data
+
+    def test_cursor_pagination(self):
+        """
+        Following the next links visits every edit once, newest first, and
+        the previous links lead back through the same pages.
+        """
+        pages = []
+        context = self.get_page("")
+        while True:
+            pages.append([edit.id for edit in context["object_list"]])
+            self.assertEqual(context["paginator"].count, 45)
+            if not context["page_obj"].has_next:
+                break
+            context = self.get_page(context["page_obj"].next_cursor)
+
+        expected = list(
+            Edit.objects.order_by("-timestamp", "-id").values_list("id", flat=True)
+        )
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual(sum(pages, []), expected)
+
+        for page in reversed(pages[:-1]):
+            context = self.get_page(context["page_obj"].previous_cursor)
+            self.assertEqual([edit.id for edit in context["object_list"]], page)
+        self.assertFalse(context["page_obj"].has_previous)
+
+    def test_cursor_pagination_template(self):
+        request = RequestFactory().get(self.url, {"query": "paged", "cursor": ""})
+        page_content = views.Index.as_view()(request).render().content.decode()
+
+        self.assertIn("45 results", page_content)
+        self.assertIn("cursor=next_20200107000000000000_", page_content)
+
+
+class PrefixSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        for rc_id, hashtag in [
+            (1, "wlm2023"),
+            (2, "WLM2024"),
+            (3, "wlm2024x"),
+            (3, "wikigap"),
+            (4, "wikigap"),
+        ]:
+            HashtagFactory(hashtag=hashtag, rc_id=rc_id)
+
+    def test_prefix_search(self):
+        """
+        A hashtag ending in * finds the edits with any hashtag starting with
+        it, whatever its case.
+        """
+        for request_dict, rc_ids in [
+            ({"query": "wlm*"}, [1, 2, 3]),
+            ({"query": "#Wlm2024*"}, [2, 3]),
+            ({"query": "wlm*, wikigap"}, [1, 2, 3, 4]),
+            ({"query": "wlm*, wikigap", "search_type": "and"}, [3]),
+            ({"query": "other*"}, []),
+        ]:
+            with self.subTest(request_dict=request_dict):
+                self.assertEqual(
+                    sorted(edit.rc_id for edit in hashtag_queryset(request_dict)),
+                    rc_ids,
+                )
+
+    def test_short_prefix(self):
+        """
+        Prefixes need a few characters, so that one search can't match a
+        large share of all hashtags.
+        """
+        self.assertEqual(list(hashtag_queryset({"query": "wl*"})), [])
+        response = self.client.get(reverse("index"), {"query": "wl*"})
+        self.assertIn(
+            "at least 3 characters",
+            " ".join(str(message) for message in response.context["messages"]),
+        )
+
+    @patch("hashtagsv2.hashtags.views.PREFIX_MAX_TAGS", 2)
+    @patch("hashtagsv2.hashtags.helpers.PREFIX_MAX_TAGS", 2)
+    def test_prefix_matching_too_many(self):
+        """
+        Only the first hashtags starting with a prefix are searched, and the
+        cache key only covers those. The user is told.
+        """
+        self.assertEqual(
+            sorted(edit.rc_id for edit in hashtag_queryset({"query": "wlm*"})),
+            [1, 2],
+        )
+        self.assertEqual(truncated_prefixes(["wlm*", "wikigap", "wlm2024*"]), ["wlm"])
+
+        key = query_cache_key("results", {"query": "wlm*"})
+        HashtagFactory(hashtag="wlm2024x", rc_id=5)
+        self.assertEqual(query_cache_key("results", {"query": "wlm*"}), key)
+
+        response = self.client.get(reverse("index"), {"query": "wlm*"})
+        self.assertIn(
+            "More than 2 hashtags start with wlm",
+            " ".join(str(message) for message in response.context["messages"]),
+        )
+
+    def test_prefix_not_from_daily_totals(self):
+        """
+        An edit can have several hashtags with the same prefix, and the daily
+        totals would count it once for each.
+        """
+        self.assertIsNone(rollup_queryset({"query": "wlm*"}, "domain"))
+        self.assertIsNotNone(rollup_queryset({"query": "wikigap"}, "domain"))
+
+    def test_new_hashtag_invalidates(self):
+        """
+        Cached results for a prefix are dropped once there's a new hashtag
+        starting with it.
+        """
+        key = query_cache_key("results", {"query": "wlm*"})
+        HashtagFactory(hashtag="wlm2025", rc_id=5)
+        self.assertNotEqual(query_cache_key("results", {"query": "wlm*"}), key)
+
+
+class HashtagSuggestTest(TestCase):
+    def setUp(self):
+        suggest._suggestions = None
+        today = datetime.now(timezone.utc)
+        for rc_id, hashtag, days_ago in [
+            (1, "wlm2023", 1),
+            (2, "WLM2024", 1),
+            (3, "WLM2024", 2),
+            (4, "wikigap", 1),
+            (5, "wlm2010", suggest.SUGGEST_DAYS + 1),
+        ]:
+            HashtagFactory(
+                hashtag=hashtag, rc_id=rc_id, timestamp=today - timedelta(days=days_ago)
+            )
+
+    def test_suggest(self):
+        """
+        Hashtags starting with a prefix are suggested most used first, then
+        alphabetically.
+        """
+        suggestions = suggest.Suggestions(
+            [("b", 1), ("WLM2024", 5), ("wlm2023", 2), ("wlm2022", 2), ("wm", 9)]
+        )
+        self.assertEqual(
+            suggestions.suggest("Wlm"), [("WLM2024", 5), ("wlm2022", 2), ("wlm2023", 2)]
+        )
+        self.assertEqual(suggestions.suggest("wlm", limit=1), [("WLM2024", 5)])
+        self.assertEqual(suggestions.suggest("x"), [])
+        self.assertEqual(len(suggestions.suggest("")), 5)
+
+    def test_suggest_view(self):
+        """
+        Suggestions only come from recently used hashtags, and once loaded
+        don't need the database.
+        """
+        url = reverse("hashtag_suggest")
+        self.client.get(url, {"query": "w"})
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {"query": "#wl"})
+        self.assertEqual(
+            loads(response.content),
+            {
+                "hashtags": [
+                    {"hashtag": "WLM2024", "edits": 2},
+                    {"hashtag": "wlm2023", "edits": 1},
+                ]
+            },
+        )
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {"query": ""})
+        self.assertEqual(loads(response.content), {"hashtags": []})
+
+    def test_suggestions_refreshed(self):
+        HashtagFactory(hashtag="wlm2025", rc_id=6)
+        suggestions = suggest.get_suggestions()
+        self.assertIs(suggest.get_suggestions(), suggestions)
+
+        suggestions.loaded -= suggest.SUGGEST_REFRESH_S + 1
+        self.assertIsNot(suggest.get_suggestions(), suggestions)
+
+
+PlanStep = namedtuple("PlanStep", ["table", "index", "covering", "rows"])
+
+
+def query_plan(queryset):
+    """
+    How the database would run a queryset: a step for each table it reads,
+    with the index it reads it through (None for a full scan), whether that
+    index has every column it needs, and how many rows it expects to read
+    (None if it doesn't say).
+    """
+    sql, params = queryset.query.sql_with_params()
+    steps = []
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            for *_, detail in cursor.fetchall():
+                match = re.match(
+                    r"(SEARCH|SCAN)(?: TABLE)? (\w+)(?: AS \w+)?"
+                    r"(?: USING (COVERING )?INDEX (\w+)| USING INTEGER PRIMARY KEY)?",
+                    detail,
+                )
+                if not match:
+                    continue
+                action, table, covering, index = match.groups()
+                # Reading the whole of an index is no better than a full scan.
+                if action == "SCAN":
+                    index = None
+                elif index is None:
+                    index = "PRIMARY"
+                steps.append(PlanStep(table, index, bool(covering), None))
+        else:
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [column[0].lower() for column in cursor.description]
+            for row in cursor.fetchall():
+                step = dict(zip(columns, row))
+                # Skip derived tables and the like.
+                if not step["table"] or step["table"].startswith("<"):
+                    continue
+                steps.append(
+                    PlanStep(
+                        step["table"],
+                        None if step["type"] in ("ALL", "index") else step["key"],
+                        "Using index" in (step["extra"] or ""),
+                        step["rows"],
+                    )
+                )
+    return steps
+
+
+class QueryPlanTest(TestCase):
+    """
+    Every combination of filters the search form allows should find its edits
+    through indexes, rather than scanning the edits or their links.
+    """
+
+    # The most rows any step of a search may expect to read. The searches
+    # below find at most 40 of the 340 edits.
+    ROW_BUDGET = 100
+
+    @classmethod
+    def setUpTestData(cls):
+        start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        for rc_id in range(300):
+            HashtagFactory(
+                hashtag="filler{}".format(rc_id % 30),
+                rc_id=rc_id,
+                domain=("en", "fr", "de", "es")[rc_id % 4] + ".wikipedia.org",
+                username="user{}".format(rc_id % 50),
+                timestamp=start + timedelta(days=rc_id),
+                has_image=rc_id % 5 == 0,
+                has_video=rc_id % 7 == 0,
+                has_audio=rc_id % 11 == 0,
+            )
+        for rc_id in range(300, 340):
+            for hashtag in ("wlm", "wikigap")[: 1 + rc_id % 2]:
+                HashtagFactory(
+                    hashtag=hashtag,
+                    rc_id=rc_id,
+                    domain=("en", "fr")[rc_id % 2] + ".wikipedia.org",
+                    username="user{}".format(rc_id % 50),
+                    timestamp=start + timedelta(days=rc_id),
+                    has_image=rc_id % 5 == 0,
+                )
+        # Give the query planner statistics to go on, as it would have in
+        # production.
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("ANALYZE")
+            else:
+                cursor.execute("ANALYZE TABLE hashtags_edit, hashtags_edittag")
+
+    def searches(self):
+        """
+        Every combination of the search form's filters. Only one media flag
+        is set at a time, as they're all checked the same way.
+        """
+        filters = [
+            [{"query": "wlm"}, {"query": "wlm, wikigap"}],
+            [{}, {"search_type": "and"}],
+            [{}, {"project": "en.wikipedia.org"}],
+            [{}, {"user": "user3"}],
+            [{}, {"startdate": date(2020, 11, 1)}],
+            [{}, {"enddate": date(2020, 12, 1)}],
+            [{}, {"image": True}, {"video": True}, {"audio": True}],
+        ]
+        for combination in itertools.product(*filters):
+            request_dict = {}
+            for search in combination:
+                request_dict.update(search)
+            yield request_dict
+
+    def test_searches_use_indexes(self):
+        for request_dict in self.searches():
+            plan = query_plan(hashtag_queryset(request_dict))
+            with self.subTest(request_dict=request_dict, plan=plan):
+                self.assertTrue(plan)
+                for step in plan:
+                    self.assertIsNotNone(step.index)
+                    if step.rows is not None:
+                        self.assertLessEqual(step.rows, self.ROW_BUDGET)
+
+    def test_links_read_from_index(self):
+        """
+        A hashtag's edits are found from the index on its links alone, without
+        reading the links themselves.
+        """
+        for request_dict in self.searches():
+            plan = query_plan(hashtag_queryset(request_dict))
+            with self.subTest(request_dict=request_dict, plan=plan):
+                links = [step for step in plan if step.table != "hashtags_edit"]
+                self.assertTrue(links)
+                self.assertTrue(all(step.covering for step in links))
@@ -1,31 +1,73 @@
-import csv
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
-from django.db.models import Count
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.gzip import gzip_page
 from django.views.generic import ListView, TemplateView
 from django.utils.translation import gettext as _
 
+from .exports import (
+    COLUMNAR_FORMATS,
+    columnar_chunks,
+    csv_chunks,
+    iterate_rows,
+    json_chunks,
+    json_row,
+    ndjson_chunks,
+)
 from .forms import SearchForm
-from .helpers import hashtag_queryset, get_hashtags_context
-from .models import Hashtag
+from .helpers import (
+    PREFIX_MAX_TAGS,
+    PREFIX_MIN_LENGTH,
+    cached_results_count,
+    get_hashtags_context,
+    get_leaderboard,
+    hashtag_prefix,
+    hashtag_queryset,
+    split_hashtags,
+    truncated_prefixes,
+)
+from .models import Edit
+from .pagination import CachedCountPaginator, CursorPage
+from .suggest import get_suggestions
 
 
 class Index(ListView):
-    model = Hashtag
+    model = Edit
     template_name = "hashtags/index.html"
     form_class = SearchForm
     context_object_name = "hashtags"
     paginate_by = 20
 
+    def paginate_queryset(self, queryset, page_size):
+        # Searches with a cursor parameter (which may be empty, for the first
+        # page) opt in to keyset pagination, which is just as quick for page
+        # 500 as for page 1 but only has next and previous links.
+        if "cursor" not in self.request.GET or isinstance(queryset, list):
+            return super().paginate_queryset(queryset, page_size)
+
+        request_dict = self.request.GET.dict()
+        page = CursorPage(
+            queryset,
+            page_size,
+            request_dict["cursor"],
+            cached_results_count(request_dict, queryset),
+            request_dict,
+        )
+        return (page.paginator, page, page.object_list, page.has_other_pages())
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        if isinstance(queryset, list):
+            return super().get_paginator(queryset, per_page, **kwargs)
+        return CachedCountPaginator(
+            queryset, per_page, self.request.GET.dict(), **kwargs
+        )
+
     def get_context_data(self, *args, **kwargs):
         # If we have any hashtags in the database, check if we appear
         # to be up-to-date.
-        try:
-            latest_datetime = Hashtag.objects.all().latest("timestamp").timestamp
-        except Hashtag.DoesNotExist:
-            latest_datetime = datetime.now(timezone.utc)
+        leaderboard = get_leaderboard()
+        latest_datetime = leaderboard.latest_edit or datetime.now(timezone.utc)
         diff = datetime.now(timezone.utc) - latest_datetime
         if diff.seconds > 3600:
             messages.add_message(
@@ -38,6 +80,7 @@ class Index(ListView):
             )
 
         context = super().get_context_data(**kwargs)
+        context["cursor_pagination"] = isinstance(context["page_obj"], CursorPage)
 
         # Make sure we're setting initial values in case user has
         # already submitted something.
@@ -59,15 +102,7 @@ class Index(ListView):
             )
         else:
             # We're just displaying the home page with no query.
-            top_tags = (
-                Hashtag.objects.filter(
-                    timestamp__gt=datetime.now() - timedelta(days=30)
-                )
-                .values_list("hashtag")
-                .annotate(count=Count("hashtag"))
-                .order_by("-count")[:10]
-            )
-            context["top_tags"] = [x[0] for x in top_tags]
+            context["top_tags"] = leaderboard.top_tags
 
         return context
 
@@ -84,6 +119,7 @@ class Index(ListView):
                     _("Unfortunately Wikidata searching is not currently supported."),
                 )
             else:
+                self.add_prefix_messages(split_hashtags(form_data["query"]))
                 hashtag_qs = hashtag_queryset(form_data)
 
             return hashtag_qs
@@ -93,68 +129,131 @@ class Index(ListView):
         # if the form hasn't been filled yet.
         return []
 
+    def add_prefix_messages(self, hashtag_list):
+        # Let the user know when a prefix didn't search every hashtag they
+        # might have expected it to.
+        for term in hashtag_list:
+            if term.endswith("*") and not hashtag_prefix(term):
+                messages.add_message(
+                    self.request,
+                    messages.INFO,
+                    # Translators: Message to be displayed when a search ends a hashtag with * but gives too few characters before it.
+                    _(
+                        "Searching for hashtags starting with some text needs at least %(count)d characters before the *."
+                    )
+                    % {"count": PREFIX_MIN_LENGTH},
+                )
+        for prefix in truncated_prefixes(hashtag_list):
+            messages.add_message(
+                self.request,
+                messages.INFO,
+                # Translators: Message to be displayed when a search for hashtags starting with some text matches too many of them.
+                _(
+                    "More than %(count)d hashtags start with %(prefix)s, so only the first %(count)d alphabetically were searched."
+                )
+                % {"count": PREFIX_MAX_TAGS, "prefix": prefix},
+            )
+
 
-def csv_download(request):
-    # If this fails for large files we should consider
-    # https://docs.djangoproject.com/en/2.1/howto/outputting-csv/#streaming-large-csv-files
+def columnar_download(request):
+    # The search as a Parquet file or Arrow stream, for loading straight into
+    # pandas and the like, written a record batch at a time.
     request_dict = request.GET.dict()
+    file_format = request_dict["format"]
+    content_type, extension = COLUMNAR_FORMATS[file_format]
 
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = 'attachment; filename="hashtags.csv"'
+    hashtags = hashtag_queryset(request_dict)
+    chunks = columnar_chunks(
+        hashtags, split_hashtags(request_dict["query"]), file_format
+    )
+
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="hashtags.{}"'.format(
+        extension
+    )
+    return response
+
+
+def csv_download(request):
+    # The columnar formats are compressed already, so we don't gzip them.
+    if request.GET.get("format") in COLUMNAR_FORMATS:
+        return columnar_download(request)
+    return csv_text_download(request)
+
+
+@gzip_page
+def csv_text_download(request):
+    # Rows are written to the response as they're read from the database,
+    # and compressed if the client accepts gzip.
+    request_dict = request.GET.dict()
 
     hashtags = hashtag_queryset(request_dict)
 
-    writer = csv.writer(response)
-    writer.writerow(
+    header = [
+        # Translators: Domain of a wikimedia project.
+        _("Domain"),
+        # Translators: Time at which edit is done.
+        _("Timestamp"),
+        # Translators: Username of the editor.
+        _("Username"),
+        # Translations: Title of the page to which edit belongs.
+        _("Page_title"),
+        # Translations: Summary of the edit done on Wikimedia project.
+        _("Edit_summary"),
+        # Translations: Revision ID of the edit.
+        _("Revision_id"),
+    ]
+    rows = (
         [
-            # Translators: Domain of a wikimedia project.
-            _("Domain"),
-            # Translators: Time at which edit is done.
-            _("Timestamp"),
-            # Translators: Username of the editor.
-            _("Username"),
-            # Translations: Title of the page to which edit belongs.
-            _("Page_title"),
-            # Translations: Summary of the edit done on Wikimedia project.
-            _("Edit_summary"),
-            # Translations: Revision ID of the edit.
-            _("Revision_id"),
+            hashtag.domain,
+            hashtag.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            hashtag.username,
+            hashtag.page_title,
+            hashtag.edit_summary,
+            hashtag.rev_id,
         ]
+        for hashtag in iterate_rows(hashtags)
     )
-    for hashtag in hashtags:
-        writer.writerow(
-            [
-                hashtag.domain,
-                hashtag.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                hashtag.username,
-                hashtag.page_title,
-                hashtag.edit_summary,
-                hashtag.rev_id,
-            ]
-        )
 
+    response = StreamingHttpResponse(csv_chunks(header, rows), content_type="text/csv")
+    response["Content-Disposition"] = 'attachment; filename="hashtags.csv"'
     return response
 
 
 def json_download(request):
+    if request.GET.get("format") in COLUMNAR_FORMATS:
+        return columnar_download(request)
+    return json_text_download(request)
+
+
+@gzip_page
+def json_text_download(request):
+    # Streamed like the CSV download. ?format=ndjson gives one JSON object
+    # per line instead of a single {"Rows": [...]} object.
     request_dict = request.GET.dict()
 
     hashtags = hashtag_queryset(request_dict)
+    rows = (json_row(hashtag) for hashtag in iterate_rows(hashtags))
 
-    row_list = []
-    for hashtag in hashtags:
-        row_list.append(
-            {
-                "Domain": hashtag.domain,
-                "Timestamp": hashtag.timestamp,
-                "Username": hashtag.username,
-                "Page_title": hashtag.page_title,
-                "Edit_summary": hashtag.edit_summary,
-                "Revision_ID": hashtag.rev_id,
-            }
+    if request_dict.get("format") == "ndjson":
+        response = StreamingHttpResponse(
+            ndjson_chunks(rows), content_type="application/x-ndjson"
         )
+    else:
+        response = StreamingHttpResponse(
+            json_chunks(rows), content_type="application/json"
+        )
+    return response
 
-    return JsonResponse({"Rows": row_list})
+
+def hashtag_suggest(request):
+    # Hashtags starting with ?query=, most used recently first, for
+    # autocompleting the search box. Answered from memory, so it's quick.
+    prefix = request.GET.get("query", "").strip().lstrip("#").rstrip("*")
+    suggestions = get_suggestions().suggest(prefix) if prefix else []
+    return JsonResponse(
+        {"hashtags": [{"hashtag": name, "edits": edits} for name, edits in suggestions]}
+    )
 
 
 class Docs(TemplateView):
@@ -78,6 +78,32 @@ DATABASES = {
 
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
+# Cache
+
+# Search results are cached in each worker's memory unless CACHE_BACKEND says
+# otherwise, e.g. django.core.cache.backends.filebased.FileBasedCache with a
+# CACHE_LOCATION directory to share them between workers. Cached searches are
+# invalidated through the database, so any backend will do.
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    }
+}
+
+# Statistics
+
+# The numbers of users, pages and revisions are estimated from daily sketches
+# rather than counted for searches with more than this many edits, or for every
+# search the sketches can answer if APPROXIMATE_STATISTICS is set. Searches
+# with exact=1 are always counted.
+APPROXIMATE_STATISTICS = bool(os.environ.get("APPROXIMATE_STATISTICS"))
+APPROXIMATE_STATISTICS_EDITS = int(
+    os.environ.get("APPROXIMATE_STATISTICS_EDITS", 1000000)
+)
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -17,7 +17,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from hashtagsv2.hashtags.views import Index, csv_download, json_download, Docs
+from hashtagsv2.hashtags.views import (
+    Index,
+    csv_download,
+    json_download,
+    hashtag_suggest,
+    Docs,
+)
 
 from hashtagsv2.graphs.views import (
     top_project_statistics_data,
@@ -52,4 +58,5 @@ urlpatterns = [
         "api/top_user_stats/", top_user_statistics_data, name="top_user_statistics_data"
     ),
     path("api/time_stats/", time_statistics_data, name="time_statistics_data"),
+    path("api/hashtag_suggest/", hashtag_suggest, name="hashtag_suggest"),
 ]
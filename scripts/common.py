@@ -24,12 +24,62 @@ EXCLUDED_RE = (
 )
 
 
-# exclude tags based on pattern match
-def __excluded_re(hashtag):
-    for pattern in EXCLUDED_RE:
-        if pattern.fullmatch(hashtag):
-            return True
-    return False
+# Now do regex to see if it's a valid hashtag
+# From https://gist.github.com/mahmoud/237eb20108b5805aed5f
+HASHTAG_RE = re.compile(r"(?:^|\s)[＃#]{1}(\w+)")
+
+
+class HashtagExtractor:
+    """
+    Finds the hashtags we log in an edit summary. Every event in the stream
+    goes through this, so the exclusions are checked against a frozenset and
+    a single combined regex, and each tag is only lowercased once.
+    """
+
+    def __init__(self, excluded_literal=EXCLUDED_LITERAL, excluded_re=EXCLUDED_RE):
+        self.excluded_literal = frozenset(excluded_literal)
+        self.excluded_re = None
+        if excluded_re:
+            self.excluded_re = re.compile(
+                "|".join("(?:{})".format(pattern.pattern) for pattern in excluded_re)
+            )
+
+    def extract(self, comment):
+        """
+        Return the valid hashtags in a comment, in the order they first appear
+        and without repeats.
+        """
+        # Save some time by discarding this edit if it doesn't have
+        # a hashtag symbol at all
+        if "#" not in comment and "＃" not in comment:
+            return []
+
+        hashtags = []
+        seen = set()
+        for hashtag in HASHTAG_RE.findall(comment):
+            if hashtag in seen:
+                continue
+            seen.add(hashtag)
+            if self.valid(hashtag):
+                hashtags.append(hashtag)
+        return hashtags
+
+    def valid(self, hashtag):
+        # only numbers, or too short
+        if hashtag.isdigit() or len(hashtag) < 2:
+            return False
+        lowered = hashtag.lower()
+        # excluded literal
+        if lowered in self.excluded_literal:
+            return False
+        # excluded pattern
+        if self.excluded_re is not None and self.excluded_re.fullmatch(lowered):
+            return False
+        # Otherwise valid
+        return True
+
+
+extractor = HashtagExtractor()
 
 
 def hashtag_match(comment):
@@ -38,11 +88,7 @@ def hashtag_match(comment):
     if "#" not in comment and "＃" not in comment:
         return None
 
-    # Now do regex to see if it's a valid hashtag
-    # From https://gist.github.com/mahmoud/237eb20108b5805aed5f
-    hashtag_re = re.compile("(?:^|\s)[＃#]{1}(\w+)")
-
-    return hashtag_re.findall(comment)
+    return HASHTAG_RE.findall(comment)
 
 
 def valid_hashtag(hashtag):
@@ -51,23 +97,27 @@ def valid_hashtag(hashtag):
     if type(hashtag) is not str:
         return False
 
-    # only numbers
-    if hashtag.isdigit():
-        return False
+    return extractor.valid(hashtag)
 
-    # too short
-    if len(hashtag) < 2:
-        return False
 
-    # exluded literal
-    if hashtag.lower() in EXCLUDED_LITERAL:
-        return False
+# Most events in the stream can't have a hashtag we'd log, so we check the raw
+# event data for these before decoding it. The stream sends compact JSON, but
+# we allow for whitespace anyway. Quotes in string values are escaped, so an
+# edit summary can't contain something that looks like these keys.
+HASH_SIGNS = ("#", "＃", "\\uff03")
+BOT_RE = re.compile(r'"bot"\s*:\s*true')
+WIKIDATA_RE = re.compile(r'"domain"\s*:\s*"www\.wikidata\.org"')
 
-    # excluded pattern
-    if __excluded_re(hashtag.lower()):
-        return False
 
-    # Otherwise valid
+def might_have_hashtags(data):
+    """
+    A quick check of an event's raw JSON data. False means the event can't
+    have any hashtags we log, so there's no need to decode it.
+    """
+    if not any(sign in data for sign in HASH_SIGNS):
+        return False
+    if BOT_RE.search(data) or WIKIDATA_RE.search(data):
+        return False
     return True
 
 
@@ -1,27 +1,163 @@
+import collections
+import functools
 import mysql.connector
 import os
+import time
 
-hashtag_db = mysql.connector.connect(
-    host="db",
-    user="root",
-    passwd=os.environ["MYSQL_ROOT_PASSWORD"],
-    database=os.environ["MYSQL_DATABASE"],
+from hll import HyperLogLog, add_edit
+
+
+@functools.lru_cache(maxsize=None)
+def get_connection():
+    # Connect on first use, so that the collector's other modules can be
+    # imported (e.g. in tests) without a database.
+    return mysql.connector.connect(
+        host="db",
+        user="root",
+        passwd=os.environ["MYSQL_ROOT_PASSWORD"],
+        database=os.environ["MYSQL_DATABASE"],
+        # Sets the connection character set once, rather than running SET NAMES
+        # before every insert.
+        charset="utf8mb4",
+    )
+
+
+# Rows are buffered and written in a single transaction once we have this many
+# of them, or once the oldest buffered row has waited this long.
+FLUSH_MAX_ROWS = 100
+FLUSH_MAX_DELAY_MS = 2000
+
+# How often we save our position in the stream when no hashtags are being
+# written along with it.
+CHECKPOINT_INTERVAL_MS = 10000
+
+# How many hashtag ids we remember. Most of the hashtags in use at any time
+# are a few long-running campaigns.
+TAG_ID_CACHE_MAX_SIZE = 50000
+
+# Only run for hashtags SELECT_TAG_IDS_QUERY didn't find, since an INSERT that
+# hits the unique key still uses up an auto-increment id. Their watermarks
+# start at 0 and are advanced along with the others.
+INSERT_TAGS_QUERY = """
+    INSERT INTO hashtags_tag (name, watermark)
+    VALUES (%s, 0)
+    ON DUPLICATE KEY UPDATE id = id
+    """
+
+# The ids of the batch's hashtags we haven't looked up before. {names} is
+# NAME_VALUES repeated for each hashtag, joined by UNION ALL. Matching names
+# with the column's collation means a hashtag gets the id of the tag it was
+# stored as, whatever its case or accents.
+SELECT_TAG_IDS_QUERY = """
+    SELECT name.name, tag.id
+    FROM ({names}) AS name
+    JOIN hashtags_tag AS tag ON tag.name = name.name
+    """
+
+NAME_VALUES = "SELECT %s AS name"
+
+# Advancing each hashtag's watermark tells the website that its cached search
+# results for the hashtag are out of date. {tag_ids} is a list of placeholders.
+UPDATE_WATERMARKS_QUERY = """
+    UPDATE hashtags_tag SET watermark = watermark + 1
+    WHERE id IN ({tag_ids})
+    """
+
+INSERT_EDITS_QUERY = """
+    INSERT INTO hashtags_edit
+    (domain, timestamp, username, page_title,
+    edit_summary, rc_id, rev_id, has_image, has_video, has_audio)
+    VALUES
+    (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE id = id
+    """
+
+# Links each hashtag to its edit, looking up the edit's id in the same
+# statement. {links} is LINK_VALUES repeated for each row, joined by UNION ALL.
+# Matching the edit's timestamp as well as its unique key means that once the
+# tables are partitioned by month, each lookup only reads the edit's month.
+INSERT_LINKS_QUERY = """
+    INSERT IGNORE INTO hashtags_edittag (tag_id, edit_id, timestamp)
+    SELECT link.tag_id, edit.id, edit.timestamp
+    FROM ({links}) AS link
+    JOIN hashtags_edit AS edit
+    ON edit.domain = link.domain AND edit.rc_id = link.rc_id
+    AND edit.timestamp = link.timestamp
+    """
+
+LINK_VALUES = (
+    "SELECT %s AS tag_id, %s AS domain, %s AS rc_id, "
+    "CAST(%s AS DATETIME) AS timestamp"
 )
 
+# Add the links we're about to insert to the daily totals of edits per hashtag
+# and project, and per hashtag and user. Run before INSERT_LINKS_QUERY, so that
+# links we've already logged can be left out.
+ROLLUP_DOMAINS_QUERY = """
+    INSERT INTO hashtags_dailydomainedits (tag_id, day, domain, edits)
+    SELECT link.tag_id, DATE(edit.timestamp), edit.domain, COUNT(*)
+    FROM ({links}) AS link
+    JOIN hashtags_edit AS edit
+    ON edit.domain = link.domain AND edit.rc_id = link.rc_id
+    AND edit.timestamp = link.timestamp
+    LEFT JOIN hashtags_edittag AS logged
+    ON logged.tag_id = link.tag_id AND logged.edit_id = edit.id
+    AND logged.timestamp = edit.timestamp
+    WHERE logged.id IS NULL
+    GROUP BY link.tag_id, DATE(edit.timestamp), edit.domain
+    ON DUPLICATE KEY UPDATE edits = hashtags_dailydomainedits.edits + VALUES(edits)
+    """
 
-def insert_db(hashtag, change):
-    cursor = hashtag_db.cursor()
-    cursor.execute("SET NAMES utf8mb4")
-    cursor.execute("SET CHARACTER SET utf8mb4")
-    cursor.execute("SET character_set_connection=utf8mb4")
-    query = """
-        INSERT INTO hashtags_hashtag
-        (hashtag, domain, timestamp, username, page_title,
-        edit_summary, rc_id, rev_id, has_image, has_video, has_audio)
-        VALUES
-        (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
+ROLLUP_USERS_QUERY = """
+    INSERT INTO hashtags_dailyuseredits (tag_id, day, username, edits)
+    SELECT link.tag_id, DATE(edit.timestamp), edit.username, COUNT(*)
+    FROM ({links}) AS link
+    JOIN hashtags_edit AS edit
+    ON edit.domain = link.domain AND edit.rc_id = link.rc_id
+    AND edit.timestamp = link.timestamp
+    LEFT JOIN hashtags_edittag AS logged
+    ON logged.tag_id = link.tag_id AND logged.edit_id = edit.id
+    AND logged.timestamp = edit.timestamp
+    WHERE logged.id IS NULL
+    GROUP BY link.tag_id, DATE(edit.timestamp), edit.username
+    ON DUPLICATE KEY UPDATE edits = hashtags_dailyuseredits.edits + VALUES(edits)
+    """
 
+# The sketches of the users, pages and revisions of each hashtag on each day,
+# which estimate how many distinct ones there are. Each batch's values are
+# merged into the stored sketches in Python, so we read those first, locking
+# them until the batch commits so that another collector or build_rollups
+# can't replace them in between and lose what it added.
+# {tag_ids} and {days} are lists of placeholders.
+SELECT_SKETCHES_QUERY = """
+    SELECT tag_id, day, users, pages, revisions
+    FROM hashtags_dailysketch
+    WHERE tag_id IN ({tag_ids}) AND day IN ({days})
+    FOR UPDATE
+    """
+
+UPSERT_SKETCHES_QUERY = """
+    INSERT INTO hashtags_dailysketch (tag_id, day, users, pages, revisions)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+    users = VALUES(users), pages = VALUES(pages), revisions = VALUES(revisions)
+    """
+
+CHECKPOINT_QUERY = """
+    INSERT INTO hashtags_streamcheckpoint
+    (stream, last_event_id, updated)
+    VALUES
+    (%s, %s, UTC_TIMESTAMP())
+    ON DUPLICATE KEY UPDATE
+    last_event_id = VALUES(last_event_id), updated = VALUES(updated)
+    """
+
+
+def hashtag_values(hashtag, change):
+    """
+    Build the row we buffer for a hashtag used in a change from the
+    EventStream: the hashtag, followed by the columns of its hashtags_edit row.
+    """
     dt_without_plus = change["meta"]["dt"][:19]
     change_dt = dt_without_plus.replace("T", " ")
 
@@ -32,7 +168,7 @@ def insert_db(hashtag, change):
     except KeyError:
         revision_id = None
 
-    values = (
+    return (
         hashtag,
         change["meta"]["domain"],
         change_dt,
@@ -46,57 +182,351 @@ def insert_db(hashtag, change):
         change["has_audio"],
     )
 
-    try:
-        cursor.execute(query, values)
-    except mysql.connector.errors.IntegrityError:
-        print("Skipped rc_id {rc_id} due to integrity error".format(rc_id=change["id"]))
-        return False
-    except mysql.connector.errors.DataError as data_error:
-        # Ignore changes whose data won't fit in our database columns, but crash
-        # on other kinds of data error that we don't expect.
-        if data_error.errno == mysql.connector.errorcode.ER_DATA_TOO_LONG:
+
+class BufferedWriter:
+    """
+    Collects hashtag rows in memory and writes them to the database in one
+    transaction, rather than with a round trip and a commit per row. Each
+    flush inserts the batch's hashtags, its edits and the links between them
+    with one statement apiece, and adds the new links to the daily totals
+    and sketches kept for statistics. Call maybe_flush() regularly so that
+    rows don't wait longer than max_delay_ms during quiet periods, and
+    flush() on shutdown.
+
+    Links, totals and sketches refer to hashtags by id. We remember the ids
+    of the hashtags we've logged recently in tag_ids, so we only need to
+    look up new ones, and only INSERT the hashtags that aren't stored yet.
+
+    The database has unique keys on hashtags, edits and links, so rows we've
+    already logged, for example when replaying part of the EventStream after
+    a restart, are skipped by the INSERTs themselves. We count them in
+    duplicates_skipped.
+
+    The ID of the last event processed, given to set_checkpoint(), is saved
+    in the same transaction as the rows, so the saved position never gets
+    ahead of the hashtags we've written.
+
+    Subclasses can write to other databases by overriding the queries,
+    `row_errors` and skip_row().
+    """
+
+    insert_tags_query = INSERT_TAGS_QUERY
+    select_tag_ids_query = SELECT_TAG_IDS_QUERY
+    name_values = NAME_VALUES
+    update_watermarks_query = UPDATE_WATERMARKS_QUERY
+    insert_edits_query = INSERT_EDITS_QUERY
+    insert_links_query = INSERT_LINKS_QUERY
+    rollup_queries = (ROLLUP_DOMAINS_QUERY, ROLLUP_USERS_QUERY)
+    select_sketches_query = SELECT_SKETCHES_QUERY
+    upsert_sketches_query = UPSERT_SKETCHES_QUERY
+    link_values = LINK_VALUES
+    placeholder = "%s"
+    checkpoint_query = CHECKPOINT_QUERY
+    # Errors that reject individual rows, rather than the whole batch.
+    row_errors = (
+        mysql.connector.errors.IntegrityError,
+        mysql.connector.errors.DataError,
+    )
+
+    def __init__(
+        self,
+        connection=None,
+        stream="recentchange",
+        max_rows=FLUSH_MAX_ROWS,
+        max_delay_ms=FLUSH_MAX_DELAY_MS,
+        checkpoint_interval_ms=CHECKPOINT_INTERVAL_MS,
+        clock=time.monotonic,
+        tag_id_cache_max_size=TAG_ID_CACHE_MAX_SIZE,
+    ):
+        self.connection = connection if connection is not None else get_connection()
+        self.stream = stream
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self.checkpoint_interval = checkpoint_interval_ms / 1000
+        self.clock = clock
+        self.rows = []
+        self.oldest_row_time = None
+        self.checkpoint = None
+        self.checkpoint_time = clock()
+        self.duplicates_skipped = 0
+        # Hashtag, as written in edit summaries -> id, least recently used
+        # first. Names the database treats as equal, such as "WLM" and "wlm",
+        # get separate entries with the same id.
+        self.tag_ids = collections.OrderedDict()
+        self.tag_id_cache_max_size = tag_id_cache_max_size
+        # Ids looked up in the current transaction. A rollback would undo any
+        # new hashtags, so they're only added to tag_ids once it commits.
+        self.new_tag_ids = {}
+
+    def add(self, hashtag, change):
+        if not self.rows:
+            self.oldest_row_time = self.clock()
+        self.rows.append(hashtag_values(hashtag, change))
+        self.maybe_flush()
+
+    def set_checkpoint(self, event_id):
+        """
+        Record that every event up to and including event_id has been added.
+        """
+        if event_id is not None:
+            self.checkpoint = event_id
+
+    def maybe_flush(self):
+        if len(self.rows) >= self.max_rows:
+            self.flush()
+        elif self.rows and self.clock() - self.oldest_row_time >= self.max_delay:
+            self.flush()
+        elif (
+            self.checkpoint is not None
+            and self.clock() - self.checkpoint_time >= self.checkpoint_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered rows and the latest checkpoint, returning the number
+        of rows inserted.
+        """
+        rows = self.rows
+        self.rows = []
+        self.oldest_row_time = None
+        checkpoint = self.checkpoint
+        self.checkpoint = None
+
+        inserted, duplicates = self._insert_rows(rows) if rows else (0, 0)
+        if checkpoint is not None:
+            self._save_checkpoint(checkpoint)
+            self.checkpoint_time = self.clock()
+        self._commit()
+
+        if duplicates:
+            self.duplicates_skipped += duplicates
             print(
-                "Skipped rc_id {rc_id} due to data error {data_error}".format(
-                    rc_id=change["id"], data_error=data_error
+                "Skipped {duplicates} duplicate hashtag(s) ({total} so far)".format(
+                    duplicates=duplicates, total=self.duplicates_skipped
                 )
             )
-            return False
-        raise
+        return inserted
+
+    def _insert_rows(self, rows):
+        """
+        Insert rows without committing. Returns the number of rows inserted and
+        the number skipped as duplicates.
+        """
+        cursor = self.connection.cursor()
+        try:
+            inserted = self._insert(cursor, rows)
+        except self.row_errors:
+            # One bad row fails the whole statement. Retry the batch a row
+            # at a time so that only the offending rows are skipped.
+            self._rollback()
+            results = [self._insert_row(row) for row in rows]
+            return results.count(1), results.count(0)
+        finally:
+            cursor.close()
+
+        return inserted, len(rows) - inserted
+
+    def _insert(self, cursor, rows):
+        """
+        Insert the hashtags, edits and links for rows, returning the number of
+        links inserted.
+        """
+        names = list(dict.fromkeys(row[0] for row in rows))
+        # A change's rows all have the same edit, identified by domain and
+        # rc_id.
+        edits = {(row[1], row[6]): row[1:] for row in rows}
+
+        tag_ids = self._tag_ids(cursor, names)
+        ids = sorted(set(tag_ids.values()))
+        if ids:
+            cursor.execute(
+                self.update_watermarks_query.format(
+                    tag_ids=", ".join([self.placeholder] * len(ids))
+                ),
+                ids,
+            )
+        # mysql.connector rewrites this into a single multi-row INSERT.
+        cursor.executemany(self.insert_edits_query, list(edits.values()))
+
+        # Hashtags that only differ in case or accents are the same tag, so
+        # only link (and count) one of them to each edit.
+        unique_rows = {}
+        for row in rows:
+            if row[0] in tag_ids:
+                unique_rows.setdefault((tag_ids[row[0]], row[1], row[6]), row)
+        rows = list(unique_rows.values())
+        if not rows:
+            return 0
+        links = [
+            value for row in rows for value in (tag_ids[row[0]], row[1], row[6], row[2])
+        ]
+        link_values = " UNION ALL ".join([self.link_values] * len(rows))
+        for query in self.rollup_queries:
+            cursor.execute(query.format(links=link_values), links)
+        self._update_sketches(cursor, rows, tag_ids)
+        cursor.execute(self.insert_links_query.format(links=link_values), links)
+        # Links that hit the unique key aren't counted as affected.
+        return cursor.rowcount
+
+    def _tag_ids(self, cursor, names):
+        """
+        The ids of the hashtags in names, by name, adding any that aren't
+        stored yet.
+        """
+        ids = {}
+        missing = []
+        for name in names:
+            if name in self.tag_ids:
+                self.tag_ids.move_to_end(name)
+                ids[name] = self.tag_ids[name]
+            elif name in self.new_tag_ids:
+                ids[name] = self.new_tag_ids[name]
+            else:
+                missing.append(name)
 
-    hashtag_db.commit()
+        if missing:
+            ids.update(self._select_tag_ids(cursor, missing))
+            new = [name for name in missing if name not in ids]
+            if new:
+                # mysql.connector rewrites this into a single multi-row INSERT.
+                cursor.executemany(self.insert_tags_query, [(name,) for name in new])
+                ids.update(self._select_tag_ids(cursor, new))
+        return ids
+
+    def _select_tag_ids(self, cursor, names):
+        """
+        Look up the ids of stored hashtags, by the names we asked for.
+        """
+        cursor.execute(
+            self.select_tag_ids_query.format(
+                names=" UNION ALL ".join([self.name_values] * len(names))
+            ),
+            names,
+        )
+        ids = dict(cursor.fetchall())
+        self.new_tag_ids.update(ids)
+        return ids
+
+    def _commit(self):
+        self.connection.commit()
+        for key, tag_id in self.new_tag_ids.items():
+            self.tag_ids[key] = tag_id
+            self.tag_ids.move_to_end(key)
+        self.new_tag_ids = {}
+        while len(self.tag_ids) > self.tag_id_cache_max_size:
+            self.tag_ids.popitem(last=False)
+
+    def _rollback(self):
+        self.connection.rollback()
+        self.new_tag_ids = {}
+
+    def _update_sketches(self, cursor, rows, tag_ids):
+        """
+        Add the users, pages and revisions of rows to the sketches of their
+        hashtags for the day. Adding the same edit again changes nothing, so
+        unlike the daily totals we don't need to leave out logged links.
+        """
+        ids = sorted(set(tag_ids.values()))
+        days = sorted({row[2][:10] for row in rows})
+        cursor.execute(
+            self.select_sketches_query.format(
+                tag_ids=", ".join([self.placeholder] * len(ids)),
+                days=", ".join([self.placeholder] * len(days)),
+            ),
+            ids + days,
+        )
+        sketches = {
+            (tag_id, str(day)): [HyperLogLog.from_bytes(sketch) for sketch in stored]
+            for tag_id, day, *stored in cursor.fetchall()
+        }
+
+        updated = {}
+        for row in rows:
+            key = (tag_ids[row[0]], row[2][:10])
+            if key not in updated:
+                updated[key] = sketches.get(key) or [HyperLogLog() for _ in range(3)]
+            add_edit(updated[key], row[3], row[1], row[4], row[7])
+
+        cursor.executemany(
+            self.upsert_sketches_query,
+            [
+                key + (users.to_bytes(), pages.to_bytes(), revisions.to_bytes())
+                for key, (users, pages, revisions) in updated.items()
+            ],
+        )
+
+    def _save_checkpoint(self, event_id):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(self.checkpoint_query, (self.stream, event_id))
+        finally:
+            cursor.close()
+
+    def _insert_row(self, row):
+        """
+        Insert a single row in its own transaction. Returns the number of rows
+        inserted, or None if the row was rejected.
+        """
+        cursor = self.connection.cursor()
+        try:
+            inserted = self._insert(cursor, [row])
+        except self.row_errors as error:
+            self._rollback()
+            self.skip_row(row, error)
+            return None
+        finally:
+            cursor.close()
+
+        self._commit()
+        return inserted
+
+    def skip_row(self, row, error):
+        """
+        Report a row the database rejected, or re-raise the error if it isn't
+        one we expect.
+        """
+        rc_id = row[6]
+        if isinstance(error, mysql.connector.errors.IntegrityError):
+            print("Skipped rc_id {rc_id} due to integrity error".format(rc_id=rc_id))
+        # Ignore changes whose data won't fit in our database columns, but
+        # crash on other kinds of data error that we don't expect.
+        elif error.errno == mysql.connector.errorcode.ER_DATA_TOO_LONG:
+            print(
+                "Skipped rc_id {rc_id} due to data error {data_error}".format(
+                    rc_id=rc_id, data_error=error
+                )
+            )
+        else:
+            raise error
 
 
 def get_latest_datetime():
     """
-    Find the most recent logged hashtag, for use when collecting hashtags
+    Find the most recent logged edit, for use when collecting hashtags
     from historical EventStream following downtime.
     """
-    cursor = hashtag_db.cursor()
-    query = "SELECT MAX(timestamp) FROM hashtags_hashtag"
+    cursor = get_connection().cursor()
+    query = "SELECT MAX(timestamp) FROM hashtags_edit"
 
     cursor.execute(query)
 
     return cursor.fetchone()
 
 
-def is_duplicate(hashtag, rc_id):
+def get_checkpoint(stream="recentchange"):
     """
-    We can't make diff or event id a unique key, because we're creating
-    a db row per hashtag use, not per diff. As such, we need to check if
-    this hashtag + diff combo has been logged already.
-    We use rc_id because not all logged edits have a rev_id, such as page
-    moves or image uploads.
+    Find the ID of the last event we processed from the given stream, so that
+    we can resume it from there. Returns None if we haven't saved one yet.
     """
-    cursor = hashtag_db.cursor()
+    cursor = get_connection().cursor()
     query = """
-        SELECT COUNT(*) FROM hashtags_hashtag
-        WHERE hashtag = %s
-        AND rc_id = %s
+        SELECT last_event_id FROM hashtags_streamcheckpoint
+        WHERE stream = %s
         """
 
-    cursor.execute(query, (hashtag, rc_id))
+    cursor.execute(query, (stream,))
+    row = cursor.fetchone()
+    cursor.close()
 
-    if cursor.fetchone()[0] == 0:
-        return False
-    else:
-        return True
+    return row[0] if row else None
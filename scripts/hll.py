@@ -0,0 +1,93 @@
+import hashlib
+import math
+
+# Each sketch has 2 ** PRECISION registers, and estimates the number of
+# distinct values added to it to within about 1.6%.
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+HASH_BITS = 64
+RANK_BITS = HASH_BITS - PRECISION
+
+ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+POWERS = [2.0**-rank for rank in range(RANK_BITS + 2)]
+
+
+class HyperLogLog:
+    """
+    A HyperLogLog sketch of a set of values, from which we can estimate how
+    many distinct values there are without keeping the values themselves.
+    Adding a value twice changes nothing, and two sketches merge into a sketch
+    of their union, so we can keep one per hashtag per day and combine the
+    days of a search.
+
+    Values are hashed with BLAKE2b rather than hash(), which is different in
+    every process, so the collector and the website agree on them.
+    """
+
+    def __init__(self, registers=None):
+        self.registers = (
+            bytearray(REGISTERS) if registers is None else bytearray(registers)
+        )
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, "big")
+        index = hashed >> RANK_BITS
+        # The position of the first set bit in the rest of the hash.
+        rank = RANK_BITS - (hashed & ((1 << RANK_BITS) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """
+        Merge another sketch into this one.
+        """
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        registers = self.registers
+        estimate = ALPHA * REGISTERS**2 / sum(map(POWERS.__getitem__, registers))
+        zeros = registers.count(0)
+        # Small sets leave registers empty, which linear counting handles
+        # better.
+        if estimate <= 2.5 * REGISTERS and zeros:
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        """
+        The registers, for storing. Sketches with only a few registers set are
+        stored as 3 bytes for each of those (its index and value) instead.
+        """
+        used = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if len(used) * 3 >= REGISTERS:
+            return bytes(self.registers)
+        return b"".join(
+            index.to_bytes(2, "big") + bytes((rank,)) for index, rank in used
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        # REGISTERS isn't a multiple of 3, so the formats can't be mistaken
+        # for each other.
+        if len(data) == REGISTERS:
+            return cls(data)
+        sketch = cls()
+        for start in range(0, len(data), 3):
+            index = int.from_bytes(data[start : start + 2], "big")
+            sketch.registers[index] = data[start + 2]
+        return sketch
+
+
+def add_edit(sketches, username, domain, page_title, rev_id):
+    """
+    Add an edit to the users, pages and revisions sketches of its hashtag for
+    the day.
+    """
+    users, pages, revisions = sketches
+    users.add(username)
+    # Domains can't contain a colon, so this is unique to each page.
+    pages.add(domain + ":" + page_title)
+    # Log actions have no revision.
+    if rev_id is not None:
+        revisions.add(rev_id)
@@ -0,0 +1,133 @@
+import functools
+
+import mwapi
+
+from media_cache import MISSING
+
+API_REQUEST_TIMEOUT_S = 10.0
+
+# An arbitrary limit to how many times we follow the "continue" response in
+# imageinfo requests. See https://github.com/WikipediaLibrary/hashtags/issues/64
+# for details.
+MAX_IMAGEINFO_CONTINUES = 50
+
+
+@functools.lru_cache(maxsize=None)
+def get_wiki_session(domain):
+    return mwapi.Session(
+        "https://{}/".format(domain), "hashtags", timeout=API_REQUEST_TIMEOUT_S
+    )
+
+
+def query_media_in_revision(session, rev_id):
+    images_args = {
+        "action": "parse",
+        "prop": "images",
+        "oldid": rev_id,
+    }
+    try:
+        media_filenames = set(session.get(**images_args)["parse"]["images"])
+    except mwapi.errors.APIError as e:
+        if e.code == "nosuchrevid":
+            # Deleted page?
+            pass
+        raise
+    return media_filenames
+
+
+def query_media_types(session, media_filenames, cache=None, domain=None):
+    """
+    Return the set of media types of the given files. If a MediaTypeCache is
+    given, files it knows about on `domain` aren't looked up again.
+    """
+
+    def query_imageinfo(titles, iistart=None):
+        imageinfo_args = {
+            "action": "query",
+            "prop": "imageinfo",
+            "titles": "|".join(titles),
+            "iiprop": "mediatype|url",
+        }
+        if iistart is not None:
+            imageinfo_args["iistart"] = iistart
+        return session.get(**imageinfo_args)
+
+    media_types = set()
+    media_filenames = list(media_filenames)
+    if cache is not None:
+        uncached_filenames = []
+        for filename in media_filenames:
+            media_type = cache.get(domain, filename)
+            if media_type is MISSING:
+                uncached_filenames.append(filename)
+            elif media_type is not None:
+                media_types.add(media_type)
+        media_filenames = uncached_filenames
+
+    while media_filenames:
+        iistart = None
+        # Query the API 50 files at a time.
+        # See https://www.mediawiki.org/wiki/API:Query for this limit.
+        batch = media_filenames[:50]
+        titles = ["File:" + f for f in batch]
+        # The API may normalize the titles we ask for (e.g. replacing
+        # underscores with spaces), so keep track of which file each title
+        # in the result belongs to.
+        filename_for_title = dict(zip(titles, batch))
+        batch_media_types = dict.fromkeys(batch)
+        for _ in range(MAX_IMAGEINFO_CONTINUES):
+            result = query_imageinfo(titles, iistart)
+            for n in result["query"].get("normalized", []):
+                if n["from"] in filename_for_title:
+                    filename_for_title[n["to"]] = filename_for_title[n["from"]]
+            for m in result["query"]["pages"].values():
+                if "imageinfo" not in m:
+                    # Broken link
+                    continue
+                if "mediatype" not in m["imageinfo"][0]:
+                    # Probably filehidden?
+                    continue
+                media_type = m["imageinfo"][0]["mediatype"]
+                media_types.add(media_type)
+                if m.get("title") in filename_for_title:
+                    batch_media_types[filename_for_title[m["title"]]] = media_type
+            if "continue" in result:
+                iistart = result["continue"]["iistart"]
+            else:
+                # We've seen every file in the batch, so those we haven't
+                # found a media type for can be cached as not having one.
+                if cache is not None:
+                    for filename, media_type in batch_media_types.items():
+                        cache.set(domain, filename, media_type)
+                break
+        else:
+            print("Too many imageinfo continues, moving on!")
+        media_filenames = media_filenames[50:]
+    return media_types
+
+
+def populate_media_information(change, get_session=get_wiki_session, cache=None):
+    change["has_image"] = False
+    change["has_video"] = False
+    change["has_audio"] = False
+    if "revision" not in change:
+        return
+    new_rev = change["revision"]["new"]
+    old_rev = change["revision"].get("old", None)
+
+    try:
+        domain = change["meta"]["domain"]
+        session = get_session(domain)
+        new_media = query_media_in_revision(session, new_rev)
+        old_media = set()
+        if new_media and old_rev is not None:
+            old_media = query_media_in_revision(session, old_rev)
+
+        added_media = new_media - old_media
+        if added_media:
+            added_media_types = query_media_types(session, added_media, cache, domain)
+            change["has_image"] = bool(set(["DRAWING", "BITMAP"]) & added_media_types)
+            change["has_video"] = "VIDEO" in added_media_types
+            change["has_audio"] = "AUDIO" in added_media_types
+    except Exception as e:
+        print("Failed to query media: {}. Change: {}".format(e, change))
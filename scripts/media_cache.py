@@ -0,0 +1,143 @@
+import collections
+import sqlite3
+import threading
+import time
+
+# The same popular files get added to many pages (e.g. during Wiki Loves
+# Monuments), so we remember the media type of files we've looked up.
+MEDIA_CACHE_MAX_SIZE = 20000
+MEDIA_CACHE_TTL_S = 24 * 60 * 60
+
+# When the cache is saved to disk, new entries are committed in batches of
+# this size rather than one at a time. Expired entries are deleted, and the
+# file kept to max_size entries, with each batch.
+MEDIA_CACHE_COMMIT_EVERY = 100
+
+# Returned by MediaTypeCache.get() for files it doesn't know about. Files
+# without a media type (broken links, hidden files) are cached as None.
+MISSING = object()
+
+CREATE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS media_types
+    (domain TEXT, filename TEXT, media_type TEXT, expires REAL,
+    PRIMARY KEY (domain, filename))
+    """
+
+CREATE_INDEX_QUERY = """
+    CREATE INDEX IF NOT EXISTS media_types_expires ON media_types (expires)
+    """
+
+# Entries expire a fixed time after they're looked up, so the ones expiring
+# last are also the ones looked up most recently, which we keep.
+PRUNE_QUERY = """
+    DELETE FROM media_types
+    WHERE expires <= ? OR expires < (
+        SELECT expires FROM media_types ORDER BY expires DESC LIMIT 1 OFFSET ?
+    )
+    """
+
+
+class MediaTypeCache:
+    """
+    A bounded, least-recently-used cache of the media type of files on each
+    wiki, keyed by (domain, filename). Entries expire ttl_s seconds after they
+    were looked up.
+
+    If `path` is given, entries are also stored in an SQLite database at that
+    path and loaded from it on startup, so the cache survives restarts.
+
+    `stats` counts hits, misses, evictions (entries dropped to keep the cache
+    within max_size) and expired entries.
+    """
+
+    def __init__(
+        self,
+        max_size=MEDIA_CACHE_MAX_SIZE,
+        ttl_s=MEDIA_CACHE_TTL_S,
+        path=None,
+        clock=time.time,
+        commit_every=MEDIA_CACHE_COMMIT_EVERY,
+    ):
+        self.max_size = max_size
+        self.commit_every = commit_every
+        self.ttl_s = ttl_s
+        self.clock = clock
+        # (domain, filename) -> (media type, expiry time), least recently
+        # used first.
+        self.entries = collections.OrderedDict()
+        self.stats = collections.Counter()
+        # The cache is shared by the media lookup worker threads.
+        self.lock = threading.Lock()
+
+        self.db = None
+        self.uncommitted = 0
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(CREATE_TABLE_QUERY)
+            self.db.execute(CREATE_INDEX_QUERY)
+            self._load()
+
+    def _commit(self):
+        self.db.execute(PRUNE_QUERY, (self.clock(), self.max_size - 1))
+        self.db.commit()
+        self.uncommitted = 0
+
+    def _load(self):
+        self._commit()
+        # Load the most recently looked up entries last, so that they're
+        # treated as the most recently used.
+        rows = self.db.execute(
+            """
+            SELECT domain, filename, media_type, expires FROM (
+                SELECT * FROM media_types ORDER BY expires DESC LIMIT ?
+            ) ORDER BY expires
+            """,
+            (self.max_size,),
+        )
+        for domain, filename, media_type, expires in rows:
+            self.entries[(domain, filename)] = (media_type, expires)
+
+    def get(self, domain, filename):
+        key = (domain, filename)
+        with self.lock:
+            if key not in self.entries:
+                self.stats["misses"] += 1
+                return MISSING
+            media_type, expires = self.entries[key]
+            if expires <= self.clock():
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return media_type
+
+    def set(self, domain, filename, media_type):
+        key = (domain, filename)
+        expires = self.clock() + self.ttl_s
+        with self.lock:
+            self.entries[key] = (media_type, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO media_types VALUES (?, ?, ?, ?)",
+                    (domain, filename, media_type, expires),
+                )
+                self.uncommitted += 1
+                if self.uncommitted >= self.commit_every:
+                    self._commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self._commit()
+                self.db.close()
+                self.db = None
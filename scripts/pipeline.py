@@ -0,0 +1,389 @@
+import collections
+import concurrent.futures
+import json
+import queue
+import threading
+import time
+
+from common import extractor, might_have_hashtags, valid_edit
+from media import get_wiki_session, populate_media_information
+
+# orjson decodes events several times faster than the json module. It's
+# optional; install it in the scripts container to use it.
+try:
+    import orjson
+
+    decode_json = orjson.loads
+except ImportError:
+    decode_json = json.loads
+
+# How many raw events we hold between reading the stream and filtering them.
+EVENT_QUEUE_SIZE = 1000
+
+# How many matching changes can be waiting for media information or for the
+# writer. Once this is full we stop reading the stream until the writer
+# catches up.
+CHANGE_QUEUE_SIZE = 200
+
+# Media lookups run in a pool of worker threads, with a limit on how many run
+# against a single wiki at once so that one slow wiki can't occupy them all.
+MEDIA_WORKERS = 8
+MEDIA_WORKERS_PER_DOMAIN = 2
+
+# How often blocked stages wake up to check whether the pipeline is stopping,
+# and how often the writer checks for buffered rows that are due to be
+# flushed while no changes are coming in.
+POLL_INTERVAL_S = 0.5
+
+# How often the filter stage tells the writer how far through the stream it
+# has got, when no hashtags are passing through to do so.
+PROGRESS_INTERVAL_S = 1
+
+# How often the collector prints its running totals.
+STATS_INTERVAL_S = 600
+
+# Marks the end of the stream in the queues between stages.
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """
+    Raised inside a stage when another stage has failed or the pipeline is
+    being shut down.
+    """
+
+
+class _CountingSession:
+    """
+    Wraps an mwapi.Session to count the API requests made through it.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.requests = 0
+
+    def get(self, **params):
+        self.requests += 1
+        return self.session.get(**params)
+
+
+class MediaEnricher:
+    """
+    Looks up media information for changes on a pool of worker threads.
+
+    The lookups are done once per change, however many hashtags it logs, and
+    `stats` keeps count of the API requests made and of those saved by sharing
+    the result between a change's hashtags. If a MediaTypeCache is given,
+    files whose media type it knows aren't looked up again.
+
+    Changes beyond the per-domain limit wait here rather than in the pool, so
+    that a slow wiki only holds up its own changes and never occupies workers
+    that changes for other wikis could use.
+    """
+
+    def __init__(
+        self,
+        get_session=get_wiki_session,
+        max_workers=MEDIA_WORKERS,
+        max_per_domain=MEDIA_WORKERS_PER_DOMAIN,
+        cache=None,
+    ):
+        self.get_session = get_session
+        self.cache = cache
+        self.max_per_domain = max_per_domain
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="media"
+        )
+        self.lock = threading.Lock()
+        self.running = collections.Counter()
+        self.waiting = collections.defaultdict(collections.deque)
+        self.stats = collections.Counter()
+
+    def submit(self, change, shared_by=1):
+        """
+        Queue a change for media lookups. Returns a Future that resolves to
+        the change once its has_image, has_video and has_audio are set.
+        `shared_by` is the number of hashtag rows that will use the result.
+        """
+        future = concurrent.futures.Future()
+        domain = change["meta"]["domain"]
+        with self.lock:
+            if self.running[domain] < self.max_per_domain:
+                self.running[domain] += 1
+                self.executor.submit(self._enrich, domain, change, shared_by, future)
+            else:
+                self.waiting[domain].append((change, shared_by, future))
+        return future
+
+    def _enrich(self, domain, change, shared_by, future):
+        session = None
+
+        def get_session(domain):
+            nonlocal session
+            session = _CountingSession(self.get_session(domain))
+            return session
+
+        try:
+            populate_media_information(change, get_session, self.cache)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(change)
+        finally:
+            with self.lock:
+                requests = session.requests if session is not None else 0
+                self.stats["lookups"] += 1
+                self.stats["requests"] += requests
+                # Looking up media per hashtag would have repeated the same
+                # requests for every other hashtag in the change.
+                self.stats["requests_saved"] += requests * (shared_by - 1)
+                if self.waiting[domain]:
+                    self.executor.submit(
+                        self._enrich, domain, *self.waiting[domain].popleft()
+                    )
+                else:
+                    del self.waiting[domain]
+                    self.running[domain] -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Pipeline:
+    """
+    Collects hashtags from a stream of EventStream events and writes them
+    using a db.BufferedWriter (or anything with the same add, maybe_flush and
+    flush methods).
+
+    The work is split into stages running in their own threads and joined by
+    bounded queues:
+
+    1. reading events from the stream,
+    2. decoding them and filtering out changes without valid hashtags,
+    3. looking up media information, on a MediaEnricher's worker pool,
+    4. writing rows to the database.
+
+    Changes reach the writer in the order they were read from the stream,
+    whichever order their media lookups finish in, and all of a change's rows
+    are added together. When the writer falls behind, the queues fill up and
+    the earlier stages wait for it.
+
+    Because of that ordering, once the writer has added a change's rows every
+    earlier event has been dealt with, and it passes the event's ID on to the
+    writer's set_checkpoint().
+
+    With record_latencies, `latencies` collects how long each event took to
+    get through the filter stage (from being read) and how long each change
+    then waited for its media information, in seconds.
+    """
+
+    def __init__(
+        self,
+        writer,
+        enricher=None,
+        event_queue_size=EVENT_QUEUE_SIZE,
+        change_queue_size=CHANGE_QUEUE_SIZE,
+        record_latencies=False,
+    ):
+        self.writer = writer
+        self.enricher = enricher if enricher is not None else MediaEnricher()
+        self.events = queue.Queue(maxsize=event_queue_size)
+        self.changes = queue.Queue(maxsize=change_queue_size)
+        self.stopping = threading.Event()
+        self.errors = []
+        self.stats = collections.Counter()
+        self.latencies = collections.defaultdict(list) if record_latencies else None
+
+    def run(self, events):
+        """
+        Process events until the stream ends, then write everything still
+        buffered. If any stage fails, the pipeline stops and the error is
+        raised here.
+        """
+        stages = [
+            threading.Thread(target=self._stage, args=(self.read, events), name="read"),
+            threading.Thread(target=self._stage, args=(self.filter,), name="filter"),
+            threading.Thread(target=self._stage, args=(self.write,), name="write"),
+        ]
+        # Reading the stream can block on the network indefinitely, so we
+        # don't want these threads to keep the collector alive on exit.
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        try:
+            # Joining with a timeout keeps the main thread responsive to
+            # signals such as SIGTERM.
+            for stage in stages:
+                while stage.is_alive():
+                    stage.join(timeout=1)
+        except BaseException:
+            self.stop()
+            stages[-1].join()
+            raise
+        finally:
+            self.enricher.shutdown()
+            self.report()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def report(self):
+        stats = self.stats + self.enricher.stats
+        print(
+            "Read {events} events and logged {hashtags} hashtags from "
+            "{changes} changes. Made {requests} media API requests, saving "
+            "{requests_saved} by sharing them between hashtags.".format(
+                events=stats["events"],
+                hashtags=stats["hashtags"],
+                changes=stats["changes"],
+                requests=stats["requests"],
+                requests_saved=stats["requests_saved"],
+            )
+        )
+        cache = self.enricher.cache
+        if cache is not None:
+            print(
+                "Media type cache: {size} files, {hits} hits, {misses} misses, "
+                "{evictions} evictions, {expired} expired.".format(
+                    size=len(cache),
+                    hits=cache.stats["hits"],
+                    misses=cache.stats["misses"],
+                    evictions=cache.stats["evictions"],
+                    expired=cache.stats["expired"],
+                )
+            )
+
+    def stop(self):
+        self.stopping.set()
+
+    def _stage(self, target, *args):
+        try:
+            target(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self.errors.append(e)
+            self.stop()
+
+    def _put(self, queue_, item):
+        while True:
+            if self.stopping.is_set():
+                raise _Stopped()
+            try:
+                queue_.put(item, timeout=POLL_INTERVAL_S)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, queue_):
+        while True:
+            if self.stopping.is_set():
+                raise _Stopped()
+            try:
+                return queue_.get(timeout=POLL_INTERVAL_S)
+            except queue.Empty:
+                continue
+
+    def read(self, events):
+        for event in events:
+            if event.event == "message":
+                self.stats["events"] += 1
+                self._put(self.events, (time.monotonic(), event))
+        self._put(self.events, _DONE)
+
+    def filter(self):
+        last_event_id = None
+        last_put = time.monotonic()
+        while True:
+            item = self._get(self.events)
+            if item is _DONE:
+                break
+            read_time, event = item
+            if event.id is not None:
+                last_event_id = event.id
+
+            # Most events can be ruled out without decoding them.
+            change = {}
+            if might_have_hashtags(event.data):
+                try:
+                    change = decode_json(event.data)
+                except ValueError:
+                    pass
+
+            hashtags = self.matching_hashtags(change)
+            now = time.monotonic()
+            if self.latencies is not None:
+                self.latencies["filter"].append(now - read_time)
+            if hashtags:
+                # One set of media lookups serves all of the change's hashtags.
+                future = self.enricher.submit(change, shared_by=len(hashtags))
+                self._put(self.changes, (last_event_id, hashtags, future, now))
+                last_put = now
+            elif now - last_put >= PROGRESS_INTERVAL_S:
+                # Nothing to write, but let the writer know how far we've got.
+                self._put(self.changes, (last_event_id, [], None, now))
+                last_put = now
+        self._put(self.changes, (last_event_id, [], None, time.monotonic()))
+        self._put(self.changes, _DONE)
+
+    def matching_hashtags(self, change):
+        """
+        Return the valid hashtags in a change we want to log, or an empty list.
+        """
+        if "comment" not in change:
+            return []
+        # A hashtag repeated in the summary is still only logged once.
+        hashtags = extractor.extract(change["comment"])
+        if not hashtags or not valid_edit(change):
+            return []
+        if "id" not in change:
+            print("Couldn't find recent changes ID in data. Skipping.")
+            return []
+        # Likely a suppressed username.
+        if "user" not in change:
+            print("Couldn't find user in data. Skipping.")
+            return []
+
+        # Check edit_summary length, truncate if necessary
+        if len(change["comment"]) > 800:
+            change["comment"] = change["comment"][:799]
+        return hashtags
+
+    def write(self):
+        last_report = time.monotonic()
+        try:
+            while not self.stopping.is_set():
+                if time.monotonic() - last_report >= STATS_INTERVAL_S:
+                    self.report()
+                    last_report = time.monotonic()
+                try:
+                    item = self.changes.get(timeout=POLL_INTERVAL_S)
+                except queue.Empty:
+                    self.writer.maybe_flush()
+                    continue
+                if item is _DONE:
+                    break
+
+                event_id, hashtags, future, filtered_time = item
+                if future is not None:
+                    change = self._wait(future)
+                    if self.latencies is not None:
+                        self.latencies["media"].append(time.monotonic() - filtered_time)
+                    self.stats["changes"] += 1
+                    for hashtag in hashtags:
+                        self.writer.add(hashtag, change)
+                        self.stats["hashtags"] += 1
+                self.writer.set_checkpoint(event_id)
+                self.writer.maybe_flush()
+        finally:
+            self.writer.flush()
+
+    def _wait(self, future):
+        while True:
+            if self.stopping.is_set():
+                raise _Stopped()
+            try:
+                return future.result(timeout=POLL_INTERVAL_S)
+            except concurrent.futures.TimeoutError:
+                continue
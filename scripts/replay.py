@@ -0,0 +1,416 @@
+"""
+Replays recorded EventStream events through the collector pipeline and
+reports its throughput, so that changes to the collector can be measured
+without the live stream or the production database.
+
+Record some events from the live stream (one recentchange event per line):
+
+    python replay.py record events.jsonl --events 100000
+
+Then replay them, as fast as possible, into an SQLite database:
+
+    python replay.py run events.jsonl --sqlite /tmp/hashtags.sqlite3
+
+or at ten times the rate they originally happened, into the MySQL database
+the collector normally uses:
+
+    python replay.py run events.jsonl --mysql --rate 10
+
+Media lookups are skipped unless --media is given, in which case they're
+made against the live wikis.
+
+To time just the hashtag extraction on the recorded edit summaries:
+
+    python replay.py extract events.jsonl
+
+or the CPU time the filter stage spends per 1,000 events, with and without
+checking the raw event data before decoding it:
+
+    python replay.py filter events.jsonl
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import sqlite3
+import statistics
+import sys
+import time
+import timeit
+
+from sseclient import Event, SSEClient as EventSource
+
+import db
+from common import extractor, might_have_hashtags
+from collect_hashtags import base_stream_url
+from pipeline import MediaEnricher, Pipeline, decode_json
+
+# The collector's tables. Like MySQL, SQLite is told to compare hashtag names
+# without regard to case.
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hashtags_tag (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR(128) NOT NULL UNIQUE COLLATE NOCASE,
+        watermark INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS hashtags_edit (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        domain VARCHAR(32) NOT NULL,
+        timestamp DATETIME NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        page_title VARCHAR(500) NOT NULL,
+        edit_summary VARCHAR(800) NOT NULL,
+        rc_id INTEGER NOT NULL,
+        rev_id INTEGER NULL,
+        has_image BOOL NOT NULL,
+        has_video BOOL NOT NULL,
+        has_audio BOOL NOT NULL,
+        UNIQUE (domain, rc_id)
+    );
+    CREATE TABLE IF NOT EXISTS hashtags_edittag (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tag_id INTEGER NOT NULL REFERENCES hashtags_tag (id),
+        edit_id INTEGER NOT NULL REFERENCES hashtags_edit (id),
+        timestamp DATETIME NOT NULL,
+        UNIQUE (tag_id, edit_id)
+    );
+    CREATE TABLE IF NOT EXISTS hashtags_dailydomainedits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tag_id INTEGER NOT NULL REFERENCES hashtags_tag (id),
+        day DATE NOT NULL,
+        domain VARCHAR(32) NOT NULL,
+        edits INTEGER NOT NULL,
+        UNIQUE (tag_id, day, domain)
+    );
+    CREATE TABLE IF NOT EXISTS hashtags_dailyuseredits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tag_id INTEGER NOT NULL REFERENCES hashtags_tag (id),
+        day DATE NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        edits INTEGER NOT NULL,
+        UNIQUE (tag_id, day, username)
+    );
+    CREATE TABLE IF NOT EXISTS hashtags_dailysketch (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tag_id INTEGER NOT NULL REFERENCES hashtags_tag (id),
+        day DATE NOT NULL,
+        users BLOB NOT NULL,
+        pages BLOB NOT NULL,
+        revisions BLOB NOT NULL,
+        UNIQUE (tag_id, day)
+    );
+    CREATE TABLE IF NOT EXISTS hashtags_streamcheckpoint (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        stream VARCHAR(64) NOT NULL UNIQUE,
+        last_event_id TEXT NOT NULL,
+        updated DATETIME NOT NULL
+    );
+    """
+
+
+class SQLiteWriter(db.BufferedWriter):
+    """
+    A BufferedWriter for an SQLite database with the collector's tables.
+    """
+
+    insert_tags_query = """
+        INSERT INTO hashtags_tag (name, watermark)
+        VALUES (?, 0)
+        ON CONFLICT (name) DO NOTHING
+        """
+    insert_edits_query = """
+        INSERT OR IGNORE INTO hashtags_edit
+        (domain, timestamp, username, page_title,
+        edit_summary, rc_id, rev_id, has_image, has_video, has_audio)
+        VALUES
+        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+    insert_links_query = db.INSERT_LINKS_QUERY.replace(
+        "INSERT IGNORE", "INSERT OR IGNORE"
+    )
+    rollup_queries = (
+        db.ROLLUP_DOMAINS_QUERY.replace(
+            "ON DUPLICATE KEY UPDATE edits = hashtags_dailydomainedits.edits",
+            "ON CONFLICT (tag_id, day, domain) DO UPDATE SET edits = edits",
+        ).replace("VALUES(edits)", "excluded.edits"),
+        db.ROLLUP_USERS_QUERY.replace(
+            "ON DUPLICATE KEY UPDATE edits = hashtags_dailyuseredits.edits",
+            "ON CONFLICT (tag_id, day, username) DO UPDATE SET edits = edits",
+        ).replace("VALUES(edits)", "excluded.edits"),
+    )
+    # SQLite only has one writer at a time, so it doesn't need to lock rows.
+    select_sketches_query = db.SELECT_SKETCHES_QUERY.replace("FOR UPDATE", "")
+    upsert_sketches_query = """
+        INSERT INTO hashtags_dailysketch (tag_id, day, users, pages, revisions)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (tag_id, day) DO UPDATE SET
+        users = excluded.users, pages = excluded.pages,
+        revisions = excluded.revisions
+        """
+    # SQLite stores the timestamps as the strings we give it.
+    link_values = "SELECT ? AS tag_id, ? AS domain, ? AS rc_id, ? AS timestamp"
+    name_values = "SELECT ? AS name"
+    placeholder = "?"
+    checkpoint_query = """
+        INSERT OR REPLACE INTO hashtags_streamcheckpoint
+        (stream, last_event_id, updated)
+        VALUES
+        (?, ?, datetime('now'))
+        """
+    row_errors = (sqlite3.IntegrityError,)
+
+    def skip_row(self, row, error):
+        print("Skipped rc_id {rc_id} due to integrity error".format(rc_id=row[6]))
+
+
+class WriteTimer:
+    """
+    Counts the rows a writer inserts and times how long each row waits
+    between being added and being committed.
+    """
+
+    def __init__(self, writer):
+        self.inserted = 0
+        self.latencies = []
+        self.waiting_since = []
+        # The writer flushes itself from add() and maybe_flush(), so wrap
+        # the methods on the writer itself rather than proxying it.
+        self._add = writer.add
+        self._flush = writer.flush
+        writer.add = self.add
+        writer.flush = self.flush
+
+    def add(self, hashtag, change):
+        self.waiting_since.append(time.monotonic())
+        self._add(hashtag, change)
+
+    def flush(self):
+        inserted = self._flush()
+        self.inserted += inserted
+        now = time.monotonic()
+        self.latencies.extend(now - added for added in self.waiting_since)
+        self.waiting_since = []
+        return inserted
+
+
+class NoMedia:
+    """
+    Stands in for a MediaEnricher when we aren't looking up media, marking
+    every change as adding none.
+    """
+
+    cache = None
+
+    def __init__(self):
+        self.stats = collections.Counter()
+
+    def submit(self, change, shared_by=1):
+        change["has_image"] = False
+        change["has_video"] = False
+        change["has_audio"] = False
+        future = concurrent.futures.Future()
+        future.set_result(change)
+        return future
+
+    def shutdown(self):
+        pass
+
+
+def parse_dt(change):
+    try:
+        return datetime.datetime.fromisoformat(change["meta"]["dt"][:19])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def recorded_events(path, rate=None):
+    """
+    Yield the events recorded in a file, one recentchange event per line. If
+    a rate is given, events are spaced out as they originally happened,
+    sped up by that factor.
+    """
+    start_time = None
+    start_dt = None
+    with open(path) as recording:
+        for line_number, line in enumerate(recording, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if rate:
+                dt = parse_dt(json.loads(line))
+                if dt is not None:
+                    if start_dt is None:
+                        start_time, start_dt = time.monotonic(), dt
+                    due = start_time + (dt - start_dt).total_seconds() / rate
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+            yield Event(data=line, id=str(line_number))
+
+
+def percentiles(latencies):
+    """
+    Format the 50th, 90th and 99th percentile of a list of latencies, in
+    milliseconds.
+    """
+    if len(latencies) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(latencies, n=100)
+    return "p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms".format(
+        cuts[49] * 1000, cuts[89] * 1000, cuts[98] * 1000
+    )
+
+
+def run(args):
+    if args.sqlite:
+        connection = sqlite3.connect(args.sqlite, check_same_thread=False)
+        connection.executescript(SQLITE_SCHEMA)
+        writer = SQLiteWriter(connection, stream="replay")
+    else:
+        writer = db.BufferedWriter(stream="replay")
+    timer = WriteTimer(writer)
+    enricher = MediaEnricher() if args.media else NoMedia()
+    pipeline = Pipeline(writer, enricher, record_latencies=True)
+
+    start = time.monotonic()
+    pipeline.run(recorded_events(args.recording, args.rate))
+    elapsed = time.monotonic() - start
+
+    stats = pipeline.stats
+    print("Replayed {} events in {:.2f} s".format(stats["events"], elapsed))
+    print("  events:           {:10.1f} /s".format(stats["events"] / elapsed))
+    print("  matched hashtags: {:10.1f} /s".format(stats["hashtags"] / elapsed))
+    print("  database rows:    {:10.1f} /s".format(timer.inserted / elapsed))
+    print("Latency")
+    print("  filter: " + percentiles(pipeline.latencies["filter"]))
+    print("  media:  " + percentiles(pipeline.latencies["media"]))
+    print("  write:  " + percentiles(timer.latencies))
+
+
+def extract(args):
+    comments = []
+    with open(args.recording) as recording:
+        for line in recording:
+            if line.strip():
+                comment = json.loads(line).get("comment")
+                if isinstance(comment, str):
+                    comments.append(comment)
+    if not comments:
+        print("No edit summaries in the recording")
+        return
+
+    def extract_all():
+        for comment in comments:
+            extractor.extract(comment)
+
+    matched = sum(len(extractor.extract(comment)) for comment in comments)
+    elapsed = min(timeit.repeat(extract_all, number=1, repeat=args.repeat))
+    print(
+        "Extracted {} hashtags from {} edit summaries in {:.3f} s".format(
+            matched, len(comments), elapsed
+        )
+    )
+    print(
+        "  {:.0f} summaries/s, {:.2f} us per summary".format(
+            len(comments) / elapsed, elapsed / len(comments) * 1e6
+        )
+    )
+
+
+def filter_cpu(args):
+    with open(args.recording) as recording:
+        events = [line.strip() for line in recording if line.strip()]
+    if not events:
+        print("No events in the recording")
+        return
+    pipeline = Pipeline(None, NoMedia())
+
+    def decode_all():
+        for data in events:
+            pipeline.matching_hashtags(json.loads(data))
+
+    def prefilter_all():
+        for data in events:
+            if might_have_hashtags(data):
+                pipeline.matching_hashtags(decode_json(data))
+
+    print("CPU time per 1,000 events, best of {}:".format(args.repeat))
+    for name, target in (("decode all", decode_all), ("pre-filter", prefilter_all)):
+        cpu_time = min(
+            timeit.repeat(target, number=1, repeat=args.repeat, timer=time.process_time)
+        )
+        print("  {:12}{:8.2f} ms".format(name, cpu_time / len(events) * 1000 * 1000))
+    decoded = sum(1 for data in events if might_have_hashtags(data))
+    print("Pre-filter passed {} of {} events".format(decoded, len(events)))
+
+
+def record(args):
+    written = 0
+    with open(args.recording, "w") as recording:
+        for event in EventSource(base_stream_url, timeout=(3.05, 7)):
+            if event.event != "message" or not event.data:
+                continue
+            recording.write(event.data.strip() + "\n")
+            written += 1
+            if written >= args.events:
+                break
+    print("Recorded {} events".format(written))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Replay recorded events.")
+    run_parser.add_argument("recording", help="File of recorded events.")
+    sink = run_parser.add_mutually_exclusive_group(required=True)
+    sink.add_argument("--sqlite", help="Write to the SQLite database at this path.")
+    sink.add_argument(
+        "--mysql", action="store_true", help="Write to the collector's database."
+    )
+    run_parser.add_argument(
+        "--rate",
+        type=float,
+        help="Replay at this multiple of the original rate, rather than as "
+        "fast as possible.",
+    )
+    run_parser.add_argument(
+        "--media", action="store_true", help="Look up media on the live wikis."
+    )
+    run_parser.set_defaults(func=run)
+
+    extract_parser = subparsers.add_parser(
+        "extract", help="Time hashtag extraction on recorded edit summaries."
+    )
+    extract_parser.add_argument("recording", help="File of recorded events.")
+    extract_parser.add_argument(
+        "--repeat", type=int, default=5, help="Report the best of this many runs."
+    )
+    extract_parser.set_defaults(func=extract)
+
+    filter_parser = subparsers.add_parser(
+        "filter", help="Time the filter stage on recorded events."
+    )
+    filter_parser.add_argument("recording", help="File of recorded events.")
+    filter_parser.add_argument(
+        "--repeat", type=int, default=5, help="Report the best of this many runs."
+    )
+    filter_parser.set_defaults(func=filter_cpu)
+
+    record_parser = subparsers.add_parser(
+        "record", help="Record events from the live stream."
+    )
+    record_parser.add_argument("recording", help="File to write events to.")
+    record_parser.add_argument(
+        "--events", type=int, default=10000, help="How many events to record."
+    )
+    record_parser.set_defaults(func=record)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
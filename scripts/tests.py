@@ -0,0 +1,855 @@
+"""
+Tests for the hashtag collector. These don't need a database or network
+access; run them from this directory with `python -m unittest tests`.
+"""
+
+import collections
+import http.server
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+
+import mwapi
+from sseclient import Event
+
+import db
+from hll import REGISTERS, HyperLogLog
+from common import (
+    HashtagExtractor,
+    hashtag_match,
+    might_have_hashtags,
+    valid_hashtag,
+)
+import replay
+from media_cache import MISSING, MediaTypeCache
+from pipeline import MediaEnricher, Pipeline
+
+
+class FakeMediaWiki:
+    """
+    Serves just enough of the MediaWiki action API on localhost for the media
+    lookups, with each wiki under its own path. Requests to the wikis in
+    `delays` are answered after that many seconds.
+    """
+
+    def __init__(self, revisions, media_types, delays=None):
+        # {(domain, rev_id): [filename, ...]} and {filename: mediatype}
+        self.revisions = revisions
+        self.media_types = media_types
+        self.delays = delays or {}
+        self.requests = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.max_in_flight = collections.Counter()
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                domain = url.path.split("/")[1]
+                params = dict(urllib.parse.parse_qsl(url.query))
+                body = json.dumps(fake.respond(domain, params)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_session(self, domain):
+        return mwapi.Session(
+            "http://127.0.0.1:{}".format(self.server.server_port),
+            "hashtags tests",
+            api_path="/{}/api.php".format(domain),
+        )
+
+    def respond(self, domain, params):
+        with self.lock:
+            self.requests[domain] += 1
+            self.in_flight[domain] += 1
+            self.max_in_flight[domain] = max(
+                self.max_in_flight[domain], self.in_flight[domain]
+            )
+        try:
+            time.sleep(self.delays.get(domain, 0))
+            if params["action"] == "parse":
+                key = (domain, int(params["oldid"]))
+                if key not in self.revisions:
+                    return {"error": {"code": "nosuchrevid", "info": ""}}
+                return {"parse": {"images": self.revisions[key]}}
+
+            pages = {}
+            normalized = []
+            for i, title in enumerate(params["titles"].split("|")):
+                if "_" in title:
+                    normalized.append({"from": title, "to": title.replace("_", " ")})
+                    title = title.replace("_", " ")
+                filename = title[len("File:") :]
+                page = {"title": title}
+                if filename in self.media_types:
+                    page["imageinfo"] = [{"mediatype": self.media_types[filename]}]
+                pages[str(-1 - i)] = page
+            return {"query": {"normalized": normalized, "pages": pages}}
+        finally:
+            with self.lock:
+                self.in_flight[domain] -= 1
+
+
+class FakeWriter:
+    def __init__(self, on_add=None):
+        self.rows = []
+        self.checkpoints = []
+        self.flushed = False
+        self.on_add = on_add
+
+    def add(self, hashtag, change):
+        if self.on_add is not None:
+            self.on_add()
+        self.rows.append(
+            (
+                hashtag,
+                change["id"],
+                change["has_image"],
+                change["has_video"],
+                change["has_audio"],
+            )
+        )
+
+    def set_checkpoint(self, event_id):
+        if event_id is not None and event_id not in self.checkpoints:
+            self.checkpoints.append(event_id)
+
+    def maybe_flush(self):
+        pass
+
+    def flush(self):
+        self.flushed = True
+
+
+def make_change(rc_id, comment, domain="en.wikipedia.org", revision=None, **kwargs):
+    change = {
+        "id": rc_id,
+        "comment": comment,
+        "bot": False,
+        "user": "Example",
+        "title": "Example page",
+        "meta": {"domain": domain, "dt": "2024-04-04T16:41:00Z"},
+    }
+    if revision is not None:
+        change["revision"] = {"new": revision, "old": revision - 1}
+    change.update(kwargs)
+    return change
+
+
+def make_events(changes):
+    return [Event(data=json.dumps(change), id=str(change["id"])) for change in changes]
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.wiki = FakeMediaWiki(
+            revisions={
+                ("en.wikipedia.org", 10): ["Old.jpg"],
+                ("en.wikipedia.org", 11): ["Old.jpg", "New.jpg"],
+                ("slow.wikipedia.org", 20): [],
+                ("slow.wikipedia.org", 21): ["Song.ogg"],
+            },
+            media_types={
+                "Old.jpg": "BITMAP",
+                "New.jpg": "BITMAP",
+                "Song.ogg": "AUDIO",
+            },
+            delays={"slow.wikipedia.org": 0.2},
+        )
+        self.addCleanup(self.wiki.close)
+
+    def run_pipeline(self, changes, writer=None, **kwargs):
+        writer = writer if writer is not None else FakeWriter()
+        enricher = MediaEnricher(self.wiki.get_session)
+        Pipeline(writer, enricher, **kwargs).run(make_events(changes))
+        return writer
+
+    def test_writes_hashtags_with_media(self):
+        writer = self.run_pipeline(
+            [
+                make_change(1, "#one and #two", revision=11),
+                make_change(2, "no hashtags here", revision=11),
+                make_change(3, "#three", domain="slow.wikipedia.org", revision=21),
+            ]
+        )
+
+        self.assertEqual(
+            writer.rows,
+            [
+                ("one", 1, True, False, False),
+                ("two", 1, True, False, False),
+                ("three", 3, False, False, True),
+            ],
+        )
+        self.assertTrue(writer.flushed)
+
+    def test_looks_up_media_once_per_change(self):
+        enricher = MediaEnricher(self.wiki.get_session)
+        writer = FakeWriter()
+
+        Pipeline(writer, enricher).run(
+            make_events([make_change(1, "#one #two #three #two", revision=11)])
+        )
+
+        self.assertEqual([row[0] for row in writer.rows], ["one", "two", "three"])
+        # Two parse requests and one imageinfo request, shared by three rows.
+        self.assertEqual(self.wiki.requests["en.wikipedia.org"], 3)
+        self.assertEqual(enricher.stats["requests"], 3)
+        self.assertEqual(enricher.stats["requests_saved"], 6)
+
+    def test_skips_changes_we_dont_log(self):
+        no_user = make_change(4, "#nouser", revision=11)
+        del no_user["user"]
+        writer = self.run_pipeline(
+            [
+                make_change(1, "#bot edit", revision=11, bot=True),
+                make_change(2, "#wikidata", domain="www.wikidata.org", revision=11),
+                make_change(3, "#if #12345 #x", revision=11),
+                no_user,
+                make_change(5, "#logged", revision=11),
+            ]
+        )
+
+        self.assertEqual([row[:2] for row in writer.rows], [("logged", 5)])
+        # Only the change we logged needed its media looking up.
+        self.assertEqual(self.wiki.requests["en.wikipedia.org"], 3)
+
+    def test_keeps_stream_order(self):
+        """
+        Changes are written in stream order even when a later change's media
+        lookups finish first.
+        """
+        changes = [
+            make_change(i, "#tag{}".format(i), domain=domain, revision=revision)
+            for i, (domain, revision) in enumerate(
+                [("slow.wikipedia.org", 21), ("en.wikipedia.org", 11)] * 3
+            )
+        ]
+
+        writer = self.run_pipeline(changes)
+
+        self.assertEqual([row[1] for row in writer.rows], list(range(6)))
+
+    def test_limits_requests_per_domain(self):
+        """
+        A slow wiki can't have more than its share of lookups running, and
+        doesn't hold up lookups for other wikis.
+        """
+        enricher = MediaEnricher(self.wiki.get_session, max_per_domain=2)
+        self.addCleanup(enricher.shutdown)
+
+        slow = [
+            enricher.submit(
+                make_change(i, "#slow", domain="slow.wikipedia.org", revision=21)
+            )
+            for i in range(6)
+        ]
+        fast = enricher.submit(make_change(100, "#fast", revision=11))
+
+        self.assertTrue(fast.result(timeout=5)["has_image"])
+        self.assertFalse(all(future.done() for future in slow))
+        for future in slow:
+            self.assertTrue(future.result(timeout=5)["has_audio"])
+        self.assertEqual(self.wiki.max_in_flight["slow.wikipedia.org"], 2)
+
+    def test_slow_writer_holds_back_stream(self):
+        """
+        While the writer is blocked, we only read as much of the stream as
+        fits in the queues.
+        """
+        unblock = threading.Event()
+        writer = FakeWriter(on_add=lambda: unblock.wait(timeout=5))
+        read = []
+
+        def events():
+            for i in range(50):
+                read.append(i)
+                yield from make_events([make_change(i, "#tag")])
+
+        pipeline = Pipeline(
+            writer,
+            MediaEnricher(self.wiki.get_session),
+            event_queue_size=2,
+            change_queue_size=2,
+        )
+        thread = threading.Thread(target=pipeline.run, args=(events(),))
+        thread.start()
+
+        time.sleep(0.5)
+        # One change with the writer, two in each queue, one in the filter
+        # stage and one in the reader.
+        self.assertLessEqual(len(read), 7)
+
+        unblock.set()
+        thread.join(timeout=5)
+        self.assertEqual(len(writer.rows), 50)
+
+    def test_passes_on_stream_position(self):
+        """
+        The writer hears about our position in the stream, but only once all
+        earlier changes have been added.
+        """
+        seen_at_add = []
+        writer = FakeWriter(on_add=lambda: seen_at_add.append(list(writer.checkpoints)))
+
+        self.run_pipeline(
+            [
+                make_change(1, "nothing"),
+                make_change(2, "#slow", domain="slow.wikipedia.org", revision=21),
+                make_change(3, "nothing"),
+            ],
+            writer=writer,
+        )
+
+        self.assertEqual(seen_at_add, [[]])
+        self.assertEqual(writer.checkpoints[-1], "3")
+
+    def test_writer_error_stops_pipeline(self):
+        def fail():
+            raise RuntimeError("database went away")
+
+        writer = FakeWriter(on_add=fail)
+
+        with self.assertRaises(RuntimeError):
+            self.run_pipeline([make_change(1, "#tag")], writer=writer)
+        self.assertTrue(writer.flushed)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, query, values):
+        self.connection.log.append((query, [values]))
+        if query.startswith(db.SELECT_TAG_IDS_QUERY[:40]):
+            # Names match the stored tags whatever their case, like the
+            # column's collation.
+            tag_ids = self.connection.tag_ids
+            self.results = [
+                (name, tag_ids[name.lower()])
+                for name in values
+                if name.lower() in tag_ids
+            ]
+        elif "hashtags_dailysketch" in query:
+            self.results = self.connection.sketches
+        if "hashtags_edittag" in query:
+            # Four values for each link.
+            self.rowcount = len(values) // 4 - self.connection.duplicates
+        else:
+            self.rowcount = 1
+
+    def executemany(self, query, rows):
+        self.connection.log.append((query, rows))
+        if query == db.INSERT_TAGS_QUERY:
+            # Give each new hashtag the next id.
+            tag_ids = self.connection.tag_ids
+            for (name,) in rows:
+                tag_ids.setdefault(name.lower(), len(tag_ids) + 1)
+        self.rowcount = len(rows)
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, duplicates=0, sketches=(), tag_ids=None):
+        self.log = []
+        self.duplicates = duplicates
+        # What the stored sketches query returns.
+        self.sketches = list(sketches)
+        # The stored hashtags' ids, by lowercased name.
+        self.tag_ids = dict(tag_ids or {})
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append(("COMMIT", None))
+
+    def rollback(self):
+        self.log.append(("ROLLBACK", None))
+
+
+class BufferedWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_writer(self, connection, **kwargs):
+        return db.BufferedWriter(connection, clock=self.clock, **kwargs)
+
+    def test_flushes_full_batches(self):
+        connection = FakeConnection()
+        writer = self.make_writer(connection, max_rows=3)
+        change = make_change(1, "#a #b #c #d")
+        change.update(has_image=False, has_video=False, has_audio=False)
+
+        for hashtag in "abcd":
+            writer.add(hashtag, change)
+
+        # The first three rows went in one commit, with a SELECT for their
+        # hashtags' ids, an INSERT for the new hashtags, a SELECT for their
+        # ids, an UPDATE for the watermarks, one INSERT for their edit, one
+        # for each daily total, a SELECT and an INSERT for their sketches and
+        # one to link them.
+        self.assertEqual(len(connection.log), 11)
+        self.assertEqual(connection.log[1][1], [("a",), ("b",), ("c",)])
+        self.assertEqual(connection.log[3][1], [[1, 2, 3]])
+        self.assertEqual(len(connection.log[4][1]), 1)
+        self.assertEqual(
+            connection.log[9][1],
+            [
+                [
+                    1,
+                    "en.wikipedia.org",
+                    1,
+                    "2024-04-04 16:41:00",
+                    2,
+                    "en.wikipedia.org",
+                    1,
+                    "2024-04-04 16:41:00",
+                    3,
+                    "en.wikipedia.org",
+                    1,
+                    "2024-04-04 16:41:00",
+                ]
+            ],
+        )
+        self.assertEqual(connection.log[10][0], "COMMIT")
+
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(len(connection.log), 22)
+
+    def test_flushes_old_rows(self):
+        connection = FakeConnection()
+        writer = self.make_writer(connection, max_delay_ms=1000)
+        change = make_change(1, "#a")
+        change.update(has_image=False, has_video=False, has_audio=False)
+
+        writer.add("a", change)
+        self.clock.now += 0.5
+        writer.maybe_flush()
+        self.assertEqual(connection.log, [])
+
+        self.clock.now += 0.5
+        writer.maybe_flush()
+        self.assertEqual(len(connection.log), 11)
+
+    def test_counts_duplicates(self):
+        connection = FakeConnection(duplicates=1)
+        writer = self.make_writer(connection)
+        change = make_change(1, "#a #b")
+        change.update(has_image=False, has_video=False, has_audio=False)
+
+        writer.add("a", change)
+        writer.add("b", change)
+
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(writer.duplicates_skipped, 1)
+
+    def test_saves_checkpoint_with_rows(self):
+        connection = FakeConnection()
+        writer = self.make_writer(connection, checkpoint_interval_ms=10000)
+        change = make_change(1, "#a")
+        change.update(has_image=False, has_video=False, has_audio=False)
+
+        writer.add("a", change)
+        writer.set_checkpoint("event-1")
+        writer.flush()
+
+        queries = [query for query, values in connection.log]
+        self.assertEqual(queries[1], db.INSERT_TAGS_QUERY)
+        self.assertEqual(queries[4], db.INSERT_EDITS_QUERY)
+        self.assertEqual(queries[10:], [db.CHECKPOINT_QUERY, "COMMIT"])
+        self.assertEqual(connection.log[10][1], [("recentchange", "event-1")])
+
+        # Without any rows, the checkpoint is saved every so often.
+        writer.set_checkpoint("event-2")
+        writer.maybe_flush()
+        self.assertEqual(len(connection.log), 12)
+        self.clock.now += 10
+        writer.maybe_flush()
+        self.assertEqual(connection.log[12][1], [("recentchange", "event-2")])
+
+    def test_links_case_variants_once(self):
+        connection = FakeConnection()
+        writer = self.make_writer(connection)
+        change = make_change(1, "#wlm #WLM")
+        change.update(has_image=False, has_video=False, has_audio=False)
+
+        writer.add("wlm", change)
+        writer.add("WLM", change)
+        writer.flush()
+
+        # Otherwise the edit would be counted twice in the daily totals.
+        self.assertEqual(
+            connection.log[9][1], [[1, "en.wikipedia.org", 1, "2024-04-04 16:41:00"]]
+        )
+
+    def test_remembers_tag_ids(self):
+        connection = FakeConnection()
+        writer = self.make_writer(connection)
+        for rc_id in (1, 2):
+            change = make_change(rc_id, "#wlm")
+            change.update(has_image=False, has_video=False, has_audio=False)
+            writer.add("wlm", change)
+            writer.flush()
+
+        queries = [query for query, values in connection.log]
+        self.assertEqual(
+            queries.count(db.SELECT_TAG_IDS_QUERY.format(names=db.NAME_VALUES)), 2
+        )
+        self.assertEqual(queries.count(db.INSERT_TAGS_QUERY), 1)
+        self.assertEqual(writer.tag_ids, {"wlm": 1})
+        # The hashtag's watermark was still advanced by both batches.
+        watermarks = db.UPDATE_WATERMARKS_QUERY.format(tag_ids="%s")
+        self.assertEqual(
+            [values for query, values in connection.log if query == watermarks],
+            [[[1]], [[1]]],
+        )
+
+    def test_only_inserts_new_tags(self):
+        """
+        Hashtags that are already stored, under any name the database treats
+        as the same, are looked up rather than inserted, which would use up
+        an id each time.
+        """
+        connection = FakeConnection(tag_ids={"wlm": 1})
+        writer = self.make_writer(connection)
+        change = make_change(1, "#WLM #new")
+        change.update(has_image=False, has_video=False, has_audio=False)
+
+        writer.add("WLM", change)
+        writer.add("new", change)
+        writer.flush()
+
+        inserted = [
+            values for query, values in connection.log if query == db.INSERT_TAGS_QUERY
+        ]
+        self.assertEqual(inserted, [[("new",)]])
+        # Each name is remembered as it was written, with the stored tag's id.
+        self.assertEqual(writer.tag_ids, {"WLM": 1, "new": 2})
+
+    def test_forgets_tag_ids_on_rollback(self):
+        connection = FakeConnection()
+        writer = self.make_writer(connection)
+        writer.new_tag_ids = {"wlm": 1}
+
+        writer._rollback()
+        writer._commit()
+
+        self.assertEqual(writer.tag_ids, {})
+
+    def test_merges_stored_sketches(self):
+        stored = HyperLogLog()
+        stored.add("Someone else")
+        empty = HyperLogLog().to_bytes()
+        connection = FakeConnection(
+            sketches=[(1, "2024-04-04", stored.to_bytes(), empty, empty)]
+        )
+        writer = self.make_writer(connection)
+
+        for rc_id, hashtag in [(1, "WLM"), (2, "wlm")]:
+            change = make_change(rc_id, "#" + hashtag, revision=rc_id + 10)
+            change.update(has_image=False, has_video=False, has_audio=False)
+            writer.add(hashtag, change)
+        writer.flush()
+
+        query, values = connection.log[7]
+        # Locked until the batch commits, so no other writer can merge into
+        # them meanwhile.
+        self.assertIn("FOR UPDATE", query)
+        self.assertEqual(values, [[1, "2024-04-04"]])
+        (upserted,) = connection.log[8][1]
+        self.assertEqual(upserted[:2], (1, "2024-04-04"))
+        users, pages, revisions = (
+            HyperLogLog.from_bytes(sketch).count() for sketch in upserted[2:]
+        )
+        self.assertEqual((users, pages, revisions), (2, 1, 2))
+
+
+class HyperLogLogTest(unittest.TestCase):
+    def test_estimates_distinct_values(self):
+        for distinct in (0, 1, 100, 20000):
+            sketch = HyperLogLog()
+            for value in range(distinct):
+                sketch.add(value)
+                sketch.add(value)
+            self.assertAlmostEqual(sketch.count(), distinct, delta=distinct * 0.05)
+
+    def test_merges_sketches(self):
+        first = HyperLogLog()
+        second = HyperLogLog()
+        for value in range(1000):
+            first.add(value)
+            second.add(value + 500)
+
+        first.update(second)
+
+        self.assertAlmostEqual(first.count(), 1500, delta=75)
+
+    def test_stores_small_sketches_sparsely(self):
+        sketch = HyperLogLog()
+        for value in range(10):
+            sketch.add(value)
+
+        self.assertEqual(len(sketch.to_bytes()), 30)
+        self.assertEqual(
+            HyperLogLog.from_bytes(sketch.to_bytes()).registers, sketch.registers
+        )
+
+        for value in range(10000):
+            sketch.add(value)
+
+        self.assertEqual(len(sketch.to_bytes()), REGISTERS)
+        self.assertEqual(
+            HyperLogLog.from_bytes(sketch.to_bytes()).registers, sketch.registers
+        )
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MediaTypeCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = MediaTypeCache(max_size=2)
+        cache.set("en.wikipedia.org", "A.jpg", "BITMAP")
+        cache.set("en.wikipedia.org", "B.jpg", "BITMAP")
+        # Using A makes B the least recently used.
+        cache.get("en.wikipedia.org", "A.jpg")
+        cache.set("en.wikipedia.org", "C.ogg", "AUDIO")
+
+        self.assertEqual(cache.get("en.wikipedia.org", "A.jpg"), "BITMAP")
+        self.assertIs(cache.get("en.wikipedia.org", "B.jpg"), MISSING)
+        self.assertEqual(cache.get("en.wikipedia.org", "C.ogg"), "AUDIO")
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(cache.stats["hits"], 3)
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = MediaTypeCache(ttl_s=60, clock=clock)
+        cache.set("en.wikipedia.org", "A.jpg", "BITMAP")
+        cache.set("en.wikipedia.org", "Missing.jpg", None)
+
+        clock.now += 59
+        self.assertEqual(cache.get("en.wikipedia.org", "A.jpg"), "BITMAP")
+        self.assertIsNone(cache.get("en.wikipedia.org", "Missing.jpg"))
+        # The same file on another wiki is a different entry.
+        self.assertIs(cache.get("fr.wikipedia.org", "A.jpg"), MISSING)
+
+        clock.now += 1
+        self.assertIs(cache.get("en.wikipedia.org", "A.jpg"), MISSING)
+        self.assertEqual(cache.stats["expired"], 1)
+
+    def test_persists_to_disk(self):
+        clock = FakeClock()
+        path = os.path.join(tempfile.mkdtemp(), "media_cache.sqlite3")
+        cache = MediaTypeCache(ttl_s=60, path=path, clock=clock)
+        cache.set("en.wikipedia.org", "A.jpg", "BITMAP")
+        clock.now += 30
+        cache.set("en.wikipedia.org", "B.webm", "VIDEO")
+        cache.close()
+
+        clock.now += 45
+        cache = MediaTypeCache(ttl_s=60, path=path, clock=clock)
+        self.addCleanup(cache.close)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("en.wikipedia.org", "B.webm"), "VIDEO")
+
+    def test_prunes_disk_as_it_commits(self):
+        """
+        Expired entries are deleted from disk, and at most max_size entries
+        kept there, whenever a batch is committed.
+        """
+        clock = FakeClock()
+        path = os.path.join(tempfile.mkdtemp(), "media_cache.sqlite3")
+        cache = MediaTypeCache(
+            max_size=3, ttl_s=60, path=path, clock=clock, commit_every=6
+        )
+        self.addCleanup(cache.close)
+        cache.set("en.wikipedia.org", "Old.jpg", "BITMAP")
+        clock.now += 61
+
+        for i in range(5):
+            clock.now += 1
+            cache.set("en.wikipedia.org", "{}.jpg".format(i), "BITMAP")
+
+        self.assertEqual(
+            sorted(cache.db.execute("SELECT filename FROM media_types")),
+            [("2.jpg",), ("3.jpg",), ("4.jpg",)],
+        )
+
+    def test_pipeline_reuses_media_types(self):
+        wiki = FakeMediaWiki(
+            revisions={
+                ("en.wikipedia.org", 10): [],
+                ("en.wikipedia.org", 11): ["Popular_photo.jpg", "Broken.jpg"],
+            },
+            media_types={"Popular photo.jpg": "BITMAP"},
+        )
+        self.addCleanup(wiki.close)
+        cache = MediaTypeCache()
+        writer = FakeWriter()
+
+        # One lookup at a time, so that each change sees the one before it.
+        enricher = MediaEnricher(wiki.get_session, max_per_domain=1, cache=cache)
+        Pipeline(writer, enricher).run(
+            make_events(
+                [make_change(i, "#wlm", revision=11) for i in range(1, 4)],
+            )
+        )
+
+        self.assertEqual(
+            writer.rows, [("wlm", i, True, False, False) for i in (1, 2, 3)]
+        )
+        # Two parse requests per change, but only the first needed imageinfo.
+        self.assertEqual(wiki.requests["en.wikipedia.org"], 7)
+        self.assertEqual(cache.get("en.wikipedia.org", "Popular_photo.jpg"), "BITMAP")
+        self.assertIsNone(cache.get("en.wikipedia.org", "Broken.jpg"))
+
+
+class HashtagExtractorTest(unittest.TestCase):
+    def test_extracts_valid_hashtags(self):
+        extractor = HashtagExtractor()
+        self.assertEqual(
+            extractor.extract("#WLM photo #wlm ＃Wiki_Loves #WLM #1lib1ref"),
+            ["WLM", "wlm", "Wiki_Loves", "1lib1ref"],
+        )
+        self.assertEqual(extractor.extract("No hashtags, not even in#here"), [])
+
+    def test_excludes_hashtags(self):
+        extractor = HashtagExtractor()
+        self.assertEqual(
+            extractor.extract(
+                "#Redirect #if #123 #a #temporary_batch_1712248860000 #QuickStatements"
+            ),
+            [],
+        )
+        self.assertEqual(
+            extractor.extract("#temporary_batch_171224886 #redirects"),
+            ["temporary_batch_171224886", "redirects"],
+        )
+
+    def test_matches_per_hashtag_functions(self):
+        comment = "#wlm #WLM #if #12 #x ＃ok #temporary_batch_1712248860000"
+        self.assertEqual(
+            HashtagExtractor().extract(comment),
+            [h for h in dict.fromkeys(hashtag_match(comment)) if valid_hashtag(h)],
+        )
+        self.assertIsNone(hashtag_match("Typo"))
+        self.assertFalse(valid_hashtag(None))
+
+    def test_prefilters_raw_events(self):
+        def data(comment, **kwargs):
+            return json.dumps(make_change(1, comment, **kwargs), separators=(",", ":"))
+
+        self.assertTrue(might_have_hashtags(data("#wlm")))
+        self.assertTrue(might_have_hashtags(data("＃wlm")))
+        self.assertTrue(might_have_hashtags(json.dumps(make_change(1, "＃wlm"))))
+        self.assertTrue(might_have_hashtags(data('#wlm "bot":true')))
+        self.assertFalse(might_have_hashtags(data("Typo")))
+        self.assertFalse(might_have_hashtags(data("#wlm", bot=True)))
+        self.assertFalse(might_have_hashtags(data("#wlm", domain="www.wikidata.org")))
+
+
+class ReplayTest(unittest.TestCase):
+    def test_replays_into_sqlite(self):
+        changes = [
+            make_change(1, "#wlm", timestamp=1712248860),
+            make_change(2, "Typo", timestamp=1712248861),
+            make_change(3, "#WLM #other", timestamp=1712248862, user="Other"),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            recording = os.path.join(directory, "events.jsonl")
+            database = os.path.join(directory, "hashtags.sqlite3")
+            with open(recording, "w") as f:
+                for change in changes:
+                    f.write(json.dumps(change) + "\n")
+
+            # Replaying again doesn't log the same hashtags twice.
+            for _ in range(2):
+                replay.main(["run", recording, "--sqlite", database])
+
+            connection = sqlite3.connect(database)
+            rows = connection.execute("""
+                SELECT tag.name, edit.rc_id FROM hashtags_edittag AS link
+                JOIN hashtags_tag AS tag ON tag.id = link.tag_id
+                JOIN hashtags_edit AS edit ON edit.id = link.edit_id
+                ORDER BY link.id
+                """).fetchall()
+            checkpoint = connection.execute(
+                "SELECT last_event_id FROM hashtags_streamcheckpoint"
+            ).fetchone()
+            watermarks = connection.execute(
+                "SELECT name, watermark FROM hashtags_tag ORDER BY name"
+            ).fetchall()
+            daily_edits = connection.execute("""
+                SELECT tag.name, rollup.day, rollup.domain, rollup.edits
+                FROM hashtags_dailydomainedits AS rollup
+                JOIN hashtags_tag AS tag ON tag.id = rollup.tag_id
+                ORDER BY rollup.id
+                """).fetchall()
+            sketches = connection.execute("""
+                SELECT tag.name, sketch.day, sketch.users
+                FROM hashtags_dailysketch AS sketch
+                JOIN hashtags_tag AS tag ON tag.id = sketch.tag_id
+                ORDER BY sketch.id
+                """).fetchall()
+            connection.close()
+
+        # Hashtags are stored once, in the case they were first seen in.
+        self.assertEqual(rows, [("wlm", 1), ("wlm", 3), ("other", 3)])
+        # Each replay advanced the watermarks of the hashtags it logged.
+        self.assertEqual(watermarks, [("other", 2), ("wlm", 2)])
+        # Replaying again didn't add to the daily totals either.
+        self.assertEqual(
+            daily_edits,
+            [
+                ("wlm", "2024-04-04", "en.wikipedia.org", 2),
+                ("other", "2024-04-04", "en.wikipedia.org", 1),
+            ],
+        )
+        self.assertEqual(
+            [
+                (name, day, HyperLogLog.from_bytes(users).count())
+                for name, day, users in sketches
+            ],
+            [("wlm", "2024-04-04", 2), ("other", "2024-04-04", 1)],
+        )
+        # Events are numbered by their line in the recording.
+        self.assertEqual(checkpoint, ("3",))
+
+
+if __name__ == "__main__":
+    unittest.main()